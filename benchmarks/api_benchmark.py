@@ -0,0 +1,254 @@
+"""
+API endpoint benchmark.
+
+Generates a synthetic dataset (see benchmarks.dataset) and times the key endpoints as admin, workspace manager and
+regular user. The results can be written to a JSON report and compared with a report from another commit:
+
+  python -m benchmarks.api_benchmark --users 5000 --workspaces 200 --output after.json
+  python -m benchmarks.api_benchmark --compare before.json after.json
+"""
+import argparse
+import datetime
+import json
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import sqlalchemy as sa
+
+from benchmarks.common import ApiClient, create_benchmark_app, drop_benchmark_app
+from benchmarks.dataset import generate_dataset, MANAGER_EXT_ID, MANAGER_PASSWORD, USER_EXT_ID, USER_PASSWORD
+from pebbles.models import db, ApplicationSession, Lock
+
+ROLES = ('admin', 'manager', 'user')
+
+# median time increase that is reported as a regression in --compare
+DEFAULT_REGRESSION_THRESHOLD = 0.2
+
+
+def delete_session(app, resp):
+    """Mark a session created by the benchmark deleted, so that the next one fits in the per user limit"""
+    with app.app_context():
+        db.session.execute(
+            sa.update(ApplicationSession)
+            .where(ApplicationSession.id == resp.json['id'])
+            .values(_state=ApplicationSession.STATE_DELETED)
+        )
+        db.session.commit()
+
+
+def create_lock(app, lock_id):
+    with app.app_context():
+        db.session.add(Lock(lock_id, 'benchmark'))
+        db.session.commit()
+
+
+def delete_lock(app, lock_id):
+    with app.app_context():
+        db.session.execute(sa.delete(Lock).where(Lock.id == lock_id))
+        db.session.commit()
+
+
+# name, method, path, request data, roles, setup(app, ctx) and teardown(app, ctx, resp) run outside the timing
+ENDPOINTS = (
+    ('session list', 'GET', 'application_sessions', None, ROLES, None, None),
+    ('session create', 'POST', 'application_sessions', dict(application_id='{application_id}'), ROLES, None,
+     lambda app, ctx, resp: delete_session(app, resp)),
+    ('application list', 'GET', 'applications', None, ROLES, None, None),
+    ('workspace list', 'GET', 'workspaces', None, ROLES, None, None),
+    ('workspace members', 'GET', 'workspaces/{workspace_id}/members', None, ('admin', 'manager'), None, None),
+    ('workspace accounting', 'GET', 'workspaces/{workspace_id}/accounting', None, ('admin',), None, None),
+    ('accounting report', 'GET', 'workspace_accounting?start_ts={start_ts}&end_ts={end_ts}', None, ('admin',),
+     None, None),
+    ('alert list', 'GET', 'alerts', None, ('admin',), None, None),
+    ('system status', 'GET', 'status', None, ROLES, None, None),
+    ('lock list', 'GET', 'locks', None, ('admin',), None, None),
+    ('lock obtain', 'PUT', 'locks/{lock_id}', dict(owner='benchmark'), ('admin',), None,
+     lambda app, ctx, resp: delete_lock(app, ctx['lock_id'])),
+    ('lock release', 'DELETE', 'locks/{lock_id}', None, ('admin',),
+     lambda app, ctx: create_lock(app, ctx['lock_id']), None),
+)
+
+
+def format_data(data, ctx):
+    if data is None:
+        return None
+    return {key: value.format(**ctx) if isinstance(value, str) else value for key, value in data.items()}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def summarize(timings):
+    return dict(
+        count=len(timings),
+        median_ms=round(statistics.median(timings) * 1000, 3),
+        mean_ms=round(statistics.mean(timings) * 1000, 3),
+        p95_ms=round(percentile(timings, 95) * 1000, 3),
+        min_ms=round(min(timings) * 1000, 3),
+        max_ms=round(max(timings) * 1000, 3),
+    )
+
+
+def query_count(resp):
+    """The number of SQL queries reported in the Server-Timing header"""
+    match = re.search(r'desc="(\d+) queries"', resp.headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else None
+
+
+def time_endpoint(app, client, endpoint, ctx, repeats):
+    name, method, path, data, _, setup, teardown = endpoint
+    timings = []
+    queries = None
+    # one extra round to warm up caches and lazy initialization
+    for i in range(repeats + 1):
+        ctx['lock_id'] = 'benchmark-%s-%d' % (client.role, i)
+        if setup:
+            setup(app, ctx)
+        start_ts = time.perf_counter()
+        resp = client.open(method, path.format(**ctx), format_data(data, ctx))
+        # streamed responses are generated only when the body is read
+        resp.get_data()
+        elapsed = time.perf_counter() - start_ts
+        if resp.status_code != 200:
+            raise RuntimeError('%s as %s failed: %s %s' % (
+                name, client.role, resp.status_code, resp.get_data(as_text=True)))
+        if teardown:
+            teardown(app, ctx, resp)
+        if i:
+            timings.append(elapsed)
+            queries = query_count(resp)
+    return dict(summarize(timings), queries=queries)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(dataset_args, repeats, endpoint_filter=None):
+    app = create_benchmark_app()
+    try:
+        with app.app_context():
+            start_ts = time.time()
+            dataset = generate_dataset(**dataset_args)
+            generation_time = time.time() - start_ts
+            dialect = db.engine.dialect.name
+
+        clients = dict(
+            admin=ApiClient(app),
+            manager=ApiClient(app, MANAGER_EXT_ID, MANAGER_PASSWORD),
+            user=ApiClient(app, USER_EXT_ID, USER_PASSWORD),
+        )
+        for role, client in clients.items():
+            client.role = role
+
+        now = int(time.time())
+        ctx = dict(
+            workspace_id=dataset['workspace_id'],
+            application_id=dataset['application_id'],
+            start_ts=now - 365 * 24 * 3600,
+            end_ts=now,
+        )
+        results = {}
+        for endpoint in ENDPOINTS:
+            name, method, path, _, roles, _, _ = endpoint
+            if endpoint_filter and endpoint_filter not in name:
+                continue
+            for role in roles:
+                key = '%s [%s]' % (name, role)
+                results[key] = time_endpoint(app, clients[role], endpoint, ctx, repeats)
+                results[key]['request'] = '%s %s' % (method, path.split('?')[0])
+                print('%-36s median %8.2f ms   p95 %8.2f ms   queries %s' % (
+                    key, results[key]['median_ms'], results[key]['p95_ms'], results[key]['queries']))
+
+        return dict(
+            meta=dict(
+                revision=git_revision(),
+                created_at=datetime.datetime.utcnow().isoformat(timespec='seconds'),
+                python=platform.python_version(),
+                database=dialect,
+                repeats=repeats,
+                dataset_args=dataset_args,
+                dataset_counts=dataset['counts'],
+                generation_time_s=round(generation_time, 2),
+            ),
+            results=results,
+        )
+    finally:
+        drop_benchmark_app(app)
+
+
+def compare(baseline, current, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """Print the median timings of two reports side by side. Returns the keys that got slower than the threshold."""
+    if baseline['meta'].get('dataset_counts') != current['meta'].get('dataset_counts'):
+        print('warning: the reports have been generated with different datasets')
+    print('%-36s %12s %12s %8s' % ('endpoint', 'before ms', 'after ms', 'change'))
+    regressions = []
+    for key, result in current['results'].items():
+        if key not in baseline['results']:
+            print('%-36s %12s %12.2f' % (key, '-', result['median_ms']))
+            continue
+        before = baseline['results'][key]['median_ms']
+        change = (result['median_ms'] - before) / before if before else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(key)
+            flag = ' <-- regression'
+        print('%-36s %12.2f %12.2f %+7.0f%%%s' % (key, before, result['median_ms'], change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--workspaces', type=int, default=50)
+    parser.add_argument('--members-per-workspace', type=int, default=20)
+    parser.add_argument('--applications-per-workspace', type=int, default=3)
+    parser.add_argument('--sessions-per-user', type=int, default=10)
+    parser.add_argument('--logs-per-session', type=int, default=5)
+    parser.add_argument('--alerts', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=20, help='timed requests per endpoint and role')
+    parser.add_argument('--filter', help='only run the endpoints with this in their name')
+    parser.add_argument('--output', help='write the report to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='compare two reports instead of running the benchmark')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='relative median increase reported as a regression in --compare')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    dataset_args = dict(
+        num_users=args.users,
+        num_workspaces=args.workspaces,
+        members_per_workspace=args.members_per_workspace,
+        applications_per_workspace=args.applications_per_workspace,
+        sessions_per_user=args.sessions_per_user,
+        logs_per_session=args.logs_per_session,
+        num_alerts=args.alerts,
+        seed=args.seed,
+    )
+    report = run(dataset_args, args.repeats, args.filter)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('report written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
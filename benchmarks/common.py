@@ -0,0 +1,75 @@
+import base64
+import json
+import os
+
+import pebbles.app
+from pebbles.config import TestConfig
+from pebbles.models import db, User
+
+ADMIN_EXT_ID = 'admin@example.org'
+ADMIN_PASSWORD = 'admin'
+
+
+class BenchmarkConfig(TestConfig):
+    SQLALCHEMY_DATABASE_URI = os.environ.get('PEBBLES_BENCHMARK_DATABASE_URI', TestConfig.SQLALCHEMY_DATABASE_URI)
+
+
+def create_benchmark_app(config=None):
+    """Create an app with empty tables and an admin user. The caller should drop the tables with drop_benchmark_app()
+    when done."""
+    app = pebbles.app.create_app(config or BenchmarkConfig())
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        admin = User(ADMIN_EXT_ID, ADMIN_PASSWORD, is_admin=True)
+        db.session.add(admin)
+        db.session.commit()
+    return app
+
+
+def drop_benchmark_app(app):
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+class ApiClient:
+    """Minimal API client on top of the Flask test client, counting the requests made"""
+
+    def __init__(self, app, ext_id=ADMIN_EXT_ID, password=ADMIN_PASSWORD):
+        self.client = app.test_client()
+        self.num_requests = 0
+        resp = self.client.post(
+            '/api/v1/sessions',
+            json=dict(ext_id=ext_id, password=password, agreement_sign='signed')
+        )
+        if resp.status_code != 200:
+            raise RuntimeError('login failed: %s' % resp.status_code)
+        token = base64.b64encode(('%s:' % resp.json['token']).encode('ascii')).decode('utf-8')
+        self.headers = {'Authorization': 'Basic %s' % token, 'Accept': 'application/json'}
+
+    def open(self, method, path, data=None):
+        """Make a request and return the response as is"""
+        self.num_requests += 1
+        return self.client.open(
+            '/api/v1/%s' % path,
+            method=method,
+            headers=self.headers,
+            data=json.dumps(data) if data is not None else None,
+            content_type='application/json',
+        )
+
+    def request(self, method, path, data=None):
+        resp = self.open(method, path, data)
+        if resp.status_code != 200:
+            raise RuntimeError('%s %s failed: %s %s' % (method, path, resp.status_code, resp.get_data(as_text=True)))
+        return resp.json
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, data=None):
+        return self.request('POST', path, data)
+
+    def patch(self, path, data=None):
+        return self.request('PATCH', path, data)
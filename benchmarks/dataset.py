@@ -0,0 +1,258 @@
+"""
+Synthetic dataset generator for the API benchmarks.
+
+Generates users, workspaces with memberships and applications, and application sessions with history and logs. The
+bulk of the rows is inserted with insert(Model), bypassing the ORM unit of work, so that large datasets can be
+generated in reasonable time. All generated users share the same password, hashed only once.
+
+Three known accounts are created for benchmarking the different roles:
+ - admin@example.org (created by create_benchmark_app())
+ - manager@example.org, owner and manager of the first workspaces
+ - user@example.org, member of the first workspaces
+
+  python -m benchmarks.dataset --users 10000 --workspaces 500 --sessions-per-user 20
+"""
+import argparse
+import datetime
+import random
+import time
+import uuid
+
+import sqlalchemy as sa
+
+from benchmarks.common import create_benchmark_app, drop_benchmark_app
+from pebbles.models import db, User, Workspace, WorkspaceMembership, ApplicationTemplate, Application, \
+    ApplicationSession, ApplicationSessionLog, Alert, Lock
+from pebbles.utils import hash_password
+
+MANAGER_EXT_ID = 'manager@example.org'
+MANAGER_PASSWORD = 'manager'
+USER_EXT_ID = 'user@example.org'
+USER_PASSWORD = 'user'
+GENERATED_USER_PASSWORD = 'benchmark'
+
+# number of workspaces the manager and user accounts belong to
+ROLE_WORKSPACES = 5
+
+INSERT_BATCH_SIZE = 5000
+
+TEMPLATE_BASE_CONFIG = {
+    'labels': '["python", "benchmark"]',
+    'cost_multiplier': '1.0',
+    'maximum_lifetime': 3600,
+    'memory_gib': 1,
+    'allow_update_client_connectivity': False,
+    'image': 'registry.example.org/pebbles/benchmark',
+    'port': 8888,
+    'volume_mount_path': '/home/jovyan',
+}
+TEMPLATE_ATTRIBUTE_LIMITS = [
+    dict(name='maximum_lifetime', min=0, max=3600 * 12),
+    dict(name='memory_gib', min=0, max=8),
+]
+
+
+def bulk_insert(model, rows):
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.session.execute(sa.insert(model), rows[i:i + INSERT_BATCH_SIZE])
+    db.session.commit()
+
+
+def generate_dataset(num_users=1000, num_workspaces=50, members_per_workspace=20, applications_per_workspace=3,
+                     sessions_per_user=10, live_session_ratio=0.2, logs_per_session=5, num_alerts=100,
+                     num_locks=10, history_days=180, clusters=('cluster-1', 'cluster-2'), seed=None):
+    """Fill the database with a synthetic dataset. Needs an app context. Returns the row counts and the ids needed for
+    benchmarking the role accounts."""
+    rnd = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    counts = {}
+
+    # users, the role accounts first
+    password_hash = hash_password(GENERATED_USER_PASSWORD, 4)
+    user_rows = [
+        User.insert_values(MANAGER_EXT_ID, hash_password(MANAGER_PASSWORD, 4)),
+        User.insert_values(USER_EXT_ID, hash_password(USER_PASSWORD, 4)),
+    ]
+    user_rows[0]['workspace_quota'] = ROLE_WORKSPACES
+    user_rows.extend(
+        User.insert_values('user-%06d@example.org' % i, password_hash) for i in range(num_users)
+    )
+    bulk_insert(User, user_rows)
+    user_ids = [row['id'] for row in user_rows]
+    manager_id, user_id = user_ids[:2]
+    counts['users'] = len(user_rows)
+
+    # workspaces with applications
+    template = ApplicationTemplate(
+        'Benchmark template', 'template for benchmarks', 'jupyter', TEMPLATE_ATTRIBUTE_LIMITS,
+        TEMPLATE_BASE_CONFIG, is_enabled=True
+    )
+    db.session.add(template)
+    workspaces = []
+    applications = []
+    for i in range(num_workspaces):
+        ws = Workspace('Workspace %d' % i, 'benchmark workspace', cluster=clusters[i % len(clusters)],
+                       memory_limit_gib=100000)
+        if i % 4 == 3:
+            ws.membership_expiry_policy = dict(kind=Workspace.MEP_ACTIVITY_TIMEOUT, timeout_days=30 + i % 60)
+        workspaces.append(ws)
+        for j in range(applications_per_workspace):
+            applications.append(Application(
+                'Application %d-%d' % (i, j), 'benchmark application', template.id, ws.id,
+                labels=['python', 'benchmark'], is_enabled=True, base_config=TEMPLATE_BASE_CONFIG.copy(),
+                attribute_limits=TEMPLATE_ATTRIBUTE_LIMITS, application_type=template.application_type
+            ))
+    db.session.add_all(workspaces)
+    db.session.add_all(applications)
+    # plain values, so that the objects need not be refreshed after commit
+    workspaces = [(ws.id, ws.cluster) for ws in workspaces]
+    applications = [(a.id, a.workspace_id, a.maximum_lifetime) for a in applications]
+    db.session.commit()
+    counts['workspaces'] = len(workspaces)
+    counts['applications'] = len(applications)
+
+    # memberships, the role accounts belong to the first workspaces
+    members = {}
+    membership_rows = []
+    for i, (ws_id, _) in enumerate(workspaces):
+        ws_members = set(rnd.sample(user_ids[2:], min(members_per_workspace, len(user_ids) - 2)))
+        if i < ROLE_WORKSPACES:
+            membership_rows.append(dict(workspace_id=ws_id, user_id=manager_id, is_manager=True, is_owner=True))
+            ws_members.add(user_id)
+        members[ws_id] = ws_members
+        membership_rows.extend(dict(workspace_id=ws_id, user_id=uid, is_manager=False, is_owner=False)
+                               for uid in ws_members)
+    bulk_insert(WorkspaceMembership, membership_rows)
+    counts['memberships'] = len(membership_rows)
+
+    # sessions with history. Each user has at most one live session, the role accounts none, so that they can
+    # create new ones within the per user limit.
+    workspace_clusters = dict(workspaces)
+    applications_by_user = {}
+    for application in applications:
+        for uid in members[application[1]]:
+            applications_by_user.setdefault(uid, []).append(application)
+
+    session_rows = []
+    log_rows = []
+    for uid, user_applications in applications_by_user.items():
+        has_live_session = uid not in (manager_id, user_id) and rnd.random() < live_session_ratio
+        for k in range(sessions_per_user):
+            application_id, workspace_id, maximum_lifetime = rnd.choice(user_applications)
+            if has_live_session and k == 0:
+                provisioned_at = now - datetime.timedelta(seconds=rnd.randint(60, 3000))
+                deprovisioned_at = None
+                state = ApplicationSession.STATE_RUNNING
+                next_action_at = provisioned_at + datetime.timedelta(seconds=maximum_lifetime)
+            else:
+                provisioned_at = now - datetime.timedelta(seconds=rnd.randint(3600, history_days * 24 * 3600))
+                deprovisioned_at = provisioned_at + datetime.timedelta(seconds=rnd.randint(600, 8 * 3600))
+                state = ApplicationSession.STATE_DELETED
+                next_action_at = None
+            cluster = workspace_clusters[workspace_id]
+            session_id = uuid.uuid4().hex
+            session_rows.append(dict(
+                id=session_id,
+                user_id=uid,
+                application_id=application_id,
+                workspace_id=workspace_id,
+                name='pb-benchmark-%s' % session_id[:12],
+                created_at=provisioned_at - datetime.timedelta(seconds=rnd.randint(5, 60)),
+                provisioned_at=provisioned_at,
+                deprovisioned_at=deprovisioned_at,
+                errored=False,
+                _state=state,
+                to_be_deleted=False,
+                log_fetch_pending=False,
+                _provisioning_config=dict(TEMPLATE_BASE_CONFIG, cluster=cluster),
+                memory_gib=float(TEMPLATE_BASE_CONFIG['memory_gib']),
+                cluster=cluster,
+                next_action_at=next_action_at,
+                backoff_count=0,
+            ))
+            log_ts = provisioned_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+            log_rows.extend(
+                dict(
+                    id=uuid.uuid4().hex,
+                    application_session_id=session_id,
+                    log_level='info',
+                    log_type='provisioning',
+                    timestamp=log_ts - logs_per_session + n,
+                    message='provisioning step %d' % n,
+                )
+                for n in range(logs_per_session)
+            )
+    bulk_insert(ApplicationSession, session_rows)
+    bulk_insert(ApplicationSessionLog, log_rows)
+    counts['application_sessions'] = len(session_rows)
+    counts['live_application_sessions'] = sum(
+        1 for row in session_rows if row['_state'] != ApplicationSession.STATE_DELETED)
+    counts['application_session_logs'] = len(log_rows)
+
+    # alerts, mostly archived history with some currently firing ones
+    alert_rows = []
+    for i in range(num_alerts):
+        first_seen = now - datetime.timedelta(seconds=rnd.randint(60, history_days * 24 * 3600))
+        data = dict(name='alert-%d' % (i % 20), severity=rnd.choice(('warning', 'error')), index=i)
+        target = clusters[i % len(clusters)]
+        alert_rows.append(dict(
+            id=Alert.generate_alert_id(target, 'prometheus', data),
+            target=target,
+            source='prometheus',
+            status='firing' if i % 10 == 0 else 'archived',
+            _data=data,
+            _first_seen_ts=first_seen,
+            _last_seen_ts=first_seen + datetime.timedelta(seconds=rnd.randint(60, 3600)),
+        ))
+    bulk_insert(Alert, alert_rows)
+    counts['alerts'] = len(alert_rows)
+
+    db.session.add_all(Lock('benchmark-lock-%d' % i, 'worker-%d' % (i % 3)) for i in range(num_locks))
+    db.session.commit()
+    counts['locks'] = num_locks
+
+    return dict(
+        counts=counts,
+        workspace_id=workspaces[0][0],
+        application_id=applications[0][0],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--workspaces', type=int, default=50)
+    parser.add_argument('--members-per-workspace', type=int, default=20)
+    parser.add_argument('--applications-per-workspace', type=int, default=3)
+    parser.add_argument('--sessions-per-user', type=int, default=10)
+    parser.add_argument('--logs-per-session', type=int, default=5)
+    parser.add_argument('--alerts', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--keep', action='store_true', help='leave the dataset in the database')
+    args = parser.parse_args()
+
+    app = create_benchmark_app()
+    try:
+        with app.app_context():
+            start_ts = time.time()
+            dataset = generate_dataset(
+                num_users=args.users,
+                num_workspaces=args.workspaces,
+                members_per_workspace=args.members_per_workspace,
+                applications_per_workspace=args.applications_per_workspace,
+                sessions_per_user=args.sessions_per_user,
+                logs_per_session=args.logs_per_session,
+                num_alerts=args.alerts,
+                seed=args.seed,
+            )
+            elapsed = time.time() - start_ts
+        for key, value in dataset['counts'].items():
+            print('%-28s %d' % (key + ':', value))
+        print('%-28s %.2f s' % ('elapsed:', elapsed))
+    finally:
+        if not args.keep:
+            drop_benchmark_app(app)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""
+API server load test.
+
+Serves the API with gunicorn, configured by pebbles.gunicorn_config, in a number of server modes and runs the same load
+against each:
+ - clients listing applications as fast as they can
+ - clients logging in through SSO against an identity provider that takes a while to answer
+ - clients keeping an application session event stream open, like the UI
+ - clients long-polling the application session changes, like the workers
+
+Reports the throughput and the latency of the application list requests, which shows how well each mode keeps serving
+while the slow logins, streams and long-polls are holding connections, and how many streams were opened and how many
+clients got a 503 and fell back to polling the session list.
+
+  python -m benchmarks.gunicorn_load --duration 20 --clients 16 --sso-clients 4 --stream-clients 8 --poll-clients 2
+
+The modes are 'single-sync' (one sync worker, the gunicorn defaults used before), 'sync', 'gthread' and 'gevent'.
+Sync workers cannot serve the event stream, so the sync modes run with it disabled and all stream clients fall back
+to polling. gevent mode needs gevent and psycogreen installed and is skipped otherwise. By default the database is a
+temporary SQLite file, set PEBBLES_BENCHMARK_DATABASE_URI for PostgreSQL.
+"""
+import argparse
+import base64
+import importlib.util
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import yaml
+
+from benchmarks.api_benchmark import percentile
+from benchmarks.common import ADMIN_EXT_ID, ADMIN_PASSWORD, BenchmarkConfig, create_benchmark_app, \
+    drop_benchmark_app
+from benchmarks.dataset import generate_dataset
+
+# mode name, PB_ environment for pebbles.gunicorn_config
+MODES = (
+    ('single-sync', dict(PB_GUNICORN_WORKER_CLASS='sync', PB_GUNICORN_WORKERS='1', PB_GUNICORN_PRELOAD_APP='false',
+                         PB_APPLICATION_SESSION_STREAM_ENABLED='false')),
+    ('sync', dict(PB_GUNICORN_WORKER_CLASS='sync', PB_APPLICATION_SESSION_STREAM_ENABLED='false')),
+    ('gthread', dict(PB_GUNICORN_WORKER_CLASS='gthread')),
+    # greenlets are cheap, no need to cap the streams
+    ('gevent', dict(PB_GUNICORN_WORKER_CLASS='gevent', PB_APPLICATION_SESSION_STREAM_MAX_PER_PROCESS='0')),
+)
+
+# how often the clients that got no stream poll the session list, in seconds
+SESSION_POLL_INTERVAL = 2
+
+
+class SlowIdentityProvider(BaseHTTPRequestHandler):
+    """Answers every request with 404 after a delay, the login fails after waiting for it like it would for a slow
+    provider"""
+    delay = 1.0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self.send_response(404)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_auth_config(tmp_dir, idp_url):
+    path = os.path.join(tmp_dir, 'auth-config.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(
+            dict(oauth2=dict(
+                openidConfigurationUrl=idp_url + '/.well-known/openid-configuration',
+                authMethods=[dict(acr='benchmark', idClaim='sub', prefix='benchmark')]
+            )),
+            f
+        )
+    return path
+
+
+def start_server(mode_env, port, database_uri, auth_config_file, log_file):
+    env = dict(
+        os.environ,
+        PB_SQLALCHEMY_DATABASE_URI=database_uri,
+        PB_DATABASE_PASSWORD='',
+        PB_OAUTH2_LOGIN_ENABLED='true',
+        PB_API_AUTH_CONFIG_FILE=auth_config_file,
+        PB_SLOW_REQUEST_LOG_THRESHOLD='0',
+        **mode_env
+    )
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'python:pebbles.gunicorn_config',
+         '--bind', '127.0.0.1:%d' % port, 'pebbles.app:create_app()'],
+        env=env, stdout=log_file, stderr=subprocess.STDOUT
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get('http://127.0.0.1:%d/healthz' % port, timeout=1).status_code == 200:
+                return process
+        except requests.exceptions.RequestException:
+            pass
+        if process.poll() is not None:
+            break
+        time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError('gunicorn did not start, see %s' % log_file.name)
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def login(base_url):
+    resp = requests.post(
+        base_url + '/api/v1/sessions',
+        json=dict(ext_id=ADMIN_EXT_ID, password=ADMIN_PASSWORD, agreement_sign='signed')
+    )
+    resp.raise_for_status()
+    token = base64.b64encode(('%s:' % resp.json()['token']).encode('ascii')).decode('utf-8')
+    return {'Authorization': 'Basic %s' % token, 'Accept': 'application/json'}
+
+
+def run_load(base_url, headers, args):
+    """Run the load for the duration, returns the latencies of successful list requests and the counts of errors, SSO
+    logins, opened streams and stream fallbacks"""
+    latencies = []
+    counts = dict(errors=0, sso_logins=0, streams=0, stream_fallbacks=0)
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+
+    def list_applications():
+        with requests.Session() as session:
+            while time.time() < deadline:
+                start_ts = time.perf_counter()
+                try:
+                    ok = session.get(base_url + '/api/v1/applications', headers=headers, timeout=60).status_code == 200
+                except requests.exceptions.RequestException:
+                    ok = False
+                with lock:
+                    if ok:
+                        latencies.append(time.perf_counter() - start_ts)
+                    else:
+                        counts['errors'] += 1
+
+    def sso_login():
+        sso_headers = {'Authorization': 'Bearer benchmark', 'X-Forwarded-Access-Token': 'benchmark'}
+        with requests.Session() as session:
+            while time.time() < deadline:
+                try:
+                    session.get(base_url + '/oauth2', headers=sso_headers, timeout=60)
+                except requests.exceptions.RequestException:
+                    pass
+                with lock:
+                    counts['sso_logins'] += 1
+
+    def add_count(name):
+        with lock:
+            counts[name] += 1
+
+    def stream_sessions():
+        with requests.Session() as session:
+            while time.time() < deadline:
+                try:
+                    # the server closes the stream at the deadline
+                    with session.get(
+                            base_url + '/api/v1/application_sessions/stream',
+                            params=dict(duration=deadline - time.time()),
+                            headers=headers, stream=True, timeout=60) as resp:
+                        if resp.status_code == 200:
+                            add_count('streams')
+                            for _ in resp.iter_lines():
+                                pass
+                            continue
+                        if resp.status_code != 503:
+                            add_count('errors')
+                            continue
+                        add_count('stream_fallbacks')
+                        poll_until = min(deadline, time.time() + int(resp.headers.get('Retry-After', 60)))
+                    # no stream, poll the session list until it is time to try again
+                    while time.time() < poll_until:
+                        if session.get(base_url + '/api/v1/application_sessions', headers=headers,
+                                       timeout=60).status_code != 200:
+                            add_count('errors')
+                        time.sleep(SESSION_POLL_INTERVAL)
+                except requests.exceptions.RequestException:
+                    add_count('errors')
+
+    def poll_changes():
+        cursor = None
+        with requests.Session() as session:
+            while time.time() < deadline:
+                params = dict(timeout=max(min(25, deadline - time.time()), 0))
+                if cursor is not None:
+                    params['since'] = cursor
+                try:
+                    resp = session.get(base_url + '/api/v1/application_sessions/changes', params=params,
+                                       headers=headers, timeout=60)
+                    resp.raise_for_status()
+                    cursor = resp.json()['cursor']
+                    # sessions that are due end the long-poll right away, the workers then wait for their next round
+                    if resp.json()['due']:
+                        time.sleep(1)
+                except requests.exceptions.RequestException:
+                    add_count('errors')
+
+    threads = [threading.Thread(target=list_applications) for _ in range(args.clients)]
+    threads += [threading.Thread(target=sso_login) for _ in range(args.sso_clients)]
+    threads += [threading.Thread(target=stream_sessions) for _ in range(args.stream_clients)]
+    threads += [threading.Thread(target=poll_changes) for _ in range(args.poll_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, counts
+
+
+def print_results(results):
+    print()
+    print('%-12s %10s %10s %10s %10s %8s %6s %8s %9s' % (
+        'mode', 'req/s', 'p50 ms', 'p95 ms', 'max ms', 'errors', 'sso', 'streams', 'fallback'))
+    for name, duration, latencies, counts in results:
+        if not latencies:
+            print('%-12s %10s' % (name, 'no successful requests'))
+            continue
+        print('%-12s %10.1f %10.1f %10.1f %10.1f %8d %6d %8d %9d' % (
+            name,
+            len(latencies) / duration,
+            statistics.median(latencies) * 1000,
+            percentile(latencies, 95) * 1000,
+            max(latencies) * 1000,
+            counts['errors'],
+            counts['sso_logins'],
+            counts['streams'],
+            counts['stream_fallbacks'],
+        ))
+
+
+def run(args):
+    tmp_dir = tempfile.mkdtemp(prefix='pebbles-gunicorn-load-')
+    config = BenchmarkConfig()
+    if 'PEBBLES_BENCHMARK_DATABASE_URI' not in os.environ:
+        # the server processes need a database they can share
+        config.SQLALCHEMY_DATABASE_URI = 'sqlite:///%s/pebbles.db' % tmp_dir
+    app = create_benchmark_app(config)
+
+    SlowIdentityProvider.delay = args.idp_delay
+    idp = ThreadingHTTPServer(('127.0.0.1', 0), SlowIdentityProvider)
+    threading.Thread(target=idp.serve_forever, name='idp', daemon=True).start()
+
+    results = []
+    try:
+        with app.app_context():
+            generate_dataset(num_users=100, num_workspaces=10, sessions_per_user=1, num_alerts=0, num_locks=0)
+        auth_config_file = write_auth_config(tmp_dir, 'http://127.0.0.1:%d' % idp.server_port)
+
+        for name, mode_env in MODES:
+            if args.modes and name not in args.modes:
+                continue
+            if name == 'gevent' and not (importlib.util.find_spec('gevent') and importlib.util.find_spec('psycogreen')):
+                print('%s: skipped, gevent and psycogreen are not installed' % name)
+                continue
+            port = free_port()
+            with open(os.path.join(tmp_dir, 'gunicorn-%s.log' % name), 'w') as log_file:
+                process = start_server(mode_env, port, config.SQLALCHEMY_DATABASE_URI, auth_config_file, log_file)
+                try:
+                    base_url = 'http://127.0.0.1:%d' % port
+                    headers = login(base_url)
+                    start_ts = time.time()
+                    latencies, counts = run_load(base_url, headers, args)
+                    results.append((name, time.time() - start_ts, latencies, counts))
+                    print('%s: %d requests' % (name, len(latencies)))
+                finally:
+                    stop_server(process)
+    finally:
+        idp.shutdown()
+        drop_benchmark_app(app)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print_results(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='*', choices=[name for name, _ in MODES])
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds of load per mode')
+    parser.add_argument('--clients', type=int, default=16, help='clients listing applications')
+    parser.add_argument('--sso-clients', type=int, default=4, help='clients logging in through SSO')
+    parser.add_argument('--stream-clients', type=int, default=8, help='clients keeping a session event stream open')
+    parser.add_argument('--poll-clients', type=int, default=2, help='clients long-polling session changes')
+    parser.add_argument('--idp-delay', type=float, default=2.0, help='identity provider response time in seconds')
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Import time benchmark.
+
+Imports each module in a fresh interpreter with 'python -X importtime' and reports the median total import time over
+the rounds and the modules with the highest cumulative import time. The worker should stay free of the ORM, Flask and
+the Kubernetes client until a cluster needs a driver, check the heaviest modules when the numbers go up.
+
+  python -m benchmarks.import_time --rounds 5 --top 15 pebbles.worker.main pebbles.app
+"""
+import argparse
+import collections
+import re
+import statistics
+import subprocess
+import sys
+
+DEFAULT_MODULES = ('pebbles.worker.main', 'pebbles.app')
+
+# import time:     self [us] | cumulative | imported package
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)$')
+
+
+def measure_import(module):
+    """Import the module in a new interpreter, returns cumulative import times in microseconds by module name.
+    With module None, returns the modules imported at interpreter startup."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module if module else 'pass'],
+        capture_output=True, text=True, check=True
+    )
+    cumulative_times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            cumulative_times[match.group(3)] = int(match.group(2))
+    return cumulative_times
+
+
+def run_benchmark(modules, rounds, top):
+    # site and friends are imported at startup regardless of the module, leave them out
+    startup_modules = set(measure_import(None))
+    for module in modules:
+        samples = collections.defaultdict(list)
+        for _ in range(rounds):
+            for name, cumulative_time in measure_import(module).items():
+                if name not in startup_modules:
+                    samples[name].append(cumulative_time)
+        medians = {name: statistics.median(times) for name, times in samples.items()}
+
+        print('%s: %.1f ms (median of %d rounds, %d modules)' % (module, medians[module] / 1000, rounds, len(medians)))
+        heaviest = sorted((name for name in medians if name != module), key=lambda n: medians[n], reverse=True)
+        for name in heaviest[:top]:
+            print('  %8.1f ms  %s' % (medians[name] / 1000, name))
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+    run_benchmark(args.modules, args.rounds, args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Task throughput benchmark.
+
+Simulates workers draining a queue of volume backup tasks through the claim/release API. Each simulated Job needs a
+number of status checks before it finishes. Release delays are set to zero, so that the benchmark measures the API
+and the database rather than the check interval.
+
+  python -m benchmarks.task_throughput --tasks 500 --clusters 2 --workers 4
+"""
+import argparse
+import time
+
+from benchmarks.common import ApiClient, create_benchmark_app, drop_benchmark_app
+from pebbles.models import db, Task
+
+
+def seed_tasks(app, num_tasks, num_clusters):
+    with app.app_context():
+        db.session.add_all(
+            Task(
+                Task.KIND_WORKSPACE_VOLUME_BACKUP,
+                Task.STATE_NEW,
+                dict(workspace_id='ws-%d' % (i % 10), type='user-data', pseudonym='p%d' % i,
+                     cluster='cluster-%d' % (i % num_clusters)),
+                priority=Task.PRIORITY_HIGH if i % 100 == 0 else Task.PRIORITY_DEFAULT,
+            )
+            for i in range(num_tasks)
+        )
+        db.session.commit()
+
+
+def run(num_tasks, num_clusters, num_workers, batch_size, checks_per_job, max_jobs_per_cluster):
+    app = create_benchmark_app()
+    app.config['TASK_MAX_JOBS_PER_CLUSTER'] = max_jobs_per_cluster
+    try:
+        seed_tasks(app, num_tasks, num_clusters)
+        workers = [('worker-%d' % i, ApiClient(app)) for i in range(num_workers)]
+        checks = {}
+        num_claims = 0
+        max_concurrent_jobs = 0
+        num_finished = 0
+
+        start_ts = time.time()
+        while num_finished < num_tasks:
+            claimed_in_round = 0
+            for worker_id, client in workers:
+                tasks = client.post('tasks/claim', dict(worker_id=worker_id, limit=batch_size))
+                num_claims += 1
+                claimed_in_round += len(tasks)
+                for task in tasks:
+                    if task['state'] == Task.STATE_NEW:
+                        # start the Job
+                        client.patch('tasks/%s' % task['id'], dict(state=Task.STATE_PROCESSING))
+                        client.post('tasks/%s/release' % task['id'], dict(worker_id=worker_id, delay=0))
+                        checks[task['id']] = 0
+                    else:
+                        checks[task['id']] += 1
+                        if checks[task['id']] >= checks_per_job:
+                            client.patch('tasks/%s' % task['id'], dict(state=Task.STATE_FINISHED))
+                            num_finished += 1
+                        else:
+                            client.post('tasks/%s/release' % task['id'], dict(worker_id=worker_id, delay=0))
+                max_concurrent_jobs = max(max_concurrent_jobs, len(checks) - num_finished)
+            if not claimed_in_round:
+                raise RuntimeError('no progress, %d tasks finished' % num_finished)
+        elapsed = time.time() - start_ts
+
+        num_requests = sum(client.num_requests for _, client in workers)
+        print('tasks:                   %d' % num_tasks)
+        print('workers:                 %d' % num_workers)
+        print('claims:                  %d' % num_claims)
+        print('api requests:            %d' % num_requests)
+        print('max concurrent jobs:     %d (limit %d per cluster)' % (max_concurrent_jobs, max_jobs_per_cluster))
+        print('elapsed:                 %.2f s' % elapsed)
+        print('throughput:              %.1f tasks/s, %.1f requests/s' % (
+            num_tasks / elapsed, num_requests / elapsed))
+    finally:
+        drop_benchmark_app(app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=500)
+    parser.add_argument('--clusters', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=20)
+    parser.add_argument('--checks-per-job', type=int, default=3)
+    parser.add_argument('--max-jobs-per-cluster', type=int, default=10)
+    args = parser.parse_args()
+    run(args.tasks, args.clusters, args.workers, args.batch_size, args.checks_per_job, args.max_jobs_per_cluster)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Worker provisioning throughput benchmark.
+
+Serves the API on a local port, starts N workers from pebbles.worker.main against it and provisions sessions on
+clusters simulated by SimulatedKubernetesDriver. Reports the provisioning throughput and the time from session
+creation to RUNNING.
+
+The simulated cluster state lives in the process, so the workers run as threads in the benchmark process. By default
+the database is a temporary SQLite file, set PEBBLES_BENCHMARK_DATABASE_URI for PostgreSQL.
+
+  python -m benchmarks.worker_throughput --sessions 200 --workers 4 --pod-startup-time 5 --image-pull-time 20
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+import sqlalchemy as sa
+import yaml
+from werkzeug.serving import make_server
+
+from benchmarks.common import ApiClient, BenchmarkConfig, create_benchmark_app, drop_benchmark_app
+from benchmarks.dataset import generate_dataset
+from benchmarks.api_benchmark import percentile
+from pebbles.config import BaseConfig
+from pebbles.drivers.provisioning.simulated_kubernetes_driver import get_simulated_cluster
+from pebbles.models import db, Application, ApplicationSession
+from pebbles.views.commons import create_worker
+from pebbles.worker.main import Worker
+
+APPLICATIONS_PER_WORKSPACE = 10
+
+
+def write_cluster_config(tmp_dir, num_clusters, args):
+    clusters = [
+        dict(
+            name='simulated-%d' % i,
+            driver='SimulatedKubernetesDriver',
+            simulatedApiLatency=args.api_latency,
+            simulatedApiFailureRate=args.api_failure_rate,
+            simulatedPodStartupTime=args.pod_startup_time,
+            simulatedImagePullTime=args.image_pull_time,
+            simulatedPodFailureRate=args.pod_failure_rate,
+        )
+        for i in range(num_clusters)
+    ]
+    cluster_config_file = os.path.join(tmp_dir, 'cluster-config.yaml')
+    with open(cluster_config_file, 'w') as f:
+        yaml.safe_dump(dict(clusters=clusters), f)
+    cluster_passwords_file = os.path.join(tmp_dir, 'cluster-passwords.yaml')
+    with open(cluster_passwords_file, 'w') as f:
+        yaml.safe_dump({}, f)
+    return [c['name'] for c in clusters], cluster_config_file, cluster_passwords_file
+
+
+def count_states(app, session_ids):
+    with app.app_context():
+        rows = db.session.execute(
+            sa.select(ApplicationSession._state, sa.func.count())
+            .where(ApplicationSession.id.in_(session_ids))
+            .group_by(ApplicationSession._state)
+        ).all()
+    return dict(rows)
+
+
+def run(args):
+    tmp_dir = tempfile.mkdtemp(prefix='pebbles-worker-benchmark-')
+    config = BenchmarkConfig()
+    if 'PEBBLES_BENCHMARK_DATABASE_URI' not in os.environ:
+        # in-memory SQLite cannot be shared by the API threads
+        config.SQLALCHEMY_DATABASE_URI = 'sqlite:///%s/pebbles.db' % tmp_dir
+    app = create_benchmark_app(config)
+    cluster_names, cluster_config_file, cluster_passwords_file = write_cluster_config(tmp_dir, args.clusters, args)
+
+    server = None
+    workers = []
+    try:
+        with app.app_context():
+            create_worker()
+            # one application per session, the admin can have one session per application
+            generate_dataset(
+                num_users=10,
+                num_workspaces=math.ceil(args.sessions / APPLICATIONS_PER_WORKSPACE),
+                members_per_workspace=2,
+                applications_per_workspace=APPLICATIONS_PER_WORKSPACE,
+                sessions_per_user=0,
+                num_alerts=0,
+                num_locks=0,
+                clusters=cluster_names,
+            )
+            application_ids = db.session.scalars(sa.select(Application.id).order_by(Application.name)).all()
+
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, name='api', daemon=True).start()
+
+        worker_config = BaseConfig()
+        worker_config.INTERNAL_API_BASE_URL = 'http://127.0.0.1:%d/api/v1' % server.server_port
+        worker_config.SECRET_KEY = app.config['SECRET_KEY']
+        worker_config.CLUSTER_CONFIG_FILE = cluster_config_file
+        worker_config.CLUSTER_PASSWORDS_FILE = cluster_passwords_file
+        worker_config.WORKER_RUNTIME = args.runtime
+        # the workers share the process and its metrics, there is nothing to serve per worker
+        worker_config.WORKER_METRICS_PORT = 0
+        for i in range(args.workers):
+            os.environ['WORKER_ID'] = 'benchmark-worker-%d' % i
+            if args.runtime == 'async':
+                from pebbles.worker.async_worker import AsyncWorker
+                workers.append(AsyncWorker(worker_config))
+            else:
+                workers.append(Worker(worker_config))
+        os.environ.pop('WORKER_ID')
+        for worker in workers:
+            # AsyncWorker.run() resets the alarm signal handler, which only works in the main thread
+            target = worker.run if args.runtime == 'sync' else lambda w=worker: asyncio.run(w.run_controllers())
+            threading.Thread(target=target, name=worker.id, daemon=True).start()
+
+        # let the workers find each other before the load starts
+        time.sleep(args.warmup)
+
+        client = ApiClient(app)
+        start_ts = time.time()
+        session_ids = [
+            client.post('application_sessions', dict(application_id=application_id))['id']
+            for application_id in application_ids[:args.sessions]
+        ]
+        create_time = time.time() - start_ts
+        logging.info('created %d sessions in %.2f s', len(session_ids), create_time)
+
+        simulated_clusters = [get_simulated_cluster(dict(name=name)) for name in cluster_names]
+        while time.time() - start_ts < args.timeout:
+            states = count_states(app, session_ids)
+            done = states.get(ApplicationSession.STATE_RUNNING, 0) + states.get(ApplicationSession.STATE_FAILED, 0)
+            # sessions with a failed pod would only fail after the startup time limit
+            stuck = sum(c.num_pods_failed for c in simulated_clusters)
+            if done + stuck >= len(session_ids):
+                break
+            time.sleep(0.5)
+        else:
+            logging.warning('timeout, states: %s', states)
+
+        with app.app_context():
+            rows = db.session.execute(
+                sa.select(ApplicationSession.created_at, ApplicationSession.provisioned_at)
+                .where(ApplicationSession.id.in_(session_ids))
+                .where(ApplicationSession.provisioned_at.is_not(None))
+            ).all()
+        times_to_running = [(provisioned_at - created_at).total_seconds() for created_at, provisioned_at in rows]
+        if rows:
+            first_created = min(row.created_at for row in rows)
+            last_provisioned = max(row.provisioned_at for row in rows)
+            elapsed = (last_provisioned - first_created).total_seconds()
+        else:
+            elapsed = 0
+
+        print('workers:                 %d (%s)' % (args.workers, args.runtime))
+        print('sessions:                %d' % len(session_ids))
+        print('final states:            %s' % ', '.join('%s %d' % s for s in sorted(states.items())))
+        print('session creation:        %.2f s' % create_time)
+        print('simulated api calls:     %d' % sum(c.num_api_calls for c in simulated_clusters))
+        print('simulated failed pods:   %d' % sum(c.num_pods_failed for c in simulated_clusters))
+        if times_to_running:
+            print('throughput:              %.2f sessions/s' % (len(times_to_running) / elapsed if elapsed else 0))
+            print('time to RUNNING:         p50 %.1f s, p90 %.1f s, p99 %.1f s, max %.1f s, mean %.1f s' % (
+                percentile(times_to_running, 50),
+                percentile(times_to_running, 90),
+                percentile(times_to_running, 99),
+                max(times_to_running),
+                statistics.mean(times_to_running),
+            ))
+        phase_durations = client.get('application_sessions/phase_durations?start_ts=%d&end_ts=%d' % (
+            start_ts - 60, time.time() + 60))
+        for group in phase_durations['groups']:
+            for phase, stats in group['phases'].items():
+                print('%-24s p50 %.1f s, p95 %.1f s, p99 %.1f s (%s)' % (
+                    phase + ':', stats['p50'], stats['p95'], stats['p99'], group['key']))
+    finally:
+        for worker in workers:
+            worker.terminate = True
+        if workers:
+            # give the workers a moment to remove their heartbeats
+            time.sleep(2)
+        if server:
+            server.shutdown()
+        drop_benchmark_app(app)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--runtime', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--clusters', type=int, default=1)
+    parser.add_argument('--api-latency', type=float, default=0.01, help='simulated K8s API latency in seconds')
+    parser.add_argument('--api-failure-rate', type=float, default=0.0)
+    parser.add_argument('--pod-startup-time', type=float, default=5.0)
+    parser.add_argument('--image-pull-time', type=float, default=20.0)
+    parser.add_argument('--pod-failure-rate', type=float, default=0.0)
+    parser.add_argument('--warmup', type=float, default=3.0, help='seconds to wait for the workers to start')
+    parser.add_argument('--timeout', type=float, default=600.0, help='give up after this many seconds')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+    # the API is served by werkzeug, which would log every request
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
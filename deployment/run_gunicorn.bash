@@ -4,5 +4,8 @@
 # script to be able to redirect the access logs to a file instead of stdout.
 # This is required for central logging.
 
+# Worker class, worker count, preloading and timeouts are set in pebbles/gunicorn_config.py, see the GUNICORN_*
+# variables in pebbles/config.py for tuning them with PB_ environment variables.
+
 # Become the gunicorn process for executing as pid 1 for cleaner processes and better signal handling
-exec gunicorn --bind=0.0.0.0:8080 ${APP_MODULE}
+exec gunicorn --config python:pebbles.gunicorn_config ${APP_MODULE}
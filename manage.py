@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import getpass
+import json
 import logging
 import os
 import random
@@ -9,6 +10,7 @@ import time
 from typing import List
 
 import click
+import sqlalchemy as sa
 import yaml
 from flask.cli import FlaskGroup
 from sqlalchemy.exc import IntegrityError
@@ -16,8 +18,7 @@ from sqlalchemy.exc import IntegrityError
 import pebbles.views.commons
 from pebbles.app import create_app, db
 from pebbles.config import RuntimeConfig
-from pebbles.models import User, Application, ApplicationTemplate, load_yaml
-from pebbles.utils import create_password
+from pebbles.models import User, Application, ApplicationTemplate, load_yaml, upsert_objects
 
 # ensure UNITTEST environment before importing app
 if {'test', 'coverage'}.intersection(set(sys.argv)):
@@ -103,18 +104,21 @@ def createuser_bulk(user_prefix=None, domain_name=None, count=0, lifetime_in_day
 
     expiry_ts = time.time() + 3600 * 24 * lifetime_in_days if lifetime_in_days else None
 
-    for i in range(count):
-        for retry in range(5):
-            # eg: demo_user_Rgv4@example.com
-            ext_id = user_prefix + "_" + ''.join(
-                random.choice(string.ascii_lowercase + string.digits) for _ in range(3)) + "@" + domain_name
-
-            password = create_password(8)
-
-            a = pebbles.views.commons.create_user(ext_id, password, expiry_ts=expiry_ts)
-            if a:
-                print('Username: %s\t Password: %s' % (ext_id, password))
-                break
+    # random account names can collide with existing ones, generate more for the ones that were skipped
+    num_missing = count
+    for retry in range(5):
+        # eg: demo_user_Rgv4@example.com
+        user_data = [
+            dict(ext_id=user_prefix + "_" + ''.join(
+                random.choice(string.ascii_lowercase + string.digits) for _ in range(3)) + "@" + domain_name)
+            for _ in range(num_missing)
+        ]
+        created, _ = pebbles.views.commons.create_users_bulk(user_data, expiry_ts=expiry_ts)
+        for user in created:
+            print('Username: %s\t Password: %s' % (user['ext_id'], user['password']))
+        num_missing -= len(created)
+        if not num_missing:
+            break
 
     print("\n")
 
@@ -135,8 +139,33 @@ def createuser_list_samepwd(ext_id_string=None, password=None, lifetime_in_days=
 
     ext_id_list = [x for x in ext_id_string.split(',')]
     print("List of users to create %s " % ext_id_list)
-    for ext_id in ext_id_list:
-        pebbles.views.commons.create_user(ext_id, password, expiry_ts=expiry_ts)
+    pebbles.views.commons.create_users_bulk(
+        [dict(ext_id=ext_id, password=password) for ext_id in ext_id_list], expiry_ts=expiry_ts)
+
+
+@cli.command('createuser_import')
+@click.argument('file')
+@click.option('-l', 'lifetime_in_days', default=0, help='lifetime in days (default no limit)')
+@click.option('-w', 'max_workers', default=0, help='processes for hashing passwords (default number of CPUs)')
+def createuser_import(file, lifetime_in_days=0, max_workers=0):
+    """
+    Creates users from a CSV or JSON file. CSV needs a header row with ext_id and optionally password and email_id
+    columns, JSON is a list of objects with the same keys. Prints the generated passwords for users without one.
+    """
+    data_format = 'json' if file.endswith('.json') else 'csv'
+    with open(file, 'r') as f:
+        user_data = pebbles.views.commons.parse_user_import(f.read(), data_format)
+
+    expiry_ts = time.time() + 3600 * 24 * lifetime_in_days if lifetime_in_days else None
+    created, skipped = pebbles.views.commons.create_users_bulk(
+        user_data, expiry_ts=expiry_ts, max_workers=max_workers or None)
+
+    for ext_id in skipped:
+        print('Skipped existing user %s' % ext_id)
+    for user in created:
+        if user.get('password'):
+            print('Username: %s\t Password: %s' % (user['ext_id'], user['password']))
+    print('Created %d users, skipped %d existing' % (len(created), len(skipped)))
 
 
 @cli.command('deleteuser_bulk')
@@ -168,12 +197,20 @@ def createworker():
 @cli.command('load_data')
 @click.argument('file')
 @click.option('-u', 'update', is_flag=True, help='update existing entries')
-def load_data(file, update=False):
+@click.option('--bulk', is_flag=True, help='load all entries with batched upserts in one transaction')
+def load_data(file, update=False, bulk=False):
     """
     Loads an annotated YAML file into database. Use -u/--update to update existing entries instead of skipping.
     """
     with open(file, 'r') as f:
         data = load_yaml(f)
+        if bulk:
+            counts = upsert_objects(data['data'], update=update)
+            db.session.commit()
+            logging.info('inserted %d, updated %d, skipped %d entries' % (
+                counts['inserted'], counts['updated'], counts['skipped']))
+            return
+
         for obj in data['data']:
             try:
                 db.session.add(obj)
@@ -243,7 +280,7 @@ def check_data(datadir):
             exit(1)
 
         # check that we have copied the attributes from the template correctly
-        if yaml.safe_dump(application.base_config) != yaml.safe_dump(template.base_config):
+        if yaml.safe_dump(dict(application.base_config)) != yaml.safe_dump(template.base_config):
             logging.error('ERROR: application "%s" base_config differs from template' % application.name)
             exit(1)
         if application.application_type != template.application_type:
@@ -257,6 +294,53 @@ def check_data(datadir):
                  len(template_data))
 
 
+@cli.command('check_json_columns')
+@click.option('--fix', is_flag=True, help='set invalid values to NULL')
+def check_json_columns(fix=False):
+    """
+    Checks that the JSON columns in the database contain valid JSON. Run this before migrating the columns
+    to jsonb, the conversion fails on invalid values. Use --fix to set invalid values to NULL.
+    """
+    json_columns = (
+        ('applications', 'config'),
+        ('applications', 'base_config'),
+        ('applications', 'labels'),
+        ('workspaces', 'config'),
+        ('application_sessions', 'provisioning_config'),
+        ('application_sessions', 'session_data'),
+        ('tasks', 'data'),
+        ('alerts', 'data'),
+    )
+    num_invalid = 0
+    for table, column in json_columns:
+        # cast to text so that this works both before and after the conversion
+        rows = db.session.execute(sa.text(
+            'SELECT id, CAST(%s AS TEXT) FROM %s WHERE %s IS NOT NULL' % (column, table, column)
+        ))
+        invalid_ids = []
+        for row_id, value in rows:
+            try:
+                json.loads(value)
+            except ValueError:
+                invalid_ids.append(row_id)
+        for row_id in invalid_ids:
+            logging.warning('invalid JSON in %s.%s, id %s', table, column, row_id)
+        num_invalid += len(invalid_ids)
+
+        if fix and invalid_ids:
+            db.session.execute(
+                sa.text('UPDATE %s SET %s = NULL WHERE id IN :ids' % (table, column))
+                .bindparams(sa.bindparam('ids', expanding=True)),
+                dict(ids=invalid_ids)
+            )
+            db.session.commit()
+            logging.info('set %d invalid values in %s.%s to NULL', len(invalid_ids), table, column)
+
+    logging.info('checked %d JSON columns, %d invalid values found', len(json_columns), num_invalid)
+    if num_invalid and not fix:
+        exit(1)
+
+
 @cli.command('list_application_images')
 def list_application_images():
     """
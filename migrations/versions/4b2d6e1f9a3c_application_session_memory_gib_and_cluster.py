@@ -0,0 +1,33 @@
+"""application session memory_gib and cluster
+
+Revision ID: 4b2d6e1f9a3c
+Revises: b86c5da50575
+Create Date: 2024-01-15 10:12:41.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b2d6e1f9a3c'
+down_revision = 'b86c5da50575'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('application_sessions', sa.Column('memory_gib', sa.Float))
+    op.add_column('application_sessions', sa.Column('cluster', sa.String(64)))
+
+    # populate the new columns from provisioning_config
+    op.execute('''
+      UPDATE application_sessions
+         SET memory_gib=cast(provisioning_config::jsonb->>'memory_gib' as double precision),
+             cluster=provisioning_config::jsonb->>'cluster'
+       WHERE provisioning_config IS NOT NULL
+         AND provisioning_config <> ''
+    ''')
+
+
+def downgrade():
+    op.drop_column('application_sessions', 'cluster')
+    op.drop_column('application_sessions', 'memory_gib')
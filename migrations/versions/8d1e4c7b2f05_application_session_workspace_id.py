@@ -0,0 +1,45 @@
+"""application session workspace_id and quota indexes
+
+Revision ID: 8d1e4c7b2f05
+Revises: 4b2d6e1f9a3c
+Create Date: 2024-01-17 14:03:22.581936
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d1e4c7b2f05'
+down_revision = '4b2d6e1f9a3c'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('application_sessions', sa.Column('workspace_id', sa.String(length=32), nullable=True))
+    op.create_foreign_key(
+        op.f('fk_application_sessions_workspace_id_workspaces'),
+        'application_sessions', 'workspaces', ['workspace_id'], ['id']
+    )
+
+    # populate workspace_id from the application
+    op.execute('''
+      UPDATE application_sessions
+         SET workspace_id=applications.workspace_id
+        FROM applications
+       WHERE application_sessions.application_id=applications.id
+    ''')
+
+    op.create_index(op.f('ix_application_sessions_workspace_id'), 'application_sessions', ['workspace_id'],
+                    unique=False)
+    op.create_index(op.f('ix_application_sessions_cluster'), 'application_sessions', ['cluster'], unique=False)
+    op.create_index('ix_application_sessions_workspace_id_state_memory_gib', 'application_sessions',
+                    ['workspace_id', 'state', 'memory_gib'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_application_sessions_workspace_id_state_memory_gib', table_name='application_sessions')
+    op.drop_index(op.f('ix_application_sessions_cluster'), table_name='application_sessions')
+    op.drop_index(op.f('ix_application_sessions_workspace_id'), table_name='application_sessions')
+    op.drop_constraint(op.f('fk_application_sessions_workspace_id_workspaces'), 'application_sessions',
+                       type_='foreignkey')
+    op.drop_column('application_sessions', 'workspace_id')
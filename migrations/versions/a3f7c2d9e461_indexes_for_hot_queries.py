@@ -0,0 +1,37 @@
+"""indexes for hot queries
+
+Revision ID: a3f7c2d9e461
+Revises: 8d1e4c7b2f05
+Create Date: 2024-01-22 09:41:07.120344
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a3f7c2d9e461'
+down_revision = '8d1e4c7b2f05'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index(op.f('ix_application_sessions_user_id'), 'application_sessions', ['user_id'], unique=False)
+    op.create_index(op.f('ix_application_sessions_application_id'), 'application_sessions', ['application_id'],
+                    unique=False)
+    op.create_index('ix_application_sessions_live_state_to_be_deleted', 'application_sessions',
+                    ['state', 'to_be_deleted'], unique=False, postgresql_where=sa.text("state != 'deleted'"))
+    op.create_index(op.f('ix_workspace_memberships_user_id'), 'workspace_memberships', ['user_id'], unique=False)
+    op.create_index('ix_tasks_state_kind', 'tasks', ['state', 'kind'], unique=False)
+    op.create_index('ix_tasks_unfinished_kind_create_ts', 'tasks', ['kind', 'create_ts'], unique=False,
+                    postgresql_where=sa.text("state IN ('new', 'processing')"))
+    op.create_index('ix_alerts_target_source_status', 'alerts', ['target', 'source', 'status'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_alerts_target_source_status', table_name='alerts')
+    op.drop_index('ix_tasks_unfinished_kind_create_ts', table_name='tasks')
+    op.drop_index('ix_tasks_state_kind', table_name='tasks')
+    op.drop_index(op.f('ix_workspace_memberships_user_id'), table_name='workspace_memberships')
+    op.drop_index('ix_application_sessions_live_state_to_be_deleted', table_name='application_sessions')
+    op.drop_index(op.f('ix_application_sessions_application_id'), table_name='application_sessions')
+    op.drop_index(op.f('ix_application_sessions_user_id'), table_name='application_sessions')
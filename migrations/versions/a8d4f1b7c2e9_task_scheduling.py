@@ -0,0 +1,43 @@
+"""task scheduling
+
+Revision ID: a8d4f1b7c2e9
+Revises: f2c8a5e7d3b6
+Create Date: 2024-02-12 10:17:45.381920
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a8d4f1b7c2e9'
+down_revision = 'f2c8a5e7d3b6'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column('priority', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('tasks', sa.Column('attempts', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('tasks', sa.Column('next_attempt_at', sa.DateTime(), nullable=True))
+    op.add_column('tasks', sa.Column('lease_owner', sa.String(length=64), nullable=True))
+    op.add_column('tasks', sa.Column('lease_expires_at', sa.DateTime(), nullable=True))
+    op.add_column('tasks', sa.Column('cluster', sa.String(length=64), nullable=True))
+
+    # populate cluster from data, see Task.data setter
+    op.execute('''
+      UPDATE tasks
+         SET cluster=COALESCE(data ->> 'cluster', data ->> 'tgt_cluster')
+       WHERE jsonb_typeof(data) = 'object'
+    ''')
+
+    op.create_index('ix_tasks_unfinished_priority_create_ts', 'tasks', ['priority', 'create_ts'], unique=False,
+                    postgresql_where=sa.text("state IN ('new', 'processing')"))
+
+
+def downgrade():
+    op.drop_index('ix_tasks_unfinished_priority_create_ts', table_name='tasks')
+    op.drop_column('tasks', 'cluster')
+    op.drop_column('tasks', 'lease_expires_at')
+    op.drop_column('tasks', 'lease_owner')
+    op.drop_column('tasks', 'next_attempt_at')
+    op.drop_column('tasks', 'attempts')
+    op.drop_column('tasks', 'priority')
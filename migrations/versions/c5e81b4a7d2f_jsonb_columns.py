@@ -0,0 +1,50 @@
+"""convert json text columns to jsonb
+
+Revision ID: c5e81b4a7d2f
+Revises: a3f7c2d9e461
+Create Date: 2024-01-29 13:27:55.410672
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c5e81b4a7d2f'
+down_revision = 'a3f7c2d9e461'
+
+from alembic import op
+
+# Run 'python manage.py check_json_columns' before upgrading, conversion fails if a column contains invalid JSON
+JSON_COLUMNS = (
+    ('applications', 'config'),
+    ('applications', 'base_config'),
+    ('applications', 'labels'),
+    ('workspaces', 'config'),
+    ('application_sessions', 'provisioning_config'),
+    ('application_sessions', 'session_data'),
+    ('tasks', 'data'),
+    ('alerts', 'data'),
+)
+
+
+def upgrade():
+    for table, column in JSON_COLUMNS:
+        # empty strings and JSON nulls become SQL NULLs
+        op.execute('''
+          ALTER TABLE %(table)s
+          ALTER COLUMN %(column)s TYPE jsonb
+          USING CASE WHEN %(column)s IN ('', 'null') THEN NULL ELSE %(column)s::jsonb END
+        ''' % dict(table=table, column=column))
+
+    op.execute("CREATE INDEX ix_tasks_data_workspace_id ON tasks ((data ->> 'workspace_id'))")
+    op.execute('CREATE INDEX ix_applications_labels ON applications USING gin (labels jsonb_path_ops)')
+
+
+def downgrade():
+    op.drop_index('ix_applications_labels', table_name='applications')
+    op.drop_index('ix_tasks_data_workspace_id', table_name='tasks')
+
+    for table, column in JSON_COLUMNS:
+        op.execute('''
+          ALTER TABLE %(table)s
+          ALTER COLUMN %(column)s TYPE text
+          USING %(column)s::text
+        ''' % dict(table=table, column=column))
@@ -0,0 +1,23 @@
+"""application session transition ledger
+
+Revision ID: d3e9b6a2f4c1
+Revises: a8d4f1b7c2e9
+Create Date: 2024-02-26 13:42:08.116204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd3e9b6a2f4c1'
+down_revision = 'a8d4f1b7c2e9'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.add_column('application_sessions', sa.Column('transitions', postgresql.JSONB(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('application_sessions', 'transitions')
@@ -0,0 +1,50 @@
+"""application session work queue
+
+Revision ID: d7a2e9f4b1c8
+Revises: c5e81b4a7d2f
+Create Date: 2024-02-05 11:52:13.904157
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd7a2e9f4b1c8'
+down_revision = 'c5e81b4a7d2f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('application_sessions', sa.Column('next_action_at', sa.DateTime(), nullable=True))
+    op.add_column('application_sessions', sa.Column('backoff_count', sa.Integer(), nullable=True))
+
+    # schedule the existing live sessions, see ApplicationSession.schedule_next_action()
+    op.execute('''
+      UPDATE application_sessions
+         SET backoff_count=0,
+             next_action_at=(now() at time zone 'utc')
+       WHERE state != 'deleted'
+         AND (to_be_deleted
+              OR state IN ('queueing', 'starting')
+              OR (state = 'running' AND log_fetch_pending))
+    ''')
+    op.execute('''
+      UPDATE application_sessions
+         SET backoff_count=0,
+             next_action_at=application_sessions.provisioned_at + applications.maximum_lifetime * interval '1 second'
+        FROM applications
+       WHERE application_sessions.application_id=applications.id
+         AND application_sessions.state = 'running'
+         AND application_sessions.next_action_at IS NULL
+         AND application_sessions.provisioned_at IS NOT NULL
+         AND applications.maximum_lifetime > 0
+    ''')
+
+    op.create_index(op.f('ix_application_sessions_next_action_at'), 'application_sessions', ['next_action_at'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_application_sessions_next_action_at'), table_name='application_sessions')
+    op.drop_column('application_sessions', 'backoff_count')
+    op.drop_column('application_sessions', 'next_action_at')
@@ -0,0 +1,29 @@
+"""worker heartbeats
+
+Revision ID: e3b9d4c6a1f7
+Revises: d7a2e9f4b1c8
+Create Date: 2024-02-07 09:41:37.218650
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e3b9d4c6a1f7'
+down_revision = 'd7a2e9f4b1c8'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'worker_heartbeats',
+        sa.Column('id', sa.String(length=64), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_worker_heartbeats'))
+    )
+    op.create_index(op.f('ix_worker_heartbeats_updated_at'), 'worker_heartbeats', ['updated_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_worker_heartbeats_updated_at'), table_name='worker_heartbeats')
+    op.drop_table('worker_heartbeats')
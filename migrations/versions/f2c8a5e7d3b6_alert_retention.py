@@ -0,0 +1,35 @@
+"""alert retention
+
+Revision ID: f2c8a5e7d3b6
+Revises: e3b9d4c6a1f7
+Create Date: 2024-02-09 14:03:22.671904
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f2c8a5e7d3b6'
+down_revision = 'e3b9d4c6a1f7'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'alert_history',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('target', sa.String(length=64), nullable=False),
+        sa.Column('source', sa.String(length=64), nullable=False),
+        sa.Column('name', sa.String(length=256), nullable=False),
+        sa.Column('num_alerts', sa.Integer(), nullable=False),
+        sa.Column('first_seen_ts', sa.DateTime(), nullable=True),
+        sa.Column('last_seen_ts', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('day', 'target', 'source', 'name', name=op.f('pk_alert_history'))
+    )
+    op.create_index('ix_alerts_active_status_last_seen_ts', 'alerts', ['status', 'last_seen_ts'], unique=False,
+                    postgresql_where=sa.text("status IN ('firing', 'ok')"))
+
+
+def downgrade():
+    op.drop_index('ix_alerts_active_status_last_seen_ts', table_name='alerts')
+    op.drop_table('alert_history')
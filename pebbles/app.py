@@ -8,6 +8,8 @@ from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 
 from pebbles.config import TestConfig, RuntimeConfig
+from pebbles.metrics import init_api_metrics
+from pebbles.query_stats import init_query_stats
 from pebbles.utils import init_logging
 
 db = SQLAlchemy()
@@ -65,6 +67,12 @@ def create_app(test_config=None):
     if 'SQLALCHEMY_LOGGING_LEVEL' in os.environ:
         logging.getLogger("sqlalchemy.engine").setLevel(int(os.environ.get('SQLALCHEMY_LOGGING_LEVEL')))
 
+    # count and time the SQL statements of each request
+    init_query_stats(app)
+
+    # request latency metrics and the /metrics endpoint
+    init_api_metrics(app)
+
     # setup API endpoints
     init_api(app)
 
@@ -98,10 +106,11 @@ def create_app(test_config=None):
 
 
 def init_api(app: Flask):
-    from pebbles.views.alerts import AlertList, AlertView, SystemStatus, AlertReset
+    from pebbles.views.alerts import AlertList, AlertView, SystemStatus, AlertReset, AlertCompaction
     from pebbles.views.application_categories import ApplicationCategoryList
     from pebbles.views.application_sessions import ApplicationSessionList, ApplicationSessionView, \
-        ApplicationSessionLogs
+        ApplicationSessionLogs, ApplicationSessionChanges, ApplicationSessionStream, ApplicationSessionStreamToken, \
+        ApplicationSessionPhaseDurations
     from pebbles.views.application_templates import ApplicationTemplateList, ApplicationTemplateView, \
         ApplicationTemplateCopy
     from pebbles.views.applications import ApplicationList, ApplicationView, ApplicationCopy, \
@@ -114,13 +123,14 @@ def init_api(app: Flask):
     from pebbles.views.service_announcements import ServiceAnnouncementList, ServiceAnnouncementListPublic, \
         ServiceAnnouncementListAdmin, ServiceAnnouncementViewAdmin
     from pebbles.views.sessions import SessionView
-    from pebbles.views.tasks import TaskList, TaskView, TaskAddResults
-    from pebbles.views.users import UserList, UserView, UserWorkspaceMembershipList
+    from pebbles.views.tasks import TaskList, TaskView, TaskAddResults, TaskClaim, TaskRelease
+    from pebbles.views.users import UserList, UserImport, UserView, UserWorkspaceMembershipList
+    from pebbles.views.workers import WorkerList, WorkerView
     from pebbles.views.workspaces import (
-        WorkspaceClearMembers, WorkspaceTransferOwnership, WorkspaceAccounting,
+        WorkspaceClearMembers, WorkspaceTransferOwnership, WorkspaceAccounting, WorkspaceAccountingReport,
         WorkspaceMemoryLimitGiB, WorkspaceModifyUserFolderSize,
         WorkspaceModifyCluster,
-        WorkspaceClearExpiredMembers, WorkspaceModifyMembershipExpiryPolicy,
+        WorkspaceClearExpiredMembers, WorkspaceListClearExpiredMembers, WorkspaceModifyMembershipExpiryPolicy,
         WorkspaceModifyMembershipJoinPolicy,
         WorkspaceCreateVolumeTasks, WorkspaceModifyExpiryTs
     )
@@ -130,6 +140,7 @@ def init_api(app: Flask):
     api = restful.Api(app)
     api_root = '/api/v1'
     api.add_resource(UserList, api_root + '/users', methods=['GET', 'POST'])
+    api.add_resource(UserImport, api_root + '/users/import')
     api.add_resource(UserView, api_root + '/users/<string:user_id>', methods=['GET', 'DELETE', 'PATCH'])
     api.add_resource(UserWorkspaceMembershipList, api_root + '/users/<string:user_id>/workspace_memberships')
     api.add_resource(WorkspaceList, api_root + '/workspaces')
@@ -142,9 +153,11 @@ def init_api(app: Flask):
         WorkspaceTransferOwnership, api_root + '/workspaces/<string:workspace_id>/transfer_ownership',
         methods=['PATCH'])
     api.add_resource(WorkspaceClearMembers, api_root + '/workspaces/<string:workspace_id>/clear_members')
+    api.add_resource(WorkspaceListClearExpiredMembers, api_root + '/workspaces/clear_expired_members')
     api.add_resource(WorkspaceClearExpiredMembers, api_root + '/workspaces/<string:workspace_id>/clear_expired_members')
     api.add_resource(WorkspaceExit, api_root + '/workspaces/<string:workspace_id>/exit')
     api.add_resource(WorkspaceAccounting, api_root + '/workspaces/<string:workspace_id>/accounting')
+    api.add_resource(WorkspaceAccountingReport, api_root + '/workspace_accounting')
     api.add_resource(WorkspaceMemoryLimitGiB, api_root + '/workspaces/<string:workspace_id>/memory_limit_gib')
     api.add_resource(WorkspaceModifyUserFolderSize,
                      api_root + '/workspaces/<string:workspace_id>/user_work_folder_size_gib')
@@ -173,6 +186,10 @@ def init_api(app: Flask):
     api.add_resource(ApplicationCopy, api_root + '/applications/<string:application_id>/copy')
     api.add_resource(ApplicationAttributeLimits, api_root + '/applications/<string:application_id>/attribute_limits')
     api.add_resource(ApplicationSessionList, api_root + '/application_sessions')
+    api.add_resource(ApplicationSessionChanges, api_root + '/application_sessions/changes')
+    api.add_resource(ApplicationSessionStream, api_root + '/application_sessions/stream')
+    api.add_resource(ApplicationSessionStreamToken, api_root + '/application_sessions/stream_token')
+    api.add_resource(ApplicationSessionPhaseDurations, api_root + '/application_sessions/phase_durations')
     api.add_resource(
         ApplicationSessionView,
         api_root + '/application_sessions/<string:application_session_id>',
@@ -185,13 +202,17 @@ def init_api(app: Flask):
     api.add_resource(PublicConfigList, api_root + '/config')
     api.add_resource(LockList, api_root + '/locks')
     api.add_resource(LockView, api_root + '/locks/<string:lock_id>')
+    api.add_resource(WorkerList, api_root + '/workers')
+    api.add_resource(WorkerView, api_root + '/workers/<string:worker_id>')
     api.add_resource(ApplicationCategoryList, api_root + '/application_categories')
     api.add_resource(HelpsList, api_root + '/help')
     api.add_resource(AlertList, api_root + '/alerts')
+    api.add_resource(AlertCompaction, api_root + '/alerts/compact')
     api.add_resource(AlertView, api_root + '/alerts/<string:id>')
     api.add_resource(AlertReset, api_root + '/alert_reset/<string:target>/<string:source>')
     api.add_resource(SystemStatus, api_root + '/status')
     api.add_resource(TaskList, api_root + '/tasks')
+    api.add_resource(TaskClaim, api_root + '/tasks/claim')
     api.add_resource(
         TaskView,
         api_root + '/tasks/<string:task_id>',
@@ -202,6 +223,7 @@ def init_api(app: Flask):
         api_root + '/tasks/<string:task_id>/results',
         methods=['PUT']
     )
+    api.add_resource(TaskRelease, api_root + '/tasks/<string:task_id>/release')
 
     # Setup route for readiness/liveness probe check
     @app.route('/healthz')
@@ -0,0 +1,207 @@
+"""Change feed for application sessions.
+
+Changes to application sessions (creation, state transitions, to_be_deleted, session data) and new provisioning log
+lines are published as small events that long-polling clients, such as the workers and the UI push channel, can wait on
+instead of polling the database. The events carry ids and flags only, never the session data or log messages:
+PostgreSQL limits NOTIFY payloads to 8000 bytes and a payload over it would fail the transaction making the change.
+Clients load the details they need.
+
+On PostgreSQL the events are sent with NOTIFY as a part of the transaction that makes the change, and every API process
+LISTENs to the channel, so that a client gets the event regardless of the process that served the change. On other
+databases (unit tests) the events are published to the in-process feed when the transaction commits.
+
+The cursors are positions in the feed of one API process: the id of the feed and a sequence number. The processes see
+the same events, but not at the same moments, so a cursor from another process, e.g. after the load balancer sends a
+reconnecting client to another replica, or one that has fallen out of the feed cannot be used to filter the events.
+Such clients are told to resync: to check everything and continue from the current position of the feed.
+"""
+import collections
+import json
+import logging
+import select
+import threading
+import time
+import uuid
+
+from sqlalchemy import create_engine, event, func, inspect as sa_inspect, select as sa_select
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+from pebbles.models import ApplicationSession, ApplicationSessionLog
+
+NOTIFY_CHANNEL = 'pebbles_application_session_changes'
+
+# how many events and for how long the feed keeps them for clients that are catching up
+FEED_MAX_EVENTS = 2000
+FEED_MAX_AGE = 300
+
+PENDING_CHANGES_KEY = 'pebbles_pending_changes'
+
+
+class ChangeFeed:
+    """In-process feed of change events. Events get a 'cursor' key when published, see parse_cursor()."""
+
+    def __init__(self, max_events=FEED_MAX_EVENTS, max_age=FEED_MAX_AGE):
+        self.max_age = max_age
+        self.max_events = max_events
+        self.feed_id = uuid.uuid4().hex[:12]
+        # (sequence number, publish time, change)
+        self.events = collections.deque()
+        self.seq = 0
+        # sequence number of the newest event dropped from the feed, clients behind it have missed events
+        self.dropped_seq = 0
+        self.condition = threading.Condition()
+        self.listener_thread = None
+
+    def format_cursor(self, seq):
+        return '%s-%d' % (self.feed_id, seq)
+
+    def parse_cursor(self, cursor):
+        """Return the sequence number of a cursor of this feed, or None if the cursor comes from another process or
+        the events after it have been dropped, in which case the client has to resync"""
+        feed_id, _, seq = (cursor or '').partition('-')
+        if feed_id != self.feed_id or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self.condition:
+            if seq < self.dropped_seq or seq > self.seq:
+                return None
+        return seq
+
+    def publish(self, change):
+        with self.condition:
+            self.seq += 1
+            now = time.time()
+            self.events.append((self.seq, now, dict(change, cursor=self.format_cursor(self.seq))))
+            # drop events that are too old to be of interest
+            while self.events and (len(self.events) > self.max_events or self.events[0][1] < now - self.max_age):
+                self.dropped_seq = self.events.popleft()[0]
+            self.condition.notify_all()
+
+    def latest_cursor(self):
+        with self.condition:
+            return self.format_cursor(self.seq)
+
+    def get_changes(self, since, predicate=None):
+        with self.condition:
+            return [c for seq, _, c in self.events if seq > since and (predicate is None or predicate(c))]
+
+    def wait_for_changes(self, since, timeout, predicate=None):
+        """Wait at most 'timeout' seconds for changes after sequence number 'since', see parse_cursor(). Returns the
+        changes and the cursor to continue from, which is past the events that did not match the predicate."""
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                changes = self.get_changes(since, predicate)
+                remaining = deadline - time.time()
+                if changes or remaining <= 0:
+                    return changes, self.format_cursor(self.seq)
+                self.condition.wait(remaining)
+
+    def ensure_listener(self, engine):
+        """Start a thread that LISTENs to change notifications from PostgreSQL, if not already running"""
+        if engine.dialect.name != 'postgresql':
+            return
+        with self.condition:
+            if self.listener_thread and self.listener_thread.is_alive():
+                return
+            self.listener_thread = threading.Thread(
+                target=self.listen, args=(engine.url,), name='change-feed-listener', daemon=True)
+            self.listener_thread.start()
+
+    def listen(self, database_url):
+        # use a dedicated connection outside the pool, it is kept open for the lifetime of the process
+        engine = create_engine(database_url, poolclass=NullPool)
+        while True:
+            connection = None
+            try:
+                connection = engine.raw_connection()
+                dbapi_connection = connection.driver_connection
+                dbapi_connection.autocommit = True
+                dbapi_connection.cursor().execute('LISTEN %s' % NOTIFY_CHANNEL)
+                logging.info('change feed listening to %s', NOTIFY_CHANNEL)
+                while True:
+                    if select.select([dbapi_connection], [], [], 10) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notification = dbapi_connection.notifies.pop(0)
+                        self.publish(json.loads(notification.payload))
+            except Exception as e:
+                logging.warning('change feed listener failed, reconnecting: %s', e)
+                time.sleep(5)
+            finally:
+                if connection:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+
+change_feed = ChangeFeed()
+
+
+def application_session_change(application_session, session_data_changed=False):
+    return dict(
+        kind='application_session',
+        id=application_session.id,
+        user_id=application_session.user_id,
+        state=application_session.state,
+        to_be_deleted=bool(application_session.to_be_deleted),
+        session_data_changed=session_data_changed,
+    )
+
+
+def application_session_log_change(application_session_log, user_id):
+    return dict(
+        kind='application_session_log',
+        id=application_session_log.application_session_id,
+        user_id=user_id,
+        log_id=application_session_log.id,
+    )
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_changes(session, flush_context):
+    changes = []
+    new_logs = []
+    for obj in session.new:
+        if isinstance(obj, ApplicationSession):
+            changes.append(application_session_change(obj, session_data_changed=True))
+        elif isinstance(obj, ApplicationSessionLog) and obj.log_type == 'provisioning':
+            new_logs.append(obj)
+    if new_logs:
+        # look up the owners of the sessions in one go, the logs can come in large batches
+        user_ids = dict(session.connection().execute(
+            sa_select(ApplicationSession.id, ApplicationSession.user_id)
+            .where(ApplicationSession.id.in_({log.application_session_id for log in new_logs}))
+        ).all())
+        changes.extend(application_session_log_change(log, user_ids.get(log.application_session_id))
+                       for log in new_logs)
+    for obj in session.dirty:
+        if isinstance(obj, ApplicationSession):
+            attrs = sa_inspect(obj).attrs
+            session_data_changed = attrs['_session_data'].history.has_changes()
+            if session_data_changed or any(attrs[a].history.has_changes() for a in ('_state', 'to_be_deleted')):
+                changes.append(application_session_change(obj, session_data_changed=session_data_changed))
+    if not changes:
+        return
+
+    if session.get_bind().dialect.name == 'postgresql':
+        # NOTIFY is transactional, listeners get the events only if the transaction commits
+        connection = session.connection()
+        for change in changes:
+            connection.execute(sa_select(func.pg_notify(NOTIFY_CHANNEL, json.dumps(change))))
+    else:
+        session.info.setdefault(PENDING_CHANGES_KEY, []).extend(changes)
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_pending_changes(session):
+    for change in session.info.pop(PENDING_CHANGES_KEY, []):
+        change_feed.publish(change)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_pending_changes(session, previous_transaction):
+    session.info.pop(PENDING_CHANGES_KEY, None)
@@ -1,28 +1,37 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
+import base64
 import json
 import logging
 from time import time
 
 import requests
-from jose import jwt
 
 import pebbles.utils
-from pebbles.config import RuntimeConfig
+
+
+def get_unverified_claims(token):
+    """Decode the claims of a JWT without verifying the signature. Only the API verifies tokens, so the clients can do
+    without the slow to import jose."""
+    payload = token.split('.')[1]
+    return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
 
 
 class PBClient:
-    def __init__(self, token, api_base_url, ssl_verify=True):
+    def __init__(self, token, api_base_url, ssl_verify=True, request_timeout=None):
         self.token = token
         self.api_base_url = api_base_url
         self.ssl_verify = ssl_verify
+        # timeout in seconds for the HTTP requests, None waits forever
+        self.request_timeout = request_timeout
         self.auth = pebbles.utils.b64encode_string('%s:%s' % (token, '')).replace('\n', '')
 
     def check_and_refresh_session(self, ext_id, password):
         # renew worker session 15 minutes before expiration
         try:
-            claims = jwt.get_unverified_claims(self.token)
+            claims = get_unverified_claims(self.token)
             remaining_time = claims['exp'] - time()
             if remaining_time < 900:
                 logging.info("Token will expire soon, relogin %s" % ext_id)
@@ -33,17 +42,20 @@ class PBClient:
     def login(self, ext_id, password):
         auth_url = '%s/sessions' % self.api_base_url
         auth_credentials = dict(ext_id=ext_id, password=password)
-        r = requests.post(auth_url, json=auth_credentials, verify=self.ssl_verify)
+        r = requests.post(auth_url, json=auth_credentials, verify=self.ssl_verify, timeout=self.request_timeout)
         if r.status_code != 200:
             raise RuntimeError('Login failed, status: %d, ext_id "%s", auth_url "%s"' %
                                (r.status_code, ext_id, auth_url))
         self.token = json.loads(r.text).get('token')
         self.auth = pebbles.utils.b64encode_string('%s:%s' % (self.token, '')).replace('\n', '')
 
-    def do_get(self, object_url, payload=None):
+    def do_get(self, object_url, payload=None, timeout=None):
         headers = {'Accept': 'text/plain', 'Authorization': 'Basic %s' % self.auth}
         url = '%s/%s' % (self.api_base_url, object_url)
-        resp = requests.get(url, data=payload, headers=headers, verify=self.ssl_verify)
+        resp = requests.get(
+            url, data=payload, headers=headers, verify=self.ssl_verify,
+            timeout=timeout if timeout is not None else self.request_timeout
+        )
         return resp
 
     modify_methods = dict(
@@ -61,7 +73,8 @@ class PBClient:
             'Accept': 'text/plain',
             'Authorization': 'Basic %s' % self.auth}
         url = '%s/%s' % (self.api_base_url, object_url)
-        resp = self.modify_methods[method](url, data=form_data, json=json_data, headers=headers, verify=self.ssl_verify)
+        resp = self.modify_methods[method](
+            url, data=form_data, json=json_data, headers=headers, verify=self.ssl_verify, timeout=self.request_timeout)
         return resp
 
     def do_patch(self, object_url, form_data=None, json_data=None):
@@ -131,6 +144,16 @@ class PBClient:
             raise RuntimeError('Cannot fetch data for application_sessions, %s' % resp.reason)
         return resp.json()
 
+    def get_application_session_changes(self, since=None, timeout=25):
+        query = 'application_sessions/changes?timeout=%s' % timeout
+        if since is not None:
+            query += '&since=%s' % since
+        # give the server some slack on top of the long-poll timeout
+        resp = self.do_get(query, timeout=timeout + 10)
+        if resp.status_code != 200:
+            raise RuntimeError('Cannot fetch application_session changes, %s' % resp.reason)
+        return resp.json()
+
     def get_application_session(self, application_session_id, suppress_404=False):
         resp = self.do_get('application_sessions/%s' % application_session_id)
         if resp.status_code != 200:
@@ -215,6 +238,18 @@ class PBClient:
 
         raise RuntimeError('Error deleting lock: %s, %s' % (lock_id, resp.reason))
 
+    def send_worker_heartbeat(self, worker_id):
+        """Record a heartbeat for the worker, returns the ids of the live workers"""
+        resp = self.do_put('workers/%s' % worker_id)
+        if resp.status_code != 200:
+            raise RuntimeError('Error sending worker heartbeat: %s, %s' % (worker_id, resp.reason))
+        return [worker['id'] for worker in resp.json()]
+
+    def delete_worker_heartbeat(self, worker_id):
+        resp = self.do_delete('workers/%s' % worker_id)
+        if resp.status_code not in (200, 404):
+            raise RuntimeError('Error deleting worker heartbeat: %s, %s' % (worker_id, resp.reason))
+
     def get_tasks(self, kind=None, state=None, unfinished=None):
         query_opts = []
         if kind:
@@ -234,13 +269,59 @@ class PBClient:
         json_data = dict(state=state)
         return self.do_patch(url, json_data=json_data)
 
+    def claim_tasks(self, worker_id, limit=10, lease_seconds=300):
+        json_data = dict(worker_id=worker_id, limit=limit, lease_seconds=lease_seconds)
+        resp = self.do_post('tasks/claim', json_data=json_data)
+        if resp.status_code != 200:
+            raise RuntimeError('Error claiming tasks, %s' % resp.reason)
+        return resp.json()
+
+    def release_task(self, task_id, worker_id, delay=0, error=None):
+        json_data = dict(worker_id=worker_id, delay=delay)
+        if error:
+            json_data['error'] = error
+        resp = self.do_post('tasks/%s/release' % task_id, json_data=json_data)
+        if resp.status_code == 409:
+            # the lease expired and the task was claimed by another worker, it is theirs now
+            logging.warning('lease on task %s lost to another worker', task_id)
+            return None
+        if resp.status_code != 200:
+            raise RuntimeError('Error releasing task %s, %s' % (task_id, resp.reason))
+        return resp.json()
+
     def add_task_results(self, task_id, results):
         url = 'tasks/%s/results' % task_id
         json_data = dict(results=results)
         return self.do_put(url, json_data=json_data)
 
 
+class AsyncPBClient:
+    """
+    Asyncio interface to PBClient. Each call runs the corresponding PBClient method in the event loop's executor
+    with a timeout, so that a slow API call does not block other coroutines.
+    """
+
+    def __init__(self, client: PBClient, timeout=30):
+        self.client = client
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, call_timeout=None, **kwargs):
+            return await asyncio.wait_for(
+                asyncio.to_thread(attr, *args, **kwargs),
+                call_timeout if call_timeout is not None else self.timeout
+            )
+
+        return call
+
+
 if __name__ == '__main__':
+    from pebbles.config import RuntimeConfig
+
     config = RuntimeConfig()
 
     pebbles.utils.init_logging(config, 'client')
@@ -84,6 +84,8 @@ class BaseConfig:
 
     # Oauth2 master switch
     OAUTH2_LOGIN_ENABLED = False
+    # timeout in seconds for the requests to the identity provider during login
+    OAUTH2_REQUEST_TIMEOUT = 10
 
     # Terms and conditions settings
     AGREEMENT_TITLE = 'Title here'
@@ -102,6 +104,63 @@ class BaseConfig:
     CLUSTER_KUBECONFIG_FILE = '/var/run/secrets/pebbles/cluster-kubeconfig'
     DEFAULT_CLUSTER = 'local_kubernetes'
 
+    # How long API processes cache the system status, in seconds
+    SYSTEM_STATUS_CACHE_TTL = 5
+
+    # Maximum number of concurrent Jobs started by tasks (volume backups and restores) per cluster
+    TASK_MAX_JOBS_PER_CLUSTER = 10
+
+    # Worker runtime: 'sync' runs the controllers serially in one loop, 'async' runs them as independent asyncio tasks
+    WORKER_RUNTIME = 'sync'
+    # async runtime: maximum number of application session operations in progress at the same time
+    WORKER_MAX_CONCURRENT_SESSION_OPERATIONS = 20
+    # async runtime: timeout in seconds for a single application session operation or controller round
+    WORKER_OPERATION_TIMEOUT = 120
+
+    # Maximum number of users in one POST /users/import request. Hashing the passwords with bcrypt takes about 0.25 s
+    # per user and CPU at the default cost, so the import has to stay well within GUNICORN_TIMEOUT. Use
+    # 'manage.py createuser_import' for larger imports.
+    USER_IMPORT_MAX_USERS = 200
+
+    # Per request SQL statistics: add a Server-Timing header to responses, and log the statements of requests that
+    # take longer than the threshold in seconds or run more queries than the count. 0 disables the logging.
+    SERVER_TIMING_ENABLED = True
+    SLOW_REQUEST_LOG_THRESHOLD = 2
+    SLOW_REQUEST_LOG_QUERY_COUNT = 100
+
+    # Prometheus metrics, needs prometheus_client. The API serves them on /metrics, workers on WORKER_METRICS_PORT
+    # (0 disables the worker listener)
+    METRICS_ENABLED = True
+    WORKER_METRICS_PORT = 9090
+
+    # API server settings, see pebbles/gunicorn_config.py. Worker class is 'gthread' (processes with threads), 'sync' or
+    # 'gevent' (needs gevent and psycogreen installed). 0 workers derives the number from the available CPUs.
+    GUNICORN_WORKER_CLASS = 'gthread'
+    GUNICORN_WORKERS = 0
+    # threads per process for gthread, concurrent connections per process for gevent. Long-lived requests hold a thread
+    # each: the application session streams (APPLICATION_SESSION_STREAM_MAX_PER_PROCESS) and the change long-polls of
+    # the workers, so there have to be enough threads left for the regular requests.
+    GUNICORN_THREADS = 16
+    GUNICORN_WORKER_CONNECTIONS = 100
+    # load the app in the master process before forking the workers
+    GUNICORN_PRELOAD_APP = True
+    # timeouts in seconds: silent worker restart, graceful shutdown and keep-alive connections (keep the keep-alive
+    # longer than the idle timeout of the router in front of the API)
+    GUNICORN_TIMEOUT = 60
+    GUNICORN_GRACEFUL_TIMEOUT = 30
+    GUNICORN_KEEPALIVE = 75
+
+    # Server-sent event stream of application session changes for the UI. Each open stream holds a server thread (or a
+    # gevent connection) for up to five minutes, so the streams per server process are capped. By default the cap is
+    # half of GUNICORN_THREADS, or of GUNICORN_WORKER_CONNECTIONS with gevent, see
+    # application_session_stream_max_per_process(). 0 means no cap. Clients beyond the cap get 503 and poll the session
+    # list instead, so for large courses either raise the threads or use gevent workers. The stream cannot be used
+    # with sync workers, see pebbles/gunicorn_config.py.
+    APPLICATION_SESSION_STREAM_ENABLED = True
+    APPLICATION_SESSION_STREAM_MAX_PER_PROCESS = None
+    # lifetime in seconds of the tokens for opening a stream, browsers cannot send an Authorization header with it
+    APPLICATION_SESSION_STREAM_TOKEN_LIFETIME = 60
+
     # API configmap paths
     API_AUTH_CONFIG_FILE = '/run/configmaps/pebbles/api-configmap/auth-config.yaml'
     API_FAQ_FILE = '/run/configmaps/pebbles/api-configmap/faq-content.yaml'
@@ -163,6 +222,17 @@ def resolve_configuration_value(key, default=None, *args, **kwargs):
         return default
 
 
+def application_session_stream_max_per_process(config):
+    """Maximum number of application session streams per API server process, 0 for no limit. Unless set explicitly,
+    half of the threads or gevent connections of the process, the other half is left for the other requests."""
+    max_streams = config['APPLICATION_SESSION_STREAM_MAX_PER_PROCESS']
+    if max_streams is not None:
+        return max_streams
+    if config['GUNICORN_WORKER_CLASS'] == 'gevent':
+        return config['GUNICORN_WORKER_CONNECTIONS'] // 2
+    return config['GUNICORN_THREADS'] // 2
+
+
 class RuntimeConfig(BaseConfig):
     """Main config object that resolves values dynamically at runtime."""
 
@@ -181,6 +251,7 @@ class RuntimeConfig(BaseConfig):
 class TestConfig(BaseConfig):
     """Unit tests config object"""
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    SYSTEM_STATUS_CACHE_TTL = 0
     MAIL_SUPPRESS_SEND = True
     BCRYPT_LOG_ROUNDS = 4
     TEST_MODE = True
@@ -1,10 +1,65 @@
 """
-Provisioning drivers
-=====================
+Registry of the provisioning drivers.
 
-Provisioning drivers are what makes PB tick. There are several for different
-clusters. Currently it's possible to provision on:
+Drivers are registered by class name with a 'module:attribute' reference, and the module is imported only when a
+cluster uses the driver. This keeps kubernetes, openshift and jinja2 out of the processes that do not need them and
+speeds up the worker start.
 
-* local Kubernetes/OpenShift using service account in the same namespace. Useful for development
-* remote OpenShift using robot credentials
+Drivers in other packages can be registered with register_driver(), or declared as entry points in the
+'pebbles.provisioning_drivers' group, e.g. in pyproject.toml:
+
+    [project.entry-points."pebbles.provisioning_drivers"]
+    MyDriver = "my_package.my_driver:MyDriver"
 """
+import importlib
+import importlib.metadata
+import logging
+
+ENTRY_POINT_GROUP = 'pebbles.provisioning_drivers'
+
+_drivers = {
+    'KubernetesLocalDriver': 'pebbles.drivers.provisioning.kubernetes_driver:KubernetesLocalDriver',
+    'KubernetesRemoteDriver': 'pebbles.drivers.provisioning.kubernetes_driver:KubernetesRemoteDriver',
+    'OpenShiftLocalDriver': 'pebbles.drivers.provisioning.kubernetes_driver:OpenShiftLocalDriver',
+    'OpenShiftRemoteDriver': 'pebbles.drivers.provisioning.kubernetes_driver:OpenShiftRemoteDriver',
+    'OpenShiftTemplateDriver': 'pebbles.drivers.provisioning.openshift_template_driver:OpenShiftTemplateDriver',
+    'SimulatedKubernetesDriver':
+        'pebbles.drivers.provisioning.simulated_kubernetes_driver:SimulatedKubernetesDriver',
+}
+_entry_points_loaded = False
+
+
+def register_driver(name, target):
+    """Register a driver class name with a 'module:attribute' reference"""
+    _drivers[name] = target
+
+
+def registered_drivers():
+    _load_entry_points()
+    return sorted(_drivers.keys())
+
+
+def _load_entry_points():
+    """Add the drivers declared as entry points, without importing them. Registered names take precedence."""
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    for entry_point in importlib.metadata.entry_points(group=ENTRY_POINT_GROUP):
+        _drivers.setdefault(entry_point.name, entry_point.value)
+
+
+def find_driver_class(driver_name):
+    """Import and return the driver class registered with the name, None if there is no such driver"""
+    if driver_name not in _drivers:
+        _load_entry_points()
+    target = _drivers.get(driver_name)
+    if not target:
+        return None
+    module_name, _, attribute = target.partition(':')
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as e:
+        logging.warning('unable to import driver %s from %s: %s', driver_name, module_name, e)
+        return None
+    return getattr(module, attribute or driver_name, None)
@@ -9,7 +9,8 @@ import json
 import time
 
 from pebbles.client import PBClient
-from pebbles.models import ApplicationSession
+from pebbles.metrics import observe_time_to_running
+from pebbles.states import ApplicationSessionStates
 
 
 class ProvisioningDriverBase(object):
@@ -44,21 +45,21 @@ class ProvisioningDriverBase(object):
         application_session = pbclient.get_application_session(application_session_id)
 
         if not application_session['to_be_deleted']:
-            if application_session['state'] in [ApplicationSession.STATE_QUEUEING]:
+            if application_session['state'] in [ApplicationSessionStates.STATE_QUEUEING]:
                 self.logger.info('provisioning starting for %s' % application_session.get('name'))
                 self.provision(token, application_session_id)
                 self.logger.info('provisioning done for %s' % application_session.get('name'))
-            if application_session['state'] in [ApplicationSession.STATE_STARTING]:
+            if application_session['state'] in [ApplicationSessionStates.STATE_STARTING]:
                 self.logger.debug('checking readiness of %s' % application_session.get('name'))
                 self.check_readiness(token, application_session_id)
-            if application_session['state'] in [ApplicationSession.STATE_RUNNING] \
+            if application_session['state'] in [ApplicationSessionStates.STATE_RUNNING] \
                     and application_session['log_fetch_pending']:
                 self.logger.info('fetching application_session logs for %s' % application_session.get('name'))
                 self.fetch_running_application_session_logs(token, application_session_id)
                 pass
             else:
                 self.logger.debug("update('%s') - nothing to do for %s" % (application_session_id, application_session))
-        elif application_session['state'] not in [ApplicationSession.STATE_DELETED]:
+        elif application_session['state'] not in [ApplicationSessionStates.STATE_DELETED]:
             self.logger.info('deprovisioning starting for %s' % application_session.get('name'))
             self.deprovision(token, application_session_id)
             pbclient.clear_running_application_session_logs(application_session_id)
@@ -68,16 +69,28 @@ class ProvisioningDriverBase(object):
         """ Subclasses implement and override these """
         raise RuntimeWarning('create_volume_backup_job() not implemented')
 
-    def check_volume_backup_job(self, token, workspace_id, volume_name):
+    def check_volume_backup_job(self, token, workspace_id, volume_name, job_statuses=None):
         """ Subclasses implement and override these """
         raise RuntimeWarning('check_volume_backup_job() not implemented')
 
+    def list_volume_jobs(self, token, workspace_id):
+        """ Subclasses implement and override these """
+        raise RuntimeWarning('list_volume_jobs() not implemented')
+
+    def create_workspace_backup_job(self, token, workspace_id):
+        """ Subclasses implement and override these """
+        raise RuntimeWarning('create_workspace_backup_job() not implemented')
+
+    def check_workspace_backup_job(self, token, workspace_id):
+        """ Subclasses implement and override these """
+        raise RuntimeWarning('check_workspace_backup_job() not implemented')
+
     def create_volume_restore_job(self, token, workspace_id, volume_name, volume_size_spec, storage_class,
                                   src_cluster):
         """ Subclasses implement and override these """
         raise RuntimeWarning('create_workspace_restore_job() not implemented')
 
-    def check_volume_restore_job(self, token, workspace_id, volume_name):
+    def check_volume_restore_job(self, token, workspace_id, volume_name, job_statuses=None):
         """ Subclasses implement and override these """
         raise RuntimeWarning('check_volume_restore_job() not implemented')
 
@@ -88,20 +101,20 @@ class ProvisioningDriverBase(object):
 
         try:
             pbclient.do_application_session_patch(
-                application_session_id, json_data={'state': ApplicationSession.STATE_PROVISIONING})
+                application_session_id, json_data={'state': ApplicationSessionStates.STATE_PROVISIONING})
             self.logger.debug('calling subclass do_provision')
 
             new_state = self.do_provision(token, application_session_id)
             self.logger.debug('got new state for application_session: %s' % new_state)
             if not new_state:
-                new_state = ApplicationSession.STATE_RUNNING
+                new_state = ApplicationSessionStates.STATE_RUNNING
 
             pbclient.do_application_session_patch(application_session_id, json_data={'state': new_state})
         except Exception as e:
             self.logger.exception('do_provision raised %s' % e)
             self.logger.warn('application_session provisioning failed for %s' % application_session_id)
             pbclient.do_application_session_patch(
-                application_session_id, json_data={'state': ApplicationSession.STATE_FAILED})
+                application_session_id, json_data={'state': ApplicationSessionStates.STATE_FAILED})
             raise e
 
     def check_readiness(self, token, application_session_id):
@@ -117,16 +130,20 @@ class ProvisioningDriverBase(object):
                 application_session = pbclient.get_application_session(application_session_id)
                 self.logger.info('application_session %s ready' % application_session.get('name'))
                 patch_data = dict(
-                    state=ApplicationSession.STATE_RUNNING,
+                    state=ApplicationSessionStates.STATE_RUNNING,
                     session_data=json.dumps(session_data)
                 )
                 pbclient.do_application_session_patch(application_session_id, json_data=patch_data)
                 pbclient.add_provisioning_log(application_session_id, 'ready')
+                observe_time_to_running(application_session)
+            else:
+                # not ready yet, ask the API to postpone the next check
+                pbclient.do_application_session_patch(application_session_id, json_data=dict(backoff=True))
 
         except Exception as e:
             self.logger.exception('do_check_readiness raised %s' % e)
             pbclient.do_application_session_patch(
-                application_session_id, json_data={'state': ApplicationSession.STATE_FAILED})
+                application_session_id, json_data={'state': ApplicationSessionStates.STATE_FAILED})
             raise e
 
     def deprovision(self, token, application_session_id):
@@ -135,24 +152,26 @@ class ProvisioningDriverBase(object):
 
         try:
             pbclient.do_application_session_patch(
-                application_session_id, json_data={'state': ApplicationSession.STATE_DELETING})
+                application_session_id, json_data={'state': ApplicationSessionStates.STATE_DELETING})
             self.logger.debug('calling subclass do_deprovision')
             state = self.do_deprovision(token, application_session_id)
 
             # check if we got STATE_DELETING from subclass, indicating a retry is needed
-            if state and state == ApplicationSession.STATE_DELETING:
+            if state and state == ApplicationSessionStates.STATE_DELETING:
                 self.logger.info('application_session deletion will be retried for %s', application_session_id)
                 pbclient.add_provisioning_log(application_session_id, 'deprovisioning - retrying')
+                # the state stays the same, so the API has to be asked to postpone the next attempt
+                pbclient.do_application_session_patch(application_session_id, json_data=dict(backoff=True))
             elif state is None:
                 self.logger.debug('finishing deprovisioning')
                 pbclient.do_application_session_patch(
-                    application_session_id, json_data={'state': ApplicationSession.STATE_DELETED})
+                    application_session_id, json_data={'state': ApplicationSessionStates.STATE_DELETED})
             else:
                 raise RuntimeError('Received invalid state %s from do_deprovision()' % state)
         except Exception as e:
             self.logger.exception('do_deprovision raised %s' % e)
             pbclient.do_application_session_patch(
-                application_session_id, json_data={'state': ApplicationSession.STATE_FAILED})
+                application_session_id, json_data={'state': ApplicationSessionStates.STATE_FAILED})
             raise e
 
     def housekeep(self, token):
@@ -14,12 +14,20 @@ from kubernetes.client.rest import ApiException
 from openshift.dynamic import DynamicClient
 
 from pebbles.drivers.provisioning import base_driver
-from pebbles.models import ApplicationSession
+from pebbles.metrics import time_driver_call
+from pebbles.states import ApplicationSessionStates
 from pebbles.utils import b64encode_string
 
 # limit for application session startup duration before it is marked as failed
 SESSION_STARTUP_TIME_LIMIT = 30 * 60
 
+# workspace backup job defaults, can be overridden in cluster config with backupVolumesPerPod and backupParallelism
+WORKSPACE_BACKUP_VOLUMES_PER_POD = 10
+WORKSPACE_BACKUP_PARALLELISM = 4
+WORKSPACE_BACKUP_JOB_NAME = 'backup-workspace'
+WORKSPACE_BACKUP_LABEL_SELECTOR = 'workspace-backup=true'
+WORKSPACE_BACKUP_SECRET_NAME = 'workspace-backup-secret'
+
 
 @unique
 class VolumePersistenceLevel(Enum):
@@ -63,6 +71,30 @@ def get_shared_volume_name(application_session):
     return None
 
 
+class InstrumentedDynamicClient(DynamicClient):
+    """DynamicClient that records the latency of the calls by verb and resource kind"""
+
+    def get(self, resource, *args, **kwargs):
+        with time_driver_call('get', resource.kind):
+            return super().get(resource, *args, **kwargs)
+
+    def create(self, resource, *args, **kwargs):
+        with time_driver_call('create', resource.kind):
+            return super().create(resource, *args, **kwargs)
+
+    def delete(self, resource, *args, **kwargs):
+        with time_driver_call('delete', resource.kind):
+            return super().delete(resource, *args, **kwargs)
+
+    def patch(self, resource, *args, **kwargs):
+        with time_driver_call('patch', resource.kind):
+            return super().patch(resource, *args, **kwargs)
+
+    def replace(self, resource, *args, **kwargs):
+        with time_driver_call('replace', resource.kind):
+            return super().replace(resource, *args, **kwargs)
+
+
 class KubernetesDriverBase(base_driver.ProvisioningDriverBase):
     def __init__(self, logger, config, cluster_config, token):
         super().__init__(logger, config, cluster_config, token)
@@ -110,7 +142,7 @@ class KubernetesDriverBase(base_driver.ProvisioningDriverBase):
         self.test_connection()
 
         # create dynamic client for actual use - this requires a working connection
-        self.dynamic_client = DynamicClient(self.kubernetes_api_client)
+        self.dynamic_client = InstrumentedDynamicClient(self.kubernetes_api_client)
 
     def test_connection(self):
         logging.debug('testing connection to Kubernetes API')
@@ -204,7 +236,7 @@ class KubernetesDriverBase(base_driver.ProvisioningDriverBase):
         self.create_ingress(namespace, application_session)
 
         # tell base_driver that we need to check on the readiness later by explicitly returning STATE_STARTING
-        return ApplicationSession.STATE_STARTING
+        return ApplicationSessionStates.STATE_STARTING
 
     def do_check_readiness(self, token, application_session_id):
         application_session = self.fetch_and_populate_application_session(token, application_session_id)
@@ -629,35 +661,185 @@ class KubernetesDriverBase(base_driver.ProvisioningDriverBase):
 
         secret_api.create(namespace=namespace, body=pvc_backup_secret_dict)
 
-    def check_volume_backup_job(self, token, workspace_id, volume_name):
+    def list_volume_jobs(self, token, workspace_id):
+        """List the backup and restore jobs in the workspace namespace with one call. Returns a dict of job name to
+        job status."""
         namespace = self.get_namespace(workspace_id)
-
-        # check if the namespace exists
-        if not self.namespace_exists(namespace):
-            raise RuntimeWarning('Backup: Namespace for workspace %s does not exist', workspace_id)
-
         job_api = self.dynamic_client.resources.get(api_version='batch/v1', kind='Job')
-        pod_api = self.dynamic_client.resources.get(api_version='v1', kind='Pod')
-        secret_api = self.dynamic_client.resources.get(api_version='v1', kind='Secret')
+        jobs = job_api.get(
+            namespace=namespace,
+            label_selector='application in (pebbles-backup-pvc,pebbles-restore-pvc)'
+        ).to_dict().get('items', [])
+        return {job['metadata']['name']: job.get('status') or {} for job in jobs}
+
+    def check_volume_job(self, token, workspace_id, job_kind, volume_name, job_statuses=None):
+        """Check a backup or restore job for a volume, clean up the resources once it has completed. The status is
+        looked up in job_statuses from list_volume_jobs() if given, so that the caller can check all the jobs in
+        a namespace with one listing."""
+        namespace = self.get_namespace(workspace_id)
+        job_name = '%s-pvc-%s' % (job_kind, volume_name)
+
+        if job_statuses is None:
+            # check if the namespace exists
+            if not self.namespace_exists(namespace):
+                raise RuntimeWarning(
+                    '%s: Namespace for workspace %s does not exist' % (job_kind.capitalize(), workspace_id))
+            job_statuses = self.list_volume_jobs(token, workspace_id)
 
-        job = job_api.get(namespace=namespace, name='backup-pvc-%s' % volume_name)
+        status = job_statuses.get(job_name)
+        if status is None:
+            raise RuntimeWarning('%s job for volume %s not found in workspace %s' % (
+                job_kind.capitalize(), volume_name, workspace_id))
 
-        if job['status'].get('active') == 1:
+        if not (status.get('succeeded') or status.get('failed')):
             return False
 
         # job completed, we can delete the resources in K8s
-        secret_api.delete(namespace=namespace, name='pvc-backup-secret-%s' % volume_name)
-        job_api.delete(namespace=namespace, name=job['metadata']['name'])
+        job_api = self.dynamic_client.resources.get(api_version='batch/v1', kind='Job')
+        pod_api = self.dynamic_client.resources.get(api_version='v1', kind='Pod')
+        secret_api = self.dynamic_client.resources.get(api_version='v1', kind='Secret')
+        secret_api.delete(namespace=namespace, name='pvc-%s-secret-%s' % (job_kind, volume_name))
+        job_api.delete(namespace=namespace, name=job_name)
         pod_api.delete(
             namespace=namespace,
-            label_selector='job-name=%s' % job['metadata']['name']
+            label_selector='job-name=%s' % job_name
         )
 
-        if job['status'].get('failed'):
-            raise RuntimeWarning('Backup job for volume %s failed in workspace %s' % (volume_name, workspace_id))
+        if status.get('failed'):
+            raise RuntimeWarning('%s job for volume %s failed in workspace %s' % (
+                job_kind.capitalize(), volume_name, workspace_id))
 
         return True
 
+    def check_volume_backup_job(self, token, workspace_id, volume_name, job_statuses=None):
+        return self.check_volume_job(token, workspace_id, 'backup', volume_name, job_statuses)
+
+    def list_backup_volumes(self, namespace):
+        """Return the names of the PVCs in the namespace that are annotated for backup"""
+        pvc_api = self.dynamic_client.resources.get(api_version='v1', kind='PersistentVolumeClaim')
+        pvcs = pvc_api.get(namespace=namespace).to_dict().get('items', [])
+        return sorted(
+            pvc['metadata']['name'] for pvc in pvcs
+            if (pvc['metadata'].get('annotations') or {}).get('pebbles.csc.fi/backup') == 'yes'
+        )
+
+    def get_workspace_backup_parallelism(self):
+        return int(self.cluster_config.get('backupParallelism', WORKSPACE_BACKUP_PARALLELISM))
+
+    def create_workspace_backup_job(self, token, workspace_id):
+        """Back up all the volumes of a workspace with one Job per chunk of volumes, so that each pod mounts only the
+        volumes it backs up. The Jobs beyond backupParallelism are created suspended and resumed by
+        check_workspace_backup_job(). Returns the names of the volumes."""
+        ws = self.pb_client.get_workspace(workspace_id)
+        namespace = self.get_namespace(workspace_id)
+
+        if not self.namespace_exists(namespace):
+            raise RuntimeWarning('Backup: Namespace for workspace %s does not exist' % workspace_id)
+
+        pvc_names = self.list_backup_volumes(namespace)
+        if not pvc_names:
+            raise RuntimeWarning('No volumes to back up in %s' % namespace)
+
+        volumes_per_pod = int(self.cluster_config.get('backupVolumesPerPod', WORKSPACE_BACKUP_VOLUMES_PER_POD))
+        parallelism = self.get_workspace_backup_parallelism()
+        chunks = [pvc_names[i:i + volumes_per_pod] for i in range(0, len(pvc_names), volumes_per_pod)]
+
+        # one secret for encrypting and uploading to object storage, shared by all the pods
+        secret_api = self.dynamic_client.resources.get(api_version='v1', kind='Secret')
+        backup_secret_dict = yaml.safe_load(parse_template('pvc_backup_secret.yaml.j2', dict(pvc_name='workspace')))
+        backup_secret_dict['metadata']['name'] = WORKSPACE_BACKUP_SECRET_NAME
+        backup_secret_dict['stringData']['s3cfg'] = Path(
+            '/run/secrets/pebbles/backup-secret/s3cfg').read_text()
+        backup_secret_dict['stringData']['encrypt-public-key'] = Path(
+            '/run/secrets/pebbles/backup-secret/encrypt-public-key').read_text()
+
+        secret_api.create(namespace=namespace, body=backup_secret_dict)
+
+        workspace_backup_bucket_name = Path(
+            '/run/secrets/pebbles/backup-secret/workspace-backup-bucket-name').read_text()
+        job_api = self.dynamic_client.resources.get(api_version='batch/v1', kind='Job')
+        for chunk_index, chunk in enumerate(chunks):
+            backup_job_yaml = parse_template('workspace_backup_job.yaml.j2', dict(
+                job_name='%s-%d' % (WORKSPACE_BACKUP_JOB_NAME, chunk_index),
+                chunk_index=chunk_index,
+                suspend=chunk_index >= parallelism,
+                secret_name=WORKSPACE_BACKUP_SECRET_NAME,
+                cluster_name=self.cluster_config['name'],
+                workspace_pseudonym=ws['pseudonym'],
+                pvc_names=chunk,
+                workspace_backup_bucket_name=workspace_backup_bucket_name,
+            ))
+            self.logger.debug('creating workspace backup job\n%s' % backup_job_yaml)
+            job_api.create(namespace=namespace, body=yaml.safe_load(backup_job_yaml))
+
+        return pvc_names
+
+    def get_workspace_backup_progress(self, namespace):
+        """Parse the per-volume status lines from the logs of the backup pods. Returns a dict of volume name to
+        'ok' or 'failed' for the volumes that have been processed so far."""
+        pod_api = self.dynamic_client.resources.get(api_version='v1', kind='Pod')
+        pods = pod_api.get(namespace=namespace, label_selector=WORKSPACE_BACKUP_LABEL_SELECTOR)
+        progress = {}
+        for pod in pods.items:
+            if pod.status.phase not in ('Running', 'Succeeded', 'Failed'):
+                continue
+            logs = self.dynamic_client.request(
+                'GET', '/api/v1/namespaces/%s/pods/%s/log' % (namespace, pod.metadata.name))
+            for line in (logs or '').splitlines():
+                fields = line.split()
+                if len(fields) == 3 and fields[0] == 'volume-backup-status':
+                    progress[fields[1]] = fields[2]
+        return progress
+
+    def check_workspace_backup_job(self, token, workspace_id):
+        """Check the workspace backup jobs, resuming suspended ones as the running ones finish. Returns a tuple of
+        (done, progress), see get_workspace_backup_progress() for progress."""
+        namespace = self.get_namespace(workspace_id)
+
+        # check if the namespace exists
+        if not self.namespace_exists(namespace):
+            raise RuntimeWarning('Backup: Namespace for workspace %s does not exist' % workspace_id)
+
+        job_api = self.dynamic_client.resources.get(api_version='batch/v1', kind='Job')
+        pod_api = self.dynamic_client.resources.get(api_version='v1', kind='Pod')
+        secret_api = self.dynamic_client.resources.get(api_version='v1', kind='Secret')
+
+        jobs = job_api.get(namespace=namespace, label_selector=WORKSPACE_BACKUP_LABEL_SELECTOR).to_dict()['items']
+        if not jobs:
+            raise RuntimeWarning('Backup: no backup jobs found in workspace %s' % workspace_id)
+        # resume the chunks in order
+        jobs.sort(key=lambda j: int(j['metadata']['name'].rsplit('-', 1)[-1]))
+
+        def is_finished(job):
+            conditions = (job.get('status') or {}).get('conditions') or []
+            return any(c['type'] in ('Complete', 'Failed') and c['status'] == 'True' for c in conditions)
+
+        suspended = [j for j in jobs if j['spec'].get('suspend')]
+        running = [j for j in jobs if not j['spec'].get('suspend') and not is_finished(j)]
+        for job in suspended[:max(self.get_workspace_backup_parallelism() - len(running), 0)]:
+            self.logger.debug('resuming workspace backup job %s in %s' % (job['metadata']['name'], namespace))
+            job_api.patch(
+                namespace=namespace,
+                name=job['metadata']['name'],
+                body=dict(spec=dict(suspend=False)),
+                content_type='application/merge-patch+json'
+            )
+
+        progress = self.get_workspace_backup_progress(namespace)
+
+        if suspended or running:
+            return False, progress
+
+        # all jobs completed, we can delete the resources in K8s
+        secret_api.delete(namespace=namespace, name=WORKSPACE_BACKUP_SECRET_NAME)
+        job_api.delete(namespace=namespace, label_selector=WORKSPACE_BACKUP_LABEL_SELECTOR)
+        pod_api.delete(namespace=namespace, label_selector=WORKSPACE_BACKUP_LABEL_SELECTOR)
+
+        if any((j.get('status') or {}).get('failed') for j in jobs):
+            raise RuntimeWarning('Backup job failed in workspace %s' % workspace_id)
+
+        return True, progress
+
     def create_volume_restore_job(self, token, workspace_id, volume_name, volume_size_spec, storage_class, src_cluster):
         ws = self.pb_client.get_workspace(workspace_id)
         namespace = self.get_namespace(workspace_id)
@@ -698,34 +880,8 @@ class KubernetesDriverBase(base_driver.ProvisioningDriverBase):
 
         secret_api.create(namespace=namespace, body=pvc_restore_secret_dict)
 
-    def check_volume_restore_job(self, token, workspace_id, volume_name):
-        namespace = self.get_namespace(workspace_id)
-
-        # check if the namespace exists
-        if not self.namespace_exists(namespace):
-            raise RuntimeWarning('Backup: Namespace for workspace %s does not exist', workspace_id)
-
-        job_api = self.dynamic_client.resources.get(api_version='batch/v1', kind='Job')
-        pod_api = self.dynamic_client.resources.get(api_version='v1', kind='Pod')
-        secret_api = self.dynamic_client.resources.get(api_version='v1', kind='Secret')
-
-        job = job_api.get(namespace=namespace, name='restore-pvc-%s' % volume_name)
-
-        if job['status'].get('active') == 1:
-            return False
-
-        # job completed, we can delete the resources in K8s
-        secret_api.delete(namespace=namespace, name='pvc-restore-secret-%s' % volume_name)
-        job_api.delete(namespace=namespace, name=job['metadata']['name'])
-        pod_api.delete(
-            namespace=namespace,
-            label_selector='job-name=%s' % job['metadata']['name']
-        )
-
-        if job['status'].get('failed'):
-            raise RuntimeWarning('Restore job for volume %s failed in workspace %s' % (volume_name, workspace_id))
-
-        return True
+    def check_volume_restore_job(self, token, workspace_id, volume_name, job_statuses=None):
+        return self.check_volume_job(token, workspace_id, 'restore', volume_name, job_statuses)
 
 
 class KubernetesLocalDriver(KubernetesDriverBase):
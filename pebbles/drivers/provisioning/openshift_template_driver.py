@@ -8,7 +8,7 @@ from dateutil import parser as dateutil_parser
 from openshift.dynamic.exceptions import ConflictError
 
 from pebbles.drivers.provisioning.kubernetes_driver import OpenShiftRemoteDriver
-from pebbles.models import ApplicationSession
+from pebbles.states import ApplicationSessionStates
 
 
 class OpenShiftTemplateDriver(OpenShiftRemoteDriver):
@@ -59,7 +59,7 @@ class OpenShiftTemplateDriver(OpenShiftRemoteDriver):
                 )
 
         # tell base_driver that we need to check on the readiness later by explicitly returning STATE_STARTING
-        return ApplicationSession.STATE_STARTING
+        return ApplicationSessionStates.STATE_STARTING
 
     def do_check_readiness(self, token, application_session_id):
         """ Implements readiness checking, called by superclass. Checks that all the pods are ready.
@@ -150,7 +150,7 @@ class OpenShiftTemplateDriver(OpenShiftRemoteDriver):
                     object_type, label_selector, namespace
                 )
                 # retry
-                return ApplicationSession.STATE_DELETING
+                return ApplicationSessionStates.STATE_DELETING
 
     def render_template_objects(self, namespace, application_session):
         """ Render the template for the application session. This is done on OpenShift server.
@@ -0,0 +1,369 @@
+"""
+Simulated Kubernetes driver for load testing the worker without a cluster.
+
+SimulatedKubernetesDriver runs the KubernetesDriverBase code unchanged against an in-memory stand-in of the dynamic
+client. The cluster keeps namespaces, PVCs, deployments, pods, jobs and the other objects the driver creates in
+memory, and models the following behaviour, configurable in the cluster config:
+
+ - simulatedApiLatency: seconds per API call, randomized +-50% (default 0.01)
+ - simulatedApiFailureRate: fraction of API calls that fail with status 500 (default 0)
+ - simulatedPodStartupTime: seconds from pod creation to ready, randomized +-50% (default 5)
+ - simulatedImagePullTime: extra seconds for the first pod using an image in the cluster (default 20)
+ - simulatedPodFailureRate: fraction of pods that fail to pull their image and never become ready (default 0)
+
+The state is shared by all driver instances for the same cluster name within the process.
+"""
+import copy
+import datetime
+import random
+import re
+import threading
+import time
+import uuid
+
+from kubernetes.client.rest import ApiException
+from kubernetes.dynamic.resource import ResourceInstance
+
+from pebbles.drivers.provisioning.kubernetes_driver import KubernetesDriverBase
+from pebbles.metrics import time_driver_call
+
+# kinds that do not live in a namespace
+CLUSTER_SCOPED_KINDS = ('Namespace',)
+
+LABEL_SELECTOR_RE = re.compile(r'\s*([\w./-]+)\s+in\s+\(([^)]*)\)\s*|\s*([\w./-]+)\s*=\s*([\w.-]*)\s*')
+
+_simulated_clusters = {}
+_simulated_clusters_lock = threading.Lock()
+
+
+def get_simulated_cluster(cluster_config):
+    """Return the in-memory cluster for the cluster config, creating it on first use"""
+    with _simulated_clusters_lock:
+        name = cluster_config['name']
+        if name not in _simulated_clusters:
+            _simulated_clusters[name] = SimulatedCluster(cluster_config)
+        return _simulated_clusters[name]
+
+
+def format_k8s_timestamp(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def parse_label_selector(label_selector):
+    """Parse 'key=value' and 'key in (a,b)' terms into a list of (key, allowed values)"""
+    terms = []
+    pos = 0
+    while pos < len(label_selector):
+        match = LABEL_SELECTOR_RE.match(label_selector, pos)
+        if not match:
+            raise ApiException(status=400, reason='unsupported label selector "%s"' % label_selector)
+        if match.group(1):
+            terms.append((match.group(1), {v.strip() for v in match.group(2).split(',')}))
+        else:
+            terms.append((match.group(3), {match.group(4)}))
+        pos = match.end()
+        if pos < len(label_selector) and label_selector[pos] == ',':
+            pos += 1
+    return terms
+
+
+def merge_patch(obj, patch):
+    """Apply a JSON merge patch (RFC 7386) to obj in place"""
+    for key, value in patch.items():
+        if value is None:
+            obj.pop(key, None)
+        elif isinstance(value, dict) and isinstance(obj.get(key), dict):
+            merge_patch(obj[key], value)
+        else:
+            obj[key] = copy.deepcopy(value)
+
+
+def matches_label_selector(obj, terms):
+    labels = obj['metadata'].get('labels') or {}
+    return all(labels.get(key) in values for key, values in terms)
+
+
+class SimulatedCluster:
+    """In-memory object store with simulated pod and job lifecycles"""
+
+    def __init__(self, cluster_config):
+        self.api_latency = float(cluster_config.get('simulatedApiLatency', 0.01))
+        self.api_failure_rate = float(cluster_config.get('simulatedApiFailureRate', 0))
+        self.pod_startup_time = float(cluster_config.get('simulatedPodStartupTime', 5))
+        self.image_pull_time = float(cluster_config.get('simulatedImagePullTime', 20))
+        self.pod_failure_rate = float(cluster_config.get('simulatedPodFailureRate', 0))
+
+        self.lock = threading.Lock()
+        # (kind, namespace, name) -> object
+        self.objects = {}
+        # image -> time when the image is available in the cluster
+        self.image_ready_ts = {}
+        self.num_api_calls = 0
+        self.num_pods_created = 0
+        self.num_pods_failed = 0
+
+    def api_call(self):
+        """Simulate the latency and the failures of an API call"""
+        with self.lock:
+            self.num_api_calls += 1
+        if self.api_latency:
+            time.sleep(self.api_latency * random.uniform(0.5, 1.5))
+        if self.api_failure_rate and random.random() < self.api_failure_rate:
+            raise ApiException(status=500, reason='simulated API failure')
+
+    def get(self, kind, namespace=None, name=None, label_selector=None, field_selector=None):
+        self.api_call()
+        if kind == 'Event':
+            return dict(kind='EventList', apiVersion='v1', items=self.get_events(namespace, field_selector))
+        if field_selector:
+            raise ApiException(status=400, reason='field selectors are only supported for events')
+
+        with self.lock:
+            if name:
+                obj = self.objects.get((kind, namespace, name))
+                if not obj:
+                    raise ApiException(status=404, reason='%s %s not found' % (kind, name))
+                return self.render(obj)
+
+            items = [obj for (k, ns, _), obj in self.objects.items() if k == kind and ns == namespace]
+            if label_selector:
+                terms = parse_label_selector(label_selector)
+                items = [obj for obj in items if matches_label_selector(obj, terms)]
+            return dict(kind='%sList' % kind, apiVersion='v1', items=[self.render(obj) for obj in items])
+
+    def create(self, kind, namespace, body):
+        self.api_call()
+        now = time.time()
+        obj = copy.deepcopy(body)
+        obj['kind'] = kind
+        obj['metadata']['namespace'] = namespace
+        obj['metadata'].setdefault('uid', uuid.uuid4().hex)
+        obj['metadata']['creationTimestamp'] = format_k8s_timestamp(now)
+        with self.lock:
+            key = (kind, namespace, obj['metadata']['name'])
+            if key in self.objects:
+                raise ApiException(status=409, reason='%s %s already exists' % (kind, key[2]))
+            if namespace and ('Namespace', None, namespace) not in self.objects:
+                raise ApiException(status=404, reason='namespace %s not found' % namespace)
+            self.objects[key] = obj
+
+            if kind == 'Deployment':
+                # the deployment controller creates the pod right away
+                template = obj['spec']['template']
+                image = template['spec']['containers'][0]['image']
+                self.create_pod(namespace, '%s-%s' % (obj['metadata']['name'], uuid.uuid4().hex[:10]),
+                                template['metadata'].get('labels') or {}, image, now)
+            elif kind == 'Job':
+                obj['_simulation'] = dict(pod=None)
+                # suspended jobs get their pod when they are resumed
+                if not obj['spec'].get('suspend'):
+                    self.create_job_pod(obj, now)
+
+            return self.render(obj)
+
+    def patch(self, kind, namespace, name, body):
+        """Apply a JSON merge patch"""
+        self.api_call()
+        now = time.time()
+        with self.lock:
+            obj = self.objects.get((kind, namespace, name))
+            if not obj:
+                raise ApiException(status=404, reason='%s %s not found' % (kind, name))
+            merge_patch(obj, body)
+            if kind == 'Job' and not obj['spec'].get('suspend') and not obj['_simulation']['pod']:
+                self.create_job_pod(obj, now)
+            return self.render(obj)
+
+    def create_job_pod(self, job, now):
+        """Create the pod of a job, remembering the PVCs it mounts. Needs the lock."""
+        template = job['spec']['template']
+        labels = dict(template['metadata'].get('labels') or {}, **{'job-name': job['metadata']['name']})
+        image = template['spec']['containers'][0]['image']
+        pod = self.create_pod(job['metadata']['namespace'], '%s-%s' % (job['metadata']['name'], uuid.uuid4().hex[:5]),
+                              labels, image, now)
+        pod['_simulation']['pvc_names'] = [
+            v['persistentVolumeClaim']['claimName'] for v in template['spec'].get('volumes') or []
+            if 'persistentVolumeClaim' in v
+        ]
+        job['_simulation']['pod'] = pod['metadata']['name']
+
+    def create_pod(self, namespace, name, labels, image, now):
+        """Create a pod with a simulated startup. Needs the lock."""
+        if image not in self.image_ready_ts:
+            self.image_ready_ts[image] = now + self.image_pull_time
+        image_ready_ts = self.image_ready_ts[image]
+        pod = dict(
+            kind='Pod',
+            apiVersion='v1',
+            metadata=dict(name=name, namespace=namespace, labels=labels, creationTimestamp=format_k8s_timestamp(now)),
+            spec=dict(containers=[dict(name='pebbles-session', image=image)]),
+            _simulation=dict(
+                created_ts=now,
+                image_ready_ts=image_ready_ts,
+                ready_ts=max(now, image_ready_ts) + self.pod_startup_time * random.uniform(0.5, 1.5),
+                failed=random.random() < self.pod_failure_rate,
+            )
+        )
+        self.objects[('Pod', namespace, name)] = pod
+        self.num_pods_created += 1
+        if pod['_simulation']['failed']:
+            self.num_pods_failed += 1
+        return pod
+
+    def delete(self, kind, namespace=None, name=None, label_selector=None):
+        self.api_call()
+        with self.lock:
+            if name:
+                keys = [(kind, namespace, name)]
+                if keys[0] not in self.objects:
+                    raise ApiException(status=404, reason='%s %s not found' % (kind, name))
+            else:
+                terms = parse_label_selector(label_selector or '')
+                keys = [key for key, obj in self.objects.items()
+                        if key[0] == kind and key[1] == namespace and matches_label_selector(obj, terms)]
+
+            for key in keys:
+                obj = self.objects.pop(key)
+                if kind == 'Deployment':
+                    # the pods go with the deployment
+                    terms = [(k, {v}) for k, v in obj['spec']['selector']['matchLabels'].items()]
+                    for pod_key in [k for k, o in self.objects.items()
+                                    if k[0] == 'Pod' and k[1] == namespace and matches_label_selector(o, terms)]:
+                        del self.objects[pod_key]
+                elif kind == 'Namespace':
+                    for ns_key in [k for k in self.objects.keys() if k[1] == key[2]]:
+                        del self.objects[ns_key]
+
+        return dict(kind='Status', apiVersion='v1', status='Success')
+
+    def render(self, obj):
+        """Return a copy of the object with the simulated status at this moment. Needs the lock."""
+        res = {k: copy.deepcopy(v) for k, v in obj.items() if k != '_simulation'}
+        now = time.time()
+        if obj['kind'] == 'Pod':
+            sim = obj['_simulation']
+            running = not sim['failed'] and now >= sim['ready_ts']
+            if 'job-name' in obj['metadata']['labels']:
+                phase = ('Failed' if sim['failed'] else 'Succeeded') if now >= sim['ready_ts'] else 'Pending'
+            else:
+                phase = 'Running' if running else 'Pending'
+            res['status'] = dict(
+                phase=phase,
+                containerStatuses=[dict(name='pebbles-session', ready=running)],
+            )
+        elif obj['kind'] == 'Job':
+            pod_name = obj['_simulation']['pod']
+            pod = self.objects.get(('Pod', obj['metadata']['namespace'], pod_name)) if pod_name else None
+            status = {}
+            if pod and now >= pod['_simulation']['ready_ts']:
+                failed = pod['_simulation']['failed']
+                status['failed' if failed else 'succeeded'] = 1
+                status['conditions'] = [dict(type='Failed' if failed else 'Complete', status='True')]
+            res['status'] = status
+        elif obj['kind'] == 'PersistentVolumeClaim':
+            res['status'] = dict(phase='Bound')
+        return res
+
+    def get_events(self, namespace, field_selector):
+        """Generate the events the kubelet would have posted for a pod by now"""
+        match = re.fullmatch(r'involvedObject.name=(.+)', field_selector or '')
+        if not match:
+            raise ApiException(status=400, reason='unsupported field selector "%s"' % field_selector)
+        with self.lock:
+            pod = self.objects.get(('Pod', namespace, match.group(1)))
+            if not pod:
+                return []
+            sim = pod['_simulation']
+            image = pod['spec']['containers'][0]['image']
+        now = time.time()
+        events = [(sim['created_ts'], 'Successfully assigned %s/%s' % (namespace, match.group(1)))]
+        if sim['failed']:
+            events.append((sim['created_ts'], 'Failed to pull image "%s"' % image))
+        elif now < sim['image_ready_ts']:
+            events.append((sim['created_ts'], 'Pulling image "%s"' % image))
+        else:
+            events.append((max(sim['created_ts'], sim['image_ready_ts']), 'Created container pebbles-session'))
+        return [
+            dict(kind='Event', apiVersion='v1', metadata=dict(name='%s.%d' % (match.group(1), i)),
+                 firstTimestamp=format_k8s_timestamp(ts), message=message)
+            for i, (ts, message) in enumerate(events)
+        ]
+
+    def get_pod_logs(self, namespace, pod_name):
+        self.api_call()
+        with self.lock:
+            pod = self.objects.get(('Pod', namespace, pod_name))
+            if not pod:
+                raise ApiException(status=404, reason='pod %s not found' % pod_name)
+            if pod['metadata']['labels'].get('workspace-backup') != 'true':
+                return 'simulated log of pod %s\n' % pod_name
+            # the workspace backup pods report the status of each volume they mount
+            status = 'failed' if pod['_simulation']['failed'] else 'ok'
+            return ''.join('volume-backup-status %s %s\n' % (name, status) for name in pod['_simulation']['pvc_names'])
+
+
+class SimulatedResource:
+    """Stand-in for a dynamic client resource, e.g. dynamic_client.resources.get(api_version='v1', kind='Pod')"""
+
+    def __init__(self, cluster, api_version, kind):
+        self.cluster = cluster
+        self.api_version = api_version
+        self.kind = kind
+
+    def get(self, name=None, namespace=None, label_selector=None, field_selector=None):
+        namespace = None if self.kind in CLUSTER_SCOPED_KINDS else namespace
+        with time_driver_call('get', self.kind):
+            res = self.cluster.get(self.kind, namespace, name, label_selector, field_selector)
+        return ResourceInstance(self, res)
+
+    def create(self, body, namespace=None):
+        namespace = None if self.kind in CLUSTER_SCOPED_KINDS else namespace
+        body = dict(body, apiVersion=self.api_version)
+        with time_driver_call('create', self.kind):
+            return ResourceInstance(self, self.cluster.create(self.kind, namespace, body))
+
+    def patch(self, body, name=None, namespace=None, content_type=None):
+        namespace = None if self.kind in CLUSTER_SCOPED_KINDS else namespace
+        if content_type != 'application/merge-patch+json':
+            raise ApiException(status=415, reason='only merge patches are supported')
+        with time_driver_call('patch', self.kind):
+            return ResourceInstance(self, self.cluster.patch(self.kind, namespace, name, body))
+
+    def delete(self, name=None, namespace=None, label_selector=None):
+        namespace = None if self.kind in CLUSTER_SCOPED_KINDS else namespace
+        with time_driver_call('delete', self.kind):
+            return ResourceInstance(self, self.cluster.delete(self.kind, namespace, name, label_selector))
+
+
+class SimulatedResources:
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def get(self, api_version, kind):
+        return SimulatedResource(self.cluster, api_version, kind)
+
+
+class SimulatedDynamicClient:
+    """The subset of the openshift/kubernetes DynamicClient interface that the Kubernetes drivers use"""
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.resources = SimulatedResources(cluster)
+
+    def request(self, method, path):
+        match = re.fullmatch(r'/api/v1/namespaces/([^/]+)/pods/([^/?]+)/log(\?.*)?', path)
+        if method != 'GET' or not match:
+            raise ApiException(status=404, reason='unsupported request %s %s' % (method, path))
+        return self.cluster.get_pod_logs(match.group(1), match.group(2))
+
+
+class SimulatedKubernetesDriver(KubernetesDriverBase):
+    def create_kube_client(self):
+        return None
+
+    def connect(self):
+        self.dynamic_client = SimulatedDynamicClient(get_simulated_cluster(self.cluster_config))
+        self.test_connection()
+
+    def test_connection(self):
+        self.dynamic_client.cluster.api_call()
@@ -0,0 +1,130 @@
+"""Gunicorn configuration for the API server.
+
+Used by deployment/run_gunicorn.bash with 'gunicorn --config python:pebbles.gunicorn_config'. The settings come from
+the GUNICORN_* variables in pebbles.config, so they can be tuned per deployment with PB_ environment variables.
+
+The default worker class is gthread: a few processes with a number of threads each. A request that blocks on I/O, like
+an SSO login waiting for the identity provider or a long-polling change feed client, only ties up one thread instead of
+the whole process. The number of processes is derived from the CPUs available to the container, taking the CPU limit
+into account.
+
+Long-lived requests need gthread or gevent. The application session event stream holds its connection for up to five
+minutes, which would take a whole sync worker and get it killed by the worker timeout, so the config refuses to start
+sync workers with the stream enabled. With gthread the timeout only applies to the worker main loop, and each stream
+holds one thread, so the streams per process are capped (APPLICATION_SESSION_STREAM_MAX_PER_PROCESS, half of the threads
+by default) and a warning is logged at startup when they do not leave enough threads for the other requests.
+
+With preload_app the app is created once in the master process and the workers are forked from it, which makes the
+workers start faster and share memory. SQLAlchemy connection pools must not be shared between processes, so each
+worker discards the connections inherited from the master right after the fork.
+"""
+import math
+import os
+
+from pebbles.config import RuntimeConfig, application_session_stream_max_per_process
+
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_V1_CPU_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_V1_CPU_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+
+
+def cgroup_cpu_limit():
+    """CPU limit of the container from cgroup v2 or v1, None if there is no limit"""
+    try:
+        with open(CGROUP_V2_CPU_MAX) as f:
+            quota, period = f.read().split()
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(CGROUP_V1_CPU_QUOTA) as f:
+            quota = int(f.read())
+        with open(CGROUP_V1_CPU_PERIOD) as f:
+            period = int(f.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    """Number of CPUs the process can use, rounded up from the container CPU limit"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    cpu_limit = cgroup_cpu_limit()
+    if cpu_limit:
+        cpus = min(cpus, math.ceil(cpu_limit))
+    return max(cpus, 1)
+
+
+def default_workers(worker_class, cpus):
+    """Number of worker processes for the worker class and the CPUs"""
+    if worker_class == 'sync':
+        # sync workers handle one request at a time, the classic formula keeps the CPUs busy while some wait for I/O
+        return 2 * cpus + 1
+    # threads and greenlets take care of the I/O concurrency, the processes share the CPU bound work. Keep at least
+    # two, so that a restarting worker does not take the whole pod out.
+    return max(cpus, 2)
+
+
+def check_stream_config(config, worker_class, threads):
+    """Check the application session stream settings against the worker settings. Raises RuntimeError for settings
+    that do not work, returns a warning message for settings that starve the other requests, None if they are fine."""
+    if not config.APPLICATION_SESSION_STREAM_ENABLED:
+        return None
+    if worker_class == 'sync':
+        raise RuntimeError(
+            'sync workers cannot serve the application session stream, use gthread or gevent workers or set '
+            'PB_APPLICATION_SESSION_STREAM_ENABLED=false')
+    max_streams = application_session_stream_max_per_process(config)
+    if worker_class == 'gthread' and (not max_streams or max_streams > threads // 2):
+        return 'APPLICATION_SESSION_STREAM_MAX_PER_PROCESS %s leaves too few of the %d threads for other requests' % (
+            max_streams or 'unlimited', threads)
+    return None
+
+
+def dispose_db_engines(flask_app):
+    """Discard the database connections inherited from the master process. The pools open new ones in the worker."""
+    from pebbles.app import db
+    with flask_app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+runtime_config = RuntimeConfig()
+
+bind = '0.0.0.0:8080'
+worker_class = runtime_config.GUNICORN_WORKER_CLASS
+workers = runtime_config.GUNICORN_WORKERS or default_workers(worker_class, available_cpus())
+# gunicorn turns sync workers with threads into gthread workers, so only gthread gets the threads
+threads = runtime_config.GUNICORN_THREADS if worker_class == 'gthread' else 1
+worker_connections = runtime_config.GUNICORN_WORKER_CONNECTIONS
+preload_app = runtime_config.GUNICORN_PRELOAD_APP
+timeout = runtime_config.GUNICORN_TIMEOUT
+graceful_timeout = runtime_config.GUNICORN_GRACEFUL_TIMEOUT
+keepalive = runtime_config.GUNICORN_KEEPALIVE
+# the worker heartbeat files are touched often, keep them in memory instead of the container overlay filesystem
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+stream_config_warning = check_stream_config(runtime_config, worker_class, threads)
+
+
+def on_starting(server):
+    if stream_config_warning:
+        server.log.warning(stream_config_warning)
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        dispose_db_engines(worker.app.wsgi())
+    if server.cfg.worker_class_str == 'gevent':
+        # make psycopg2 cooperative, otherwise a query blocks all greenlets of the worker
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def child_exit(server, worker):
+    # remove the metrics of the worker from the shared multiprocess metrics directory, see pebbles.metrics
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -4,65 +4,67 @@ import sys
 
 from pebbles.client import PBClient
 from pebbles.config import RuntimeConfig
-from pebbles.models import Workspace
 from pebbles.utils import init_logging
 
 # Grace period to keep workspaces after expiry
 WORKSPACE_EXPIRY_GRACE_PERIOD = 3600 * 24 * 180
+# number of workspaces deleted in one API call, the API limit is WORKSPACE_BULK_STATUS_CHANGE_LIMIT
+WORKSPACE_EXPIRY_CLEANUP_BATCH_SIZE = 100
 
 
 def run_workspace_expiry_cleanup(pb_client):
     """Deletes expired workspaces that are beyond their grace period"""
     logging.info('workspace expiry cleanup starting')
-    current_time = datetime.datetime.utcnow().timestamp()
-    res = pb_client.do_get('workspaces')
+    expiry_limit = datetime.datetime.utcnow().timestamp() - WORKSPACE_EXPIRY_GRACE_PERIOD
+    res = pb_client.do_get('workspaces?expired_before=%d' % expiry_limit)
     if res.status_code != 200:
         msg = 'Got error %d: %s when listing workspaces' % (res.status_code, res.json() if res.json else res.text)
         logging.warning(msg)
         raise RuntimeError(msg)
 
-    workspaces = res.json()
-    expired_workspaces_beyond_grace = [
-        workspace for workspace in workspaces
-        if workspace['expiry_ts']
-        if not workspace['name'].startswith('System')
-        if workspace['expiry_ts'] + WORKSPACE_EXPIRY_GRACE_PERIOD < current_time]
-    for ws in expired_workspaces_beyond_grace:
-        pb_client.delete_workspace(ws.get('id'))
-        logging.info(
-            'workspace deleted: id %s, name "%s", expiry time %s',
-            ws.get('id'),
-            ws.get('name'),
-            datetime.datetime.fromtimestamp(ws.get('expiry_ts')).isoformat('_', timespec='seconds'))
+    workspace_ids = res.json()
+    for i in range(0, len(workspace_ids), WORKSPACE_EXPIRY_CLEANUP_BATCH_SIZE):
+        batch = workspace_ids[i:i + WORKSPACE_EXPIRY_CLEANUP_BATCH_SIZE]
+        res = pb_client.do_patch('workspaces', json_data=dict(workspace_ids=batch, status='deleted'))
+        if res.status_code != 200:
+            msg = 'Got error %d: %s when deleting workspaces' % (
+                res.status_code, res.json() if res.json else res.text)
+            logging.warning(msg)
+            raise RuntimeError(msg)
+        logging.info('workspaces deleted: %s', ', '.join(batch))
 
-    logging.info('workspace expiry cleanup done')
+    logging.info('workspace expiry cleanup done, %d workspaces deleted', len(workspace_ids))
 
 
 def run_membership_expiry_cleanup(pb_client):
-    """Deletes expired workspace memberships by
-        - listing workspaces with matching policy
-        - asking API to clean up the mappings
-    """
+    """Deletes expired workspace memberships in all workspaces with an activity timeout policy with one API call"""
     logging.info('membership expiry cleanup starting')
-    # fetch workspaces with activity timeout policy
-    workspaces = pb_client.do_get('workspaces?membership_expiry_policy_kind=%s' % Workspace.MEP_ACTIVITY_TIMEOUT).json()
-    for ws in workspaces:
-        res = pb_client.do_post('workspaces/%s/clear_expired_members' % ws.get('id'))
-        if res.status_code == 200:
-            if res.json().get('num_deleted'):
-                logging.info(
-                    '%d members removed from workspace %s "%s"',
-                    res.json().get('num_deleted'),
-                    ws.get('id'),
-                    ws.get('name'))
-        else:
-            logging.warning(
-                'Got error %d: %s from workspaces/%s/clear_expired_members',
-                res.status_code,
-                res.json().get('error') if res.json else res.text,
-                ws.get('id'))
-
-    logging.info('membership expiry cleanup done')
+    res = pb_client.do_post('workspaces/clear_expired_members')
+    if res.status_code != 200:
+        msg = 'Got error %d: %s from workspaces/clear_expired_members' % (
+            res.status_code, res.json().get('error') if res.json else res.text)
+        logging.warning(msg)
+        raise RuntimeError(msg)
+
+    for ws_id, num_deleted in res.json().get('workspaces').items():
+        logging.info('%d members removed from workspace %s', num_deleted, ws_id)
+
+    logging.info('membership expiry cleanup done, %d members removed', res.json().get('num_deleted'))
+
+
+def run_alert_retention(pb_client):
+    """Compacts old archived alerts into daily alert history and purges old history"""
+    logging.info('alert retention starting')
+    res = pb_client.do_post('alerts/compact')
+    if res.status_code != 200:
+        msg = 'Got error %d: %s when compacting alerts' % (res.status_code, res.json() if res.json else res.text)
+        logging.warning(msg)
+        raise RuntimeError(msg)
+
+    logging.info(
+        'alert retention done, %d alerts compacted, %d history entries purged',
+        res.json().get('num_compacted'),
+        res.json().get('num_history_purged'))
 
 
 if __name__ == '__main__':
@@ -79,6 +81,8 @@ if __name__ == '__main__':
             run_workspace_expiry_cleanup(client)
         if 'run_membership_expiry_cleanup' in sys.argv:
             run_membership_expiry_cleanup(client)
+        if 'run_alert_retention' in sys.argv:
+            run_alert_retention(client)
     except Exception as e:
         logging.critical('maintenance job exiting due to an error', exc_info=e)
         sys.exit(1)
@@ -0,0 +1,171 @@
+"""Prometheus metrics for the API and the worker.
+
+The API reports request latencies by endpoint and status, the database connection pool usage and the hit rate of the
+workspace role caches used in permission checks. The metrics are served on /metrics.
+
+The worker reports the duration of its loops, the sessions processed per state, the outcome of session lock attempts
+(a conflict means another worker got the lock first), the latency of Kubernetes API calls by verb and kind, and the
+time from session creation to RUNNING. The worker serves the metrics on its own HTTP listener, see WORKER_METRICS_PORT.
+
+prometheus_client is an optional dependency. Without it nothing is collected and /metrics responds with 404.
+
+Every gunicorn worker process has its own metrics. To aggregate them, point PROMETHEUS_MULTIPROC_DIR to a directory
+shared by the processes, as described in the prometheus_client documentation. The pool usage is not reported then.
+"""
+import contextlib
+import datetime
+import logging
+import os
+import time
+
+try:
+    import prometheus_client
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+API_REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DRIVER_CALL_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+WORKER_LOOP_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TIME_TO_RUNNING_BUCKETS = (5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600, 1200)
+
+LOCK_OBTAINED = 'obtained'
+LOCK_CONFLICT = 'conflict'
+LOCK_SKIPPED = 'skipped'
+
+
+class DatabasePoolCollector:
+    """Reports the connection pool usage of the app in the current context at scrape time"""
+
+    def collect(self):
+        # imported here, the worker uses this module too and has no use for Flask or SQLAlchemy
+        from flask import has_app_context
+        from sqlalchemy.pool import QueuePool
+        if not has_app_context():
+            return
+        from pebbles.models import db
+        pool = db.engine.pool
+        if not isinstance(pool, QueuePool):
+            return
+        gauge = GaugeMetricFamily(
+            'pebbles_api_db_pool_connections', 'Connections in the database connection pool', labels=['state'])
+        gauge.add_metric(['checked_out'], pool.checkedout())
+        gauge.add_metric(['idle'], pool.checkedin())
+        gauge.add_metric(['overflow'], max(pool.overflow(), 0))
+        gauge.add_metric(['size'], pool.size())
+        yield gauge
+
+
+if prometheus_client:
+    API_REQUEST_DURATION = prometheus_client.Histogram(
+        'pebbles_api_request_duration_seconds', 'API request latency',
+        ['endpoint', 'method', 'status'], buckets=API_REQUEST_BUCKETS)
+    AUTH_CACHE_LOOKUPS = prometheus_client.Counter(
+        'pebbles_api_auth_cache_lookups', 'Workspace role cache lookups in permission checks', ['cache', 'result'])
+    WORKER_LOOP_DURATION = prometheus_client.Histogram(
+        'pebbles_worker_loop_duration_seconds', 'Duration of worker loop rounds', ['loop'],
+        buckets=WORKER_LOOP_BUCKETS)
+    WORKER_SESSIONS_PROCESSED = prometheus_client.Counter(
+        'pebbles_worker_sessions_processed', 'Application sessions processed by the worker', ['state'])
+    WORKER_LOCK_ATTEMPTS = prometheus_client.Counter(
+        'pebbles_worker_session_lock_attempts', 'Application session lock attempts by outcome', ['result'])
+    DRIVER_CALL_DURATION = prometheus_client.Histogram(
+        'pebbles_driver_call_duration_seconds', 'Kubernetes API call latency', ['verb', 'kind'],
+        buckets=DRIVER_CALL_BUCKETS)
+    SESSION_TIME_TO_RUNNING = prometheus_client.Histogram(
+        'pebbles_session_time_to_running_seconds', 'Time from application session creation to RUNNING',
+        buckets=TIME_TO_RUNNING_BUCKETS)
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        prometheus_client.REGISTRY.register(DatabasePoolCollector())
+
+
+def metrics_enabled():
+    return prometheus_client is not None
+
+
+def init_api_metrics(app):
+    """Record the latency of each API request and serve the metrics on /metrics"""
+    from flask import g, request
+
+    if not metrics_enabled():
+        logging.info('prometheus_client not installed, metrics are disabled')
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_request_start_ts = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start_ts = g.pop('metrics_request_start_ts', None)
+        if metrics_enabled() and start_ts is not None:
+            # use the route pattern, not the path, to keep the number of label values bounded
+            endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+            API_REQUEST_DURATION.labels(endpoint, request.method, response.status_code).observe(
+                time.perf_counter() - start_ts)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if not (metrics_enabled() and app.config['METRICS_ENABLED']):
+            return 'metrics not available', 404
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            from prometheus_client import multiprocess
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = prometheus_client.REGISTRY
+        return prometheus_client.generate_latest(registry), 200, {'Content-Type': prometheus_client.CONTENT_TYPE_LATEST}
+
+
+def start_worker_metrics_listener(port):
+    """Serve the worker metrics over HTTP on the given port. Port 0 disables the listener."""
+    if not (metrics_enabled() and port):
+        return
+    try:
+        prometheus_client.start_http_server(int(port))
+        logging.info('serving metrics on port %s', port)
+    except OSError as e:
+        logging.warning('unable to serve metrics on port %s: %s', port, e)
+
+
+def count_auth_cache_lookup(cache, hit):
+    if metrics_enabled():
+        AUTH_CACHE_LOOKUPS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+@contextlib.contextmanager
+def time_worker_loop(loop):
+    start_ts = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics_enabled():
+            WORKER_LOOP_DURATION.labels(loop).observe(time.perf_counter() - start_ts)
+
+
+def count_session_processed(state):
+    if metrics_enabled():
+        WORKER_SESSIONS_PROCESSED.labels(state).inc()
+
+
+def count_lock_attempt(result):
+    if metrics_enabled():
+        WORKER_LOCK_ATTEMPTS.labels(result).inc()
+
+
+@contextlib.contextmanager
+def time_driver_call(verb, kind):
+    start_ts = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics_enabled():
+            DRIVER_CALL_DURATION.labels(verb, kind).observe(time.perf_counter() - start_ts)
+
+
+def observe_time_to_running(application_session):
+    """Record the time from creation to now for a session that just became ready"""
+    if not (metrics_enabled() and application_session.get('created_at')):
+        return
+    created_at = datetime.datetime.fromisoformat(application_session['created_at']).replace(tzinfo=None)
+    SESSION_TIME_TO_RUNNING.observe((datetime.datetime.utcnow() - created_at).total_seconds())
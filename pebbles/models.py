@@ -1,5 +1,4 @@
 import datetime
-import hashlib
 import importlib
 import inspect
 import json
@@ -14,13 +13,19 @@ from pathlib import Path
 import yaml
 from jose import jwt, JWTError, ExpiredSignatureError
 from jose.exceptions import JWTClaimsError, JWSError
-from sqlalchemy import func
+from sqlalchemy import event, func, inspect as sa_inspect, select, text, tuple_, Float
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.mutable import MutableDict, MutableList
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.hybrid import hybrid_property, Comparator
 from sqlalchemy.schema import MetaData
+from sqlalchemy.sql.expression import FunctionElement
 
 import pebbles
 from pebbles.app import db, bcrypt
-from pebbles.utils import get_application_fields_from_config, read_list_from_text_file
+from pebbles.states import ApplicationSessionStates, TaskStates
+from pebbles.utils import generate_alert_id, get_application_fields_from_config, read_list_from_text_file
 
 PEBBLES_TAINT_KEY = 'pebbles.csc.fi/taint'
 
@@ -57,6 +62,18 @@ class CaseInsensitiveComparator(Comparator):
         return func.lower(self.__clause_element__()) == func.lower(other)
 
 
+def json_type():
+    """JSON column type: native JSONB on PostgreSQL, JSON serialized in a text column elsewhere. None is stored as
+    NULL. The value is parsed once when loaded and kept on the instance."""
+    return db.JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), 'postgresql')
+
+
+# JSON object/array column types that also track in-place modifications of the top level.
+# Each needs a type instance of its own, as_mutable() associates itself with the instance.
+JSONDict = MutableDict.as_mutable(json_type())
+JSONList = MutableList.as_mutable(json_type())
+
+
 def load_column(column):
     try:
         value = json.loads(column)
@@ -65,6 +82,50 @@ def load_column(column):
     return value
 
 
+def acquire_advisory_lock(key):
+    """Take a transaction scoped advisory lock on the given key. The lock is released at commit or rollback.
+    Only PostgreSQL supports advisory locks, on other databases this is a no-op."""
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    db.session.execute(select(func.pg_advisory_xact_lock(func.hashtext(key))))
+
+
+class seconds_between(FunctionElement):
+    """SQL expression for the duration between two DateTime expressions in seconds"""
+    type = Float()
+    inherit_cache = True
+    name = 'seconds_between'
+
+
+@compiles(seconds_between)
+def compile_seconds_between(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return 'EXTRACT(EPOCH FROM (%s - %s))' % (compiler.process(end, **kw), compiler.process(start, **kw))
+
+
+@compiles(seconds_between, 'sqlite')
+def compile_seconds_between_sqlite(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return "(CAST(strftime('%%s', %s) AS REAL) - CAST(strftime('%%s', %s) AS REAL))" % (
+        compiler.process(end, **kw), compiler.process(start, **kw))
+
+
+class year_month(FunctionElement):
+    """SQL expression for formatting a DateTime expression as 'YYYY-MM'"""
+    inherit_cache = True
+    name = 'year_month'
+
+
+@compiles(year_month)
+def compile_year_month(element, compiler, **kw):
+    return "to_char(%s, 'YYYY-MM')" % compiler.process(element.clauses, **kw)
+
+
+@compiles(year_month, 'sqlite')
+def compile_year_month_sqlite(element, compiler, **kw):
+    return "strftime('%%Y-%%m', %s)" % compiler.process(element.clauses, **kw)
+
+
 class User(db.Model):
     __tablename__ = 'users'
 
@@ -114,6 +175,21 @@ class User(db.Model):
         if workspace_quota:
             self.workspace_quota = workspace_quota
 
+    @staticmethod
+    def insert_values(ext_id, password_hash, email_id=None, expiry_ts=None):
+        """Column values for inserting a user in bulk with insert(User). The password has to be hashed already, see
+        pebbles.utils.hash_passwords()."""
+        return dict(
+            id=uuid.uuid4().hex,
+            _ext_id=ext_id.lower(),
+            _email_id=email_id.lower() if email_id else None,
+            pseudonym=''.join(secrets.choice(string.ascii_lowercase + string.digits) for _ in range(8)),
+            password=password_hash,
+            is_active=True,
+            _joining_ts=datetime.datetime.fromtimestamp(time.time()),
+            _expiry_ts=datetime.datetime.fromtimestamp(expiry_ts) if expiry_ts else None,
+        )
+
     def __eq__(self, other):
         return self.id == other.id
 
@@ -219,15 +295,19 @@ class User(db.Model):
         if self.can_login():
             return bcrypt.check_password_hash(self.password, password)
 
-    def generate_auth_token(self, app_secret, expires_in=43200):
+    def generate_auth_token(self, app_secret, expires_in=43200, scope=None):
         ts = int(time.time())
         # construct a token with user id in the claims and issue + expiration times in the header
+        claims = dict(
+            id=self.id,
+            iat=ts,
+            exp=ts + expires_in,
+        )
+        # a scoped token is only accepted where that scope is asked for, not as a general API token
+        if scope:
+            claims['scope'] = scope
         token = jwt.encode(
-            claims=dict(
-                id=self.id,
-                iat=ts,
-                exp=ts + expires_in,
-            ),
+            claims=claims,
             key=app_secret,
             algorithm=JWS_SIGNING_ALG
         )
@@ -243,7 +323,7 @@ class User(db.Model):
         return [wm for wm in self.workspace_memberships if wm.is_manager and wm.workspace.status == 'active']
 
     @staticmethod
-    def verify_auth_token(token, app_secret):
+    def verify_auth_token(token, app_secret, scope=None):
         if not token:
             return None
         try:
@@ -256,6 +336,10 @@ class User(db.Model):
             logging.warning('Possible hacking attempt "%s" with token "%s"', e, token)
             return None
 
+        if data.get('scope') != scope:
+            logging.warning('Token with scope "%s" used for scope "%s"', data.get('scope'), scope)
+            return None
+
         user = User.query.filter_by(id=data['id']).first()
         if user and user.can_login():
             return user
@@ -277,7 +361,8 @@ class User(db.Model):
 class WorkspaceMembership(db.Model):
     __tablename__ = 'workspace_memberships'
     workspace_id = db.Column(db.String(32), db.ForeignKey('workspaces.id'), primary_key=True)
-    user_id = db.Column(db.String(32), db.ForeignKey('users.id'), primary_key=True)
+    # the composite primary key starts with workspace_id, so lookups by user need a separate index
+    user_id = db.Column(db.String(32), db.ForeignKey('users.id'), primary_key=True, index=True)
     is_manager = db.Column(db.Boolean, default=False)
     is_owner = db.Column(db.Boolean, default=False)
     is_banned = db.Column(db.Boolean, default=False)
@@ -327,7 +412,7 @@ class Workspace(db.Model):
     _membership_join_policy = db.Column('membership_join_policy', db.Text)
     application_quota = db.Column(db.Integer, default=10)
     memory_limit_gib = db.Column(db.Integer, default=50)
-    _config = db.Column('config', db.Text)
+    _config = db.Column('config', JSONDict)
     contact = db.Column(db.String(64))
 
     applications = db.relationship('Application', backref='workspace', lazy='dynamic')
@@ -396,11 +481,11 @@ class Workspace(db.Model):
 
     @hybrid_property
     def config(self):
-        return load_column(self._config)
+        return self._config if self._config is not None else {}
 
     @config.setter
     def config(self, value):
-        self._config = json.dumps(value)
+        self._config = value
 
     @hybrid_property
     def membership_expiry_policy(self):
@@ -557,16 +642,22 @@ class Application(db.Model):
     )
 
     __tablename__ = 'applications'
+    __table_args__ = (
+        # containment queries on labels, e.g. labels @> '["python"]'
+        db.Index(
+            'ix_applications_labels', 'labels', postgresql_using='gin', postgresql_ops={'labels': 'jsonb_path_ops'}
+        ).ddl_if(dialect='postgresql'),
+    )
     id = db.Column(db.String(32), primary_key=True)
     name = db.Column(db.String(MAX_NAME_LENGTH))
     description = db.Column(db.Text)
     template_id = db.Column(db.String(32), db.ForeignKey('application_templates.id'))
     workspace_id = db.Column(db.String(32), db.ForeignKey('workspaces.id'))
-    _labels = db.Column('labels', db.Text)
+    _labels = db.Column('labels', JSONList)
     application_type = db.Column(db.String(MAX_NAME_LENGTH))
     maximum_lifetime = db.Column(db.Integer)
-    _base_config = db.Column('base_config', db.Text)
-    _config = db.Column('config', db.Text)
+    _base_config = db.Column('base_config', JSONDict)
+    _config = db.Column('config', JSONDict)
     _attribute_limits = db.Column('attribute_limits', db.Text)
     is_enabled = db.Column(db.Boolean, default=False)
     expiry_time = db.Column(db.DateTime)
@@ -588,11 +679,11 @@ class Application(db.Model):
         self.is_enabled = is_enabled
         if not config:
             config = dict()
-        self._config = json.dumps(config)
+        self._config = config
         self._status = Application.STATUS_ACTIVE
         if not base_config:
             base_config = dict()
-        self._base_config = json.dumps(base_config)
+        self._base_config = base_config
         if not attribute_limits:
             attribute_limits = []
         self._attribute_limits = json.dumps(attribute_limits)
@@ -600,19 +691,19 @@ class Application(db.Model):
 
     @hybrid_property
     def base_config(self):
-        return load_column(self._base_config)
+        return self._base_config if self._base_config is not None else {}
 
     @base_config.setter
     def base_config(self, value):
-        self._base_config = json.dumps(value)
+        self._base_config = value
 
     @hybrid_property
     def config(self):
-        return load_column(self._config)
+        return self._config if self._config is not None else {}
 
     @config.setter
     def config(self, value):
-        self._config = json.dumps(value)
+        self._config = value
 
     @hybrid_property
     def attribute_limits(self):
@@ -624,11 +715,11 @@ class Application(db.Model):
 
     @hybrid_property
     def labels(self):
-        return json.loads(self._labels)
+        return self._labels
 
     @labels.setter
     def labels(self, value):
-        self._labels = json.dumps(value)
+        self._labels = value
 
     @hybrid_property
     def status(self):
@@ -654,29 +745,11 @@ class Application(db.Model):
         return self.name or "Unnamed application"
 
 
-class ApplicationSession(db.Model):
-    STATE_QUEUEING = 'queueing'
-    STATE_PROVISIONING = 'provisioning'
-    STATE_STARTING = 'starting'
-    STATE_RUNNING = 'running'
-    STATE_DELETING = 'deleting'
-    STATE_DELETED = 'deleted'
-    STATE_FAILED = 'failed'
-
-    VALID_STATES = (
-        STATE_QUEUEING,
-        STATE_PROVISIONING,
-        STATE_STARTING,
-        STATE_RUNNING,
-        STATE_DELETING,
-        STATE_DELETED,
-        STATE_FAILED,
-    )
-
+class ApplicationSession(ApplicationSessionStates, db.Model):
     __tablename__ = 'application_sessions'
     id = db.Column(db.String(32), primary_key=True)
-    user_id = db.Column(db.String(32), db.ForeignKey('users.id'))
-    application_id = db.Column(db.String(32), db.ForeignKey('applications.id'))
+    user_id = db.Column(db.String(32), db.ForeignKey('users.id'), index=True)
+    application_id = db.Column(db.String(32), db.ForeignKey('applications.id'), index=True)
     name = db.Column(db.String(64), unique=True)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     provisioned_at = db.Column(db.DateTime)
@@ -686,30 +759,113 @@ class ApplicationSession(db.Model):
     to_be_deleted = db.Column(db.Boolean, default=False)
     log_fetch_pending = db.Column(db.Boolean, default=False)
     error_msg = db.Column(db.String(256))
-    _provisioning_config = db.Column('provisioning_config', db.Text)
-    _session_data = db.Column('session_data', db.Text)
+    _provisioning_config = db.Column('provisioning_config', JSONDict)
+    _session_data = db.Column('session_data', JSONDict)
+    # denormalised copies of application and provisioning_config values for quota and accounting queries
+    workspace_id = db.Column(db.String(32), db.ForeignKey('workspaces.id'), index=True)
+    memory_gib = db.Column(db.Float)
+    cluster = db.Column(db.String(64), index=True)
+    # work queue for the workers, maintained by schedule_next_action() and back_off()
+    next_action_at = db.Column(db.DateTime, index=True)
+    backoff_count = db.Column(db.Integer, default=0)
+    # ledger of the first time the session reached each state or provisioning milestone, as epoch timestamps
+    _transitions = db.Column('transitions', JSONDict)
+
+    __table_args__ = (
+        # covers the workspace memory quota check
+        db.Index('ix_application_sessions_workspace_id_state_memory_gib', 'workspace_id', 'state', 'memory_gib'),
+        # the bulk of the table is deleted sessions, index only the live ones for the worker queries
+        db.Index(
+            'ix_application_sessions_live_state_to_be_deleted', 'state', 'to_be_deleted',
+            postgresql_where=text("state != 'deleted'"),
+            sqlite_where=text("state != 'deleted'"),
+        ),
+    )
+
+    BACKOFF_BASE_SECONDS = 2
+    BACKOFF_MAX_SECONDS = 30
+
+    # provisioning milestones in the transition ledger, reported by the drivers as provisioning log messages
+    MILESTONE_SCHEDULED = 'scheduled'
+    MILESTONE_IMAGE_PULLING = 'image_pulling'
+    MILESTONE_CONTAINER_STARTING = 'container_starting'
+    PROVISIONING_LOG_MILESTONES = {
+        'scheduled to a node': MILESTONE_SCHEDULED,
+        'pulling container image': MILESTONE_IMAGE_PULLING,
+        'starting': MILESTONE_CONTAINER_STARTING,
+    }
 
     def __init__(self, application, user):
         self.id = uuid.uuid4().hex
         self.application_id = application.id
+        self.workspace_id = application.workspace_id
         self.user_id = user.id
         self._state = ApplicationSession.STATE_QUEUEING
+        self.transitions = {ApplicationSession.STATE_QUEUEING: time.time()}
+
+    def record_transition(self, name, ts=None):
+        """Record the time the session reached a state or a milestone. Only the first time is kept, so that the
+        phase durations are not skewed by retries."""
+        if name not in self.transitions:
+            self.transitions = dict(self.transitions, **{name: ts if ts is not None else time.time()})
+
+    def schedule_next_action(self, maximum_lifetime=None):
+        """Set the time when a worker should next act on this session. Sessions that need no action get None."""
+        now = datetime.datetime.utcnow()
+        if self.state == ApplicationSession.STATE_DELETED:
+            self.next_action_at = None
+        elif self.to_be_deleted:
+            self.next_action_at = now
+        elif self.state in (ApplicationSession.STATE_QUEUEING, ApplicationSession.STATE_STARTING):
+            self.next_action_at = now
+        elif self.state == ApplicationSession.STATE_RUNNING and self.log_fetch_pending:
+            self.next_action_at = now
+        elif self.state == ApplicationSession.STATE_RUNNING and self.provisioned_at and maximum_lifetime:
+            # deprovision when the lifetime runs out
+            self.next_action_at = self.provisioned_at + datetime.timedelta(seconds=maximum_lifetime)
+        else:
+            self.next_action_at = None
+
+    def back_off(self):
+        """Postpone the next action with an exponentially increasing delay, e.g. when the session is not ready yet.
+        The delay is reset on the next state change."""
+        backoff_count = self.backoff_count or 0
+        delay = min(
+            ApplicationSession.BACKOFF_BASE_SECONDS * 2 ** backoff_count,
+            ApplicationSession.BACKOFF_MAX_SECONDS
+        )
+        self.backoff_count = backoff_count + 1
+        self.next_action_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
 
     @hybrid_property
     def session_data(self):
-        return load_column(self._session_data)
+        return self._session_data if self._session_data is not None else {}
 
     @session_data.setter
     def session_data(self, value):
-        self._session_data = json.dumps(value)
+        self._session_data = value
+
+    @hybrid_property
+    def transitions(self):
+        return self._transitions if self._transitions is not None else {}
+
+    @transitions.setter
+    def transitions(self, value):
+        self._transitions = value
 
     @hybrid_property
     def provisioning_config(self):
-        return load_column(self._provisioning_config)
+        return self._provisioning_config if self._provisioning_config is not None else {}
 
     @provisioning_config.setter
     def provisioning_config(self, value):
-        self._provisioning_config = json.dumps(value)
+        self._provisioning_config = value
+        try:
+            self.memory_gib = float(value['memory_gib']) if value.get('memory_gib') is not None else None
+        except ValueError:
+            logging.warning('invalid memory_gib "%s" in provisioning_config', value.get('memory_gib'))
+            self.memory_gib = None
+        self.cluster = value.get('cluster')
 
     @hybrid_property
     def state(self):
@@ -733,6 +889,24 @@ class ApplicationSession(db.Model):
         )
 
 
+@event.listens_for(ApplicationSession, 'before_insert')
+@event.listens_for(ApplicationSession, 'before_update')
+def reschedule_application_session(mapper, connection, target):
+    """Keep the work queue position of an application session in sync with its state"""
+    attrs = sa_inspect(target).attrs
+    if not any(attrs[key].history.has_changes() for key in
+               ('_state', 'to_be_deleted', 'log_fetch_pending', 'provisioned_at')):
+        return
+    if attrs['_state'].history.has_changes():
+        target.backoff_count = 0
+
+    maximum_lifetime = None
+    if target.state == ApplicationSession.STATE_RUNNING and target.provisioned_at:
+        maximum_lifetime = connection.scalar(
+            select(Application.maximum_lifetime).where(Application.id == target.application_id))
+    target.schedule_next_action(maximum_lifetime)
+
+
 class ApplicationSessionLog(db.Model):
     __tablename__ = 'application_session_logs'
     id = db.Column(db.String(32), primary_key=True)
@@ -765,14 +939,38 @@ class Lock(db.Model):
         self.acquired_at = datetime.datetime.utcnow()
 
 
+class WorkerHeartbeat(db.Model):
+    """Membership registry of the worker replicas, workers update their heartbeat periodically"""
+    __tablename__ = 'worker_heartbeats'
+
+    # heartbeats older than this are considered to belong to workers that are gone
+    HEARTBEAT_TTL = 60
+
+    id = db.Column(db.String(64), primary_key=True)
+    updated_at = db.Column(db.DateTime, index=True)
+
+    def __init__(self, id):
+        self.id = id
+        self.updated_at = datetime.datetime.utcnow()
+
+
 class Alert(db.Model):
     __tablename__ = 'alerts'
+    __table_args__ = (
+        db.Index('ix_alerts_target_source_status', 'target', 'source', 'status'),
+        # for SystemStatus: archived alerts accumulate, index only the ones that can raise a warning
+        db.Index(
+            'ix_alerts_active_status_last_seen_ts', 'status', 'last_seen_ts',
+            postgresql_where=text("status IN ('firing', 'ok')"),
+            sqlite_where=text("status IN ('firing', 'ok')"),
+        ),
+    )
 
     id = db.Column(db.String(64), primary_key=True)
     target = db.Column(db.String(64), nullable=False)
     source = db.Column(db.String(64), nullable=False)
     status = db.Column(db.String(64), nullable=False, index=True)
-    _data = db.Column('data', db.Text)
+    _data = db.Column('data', json_type())
     _first_seen_ts = db.Column('first_seen_ts', db.DateTime, default=datetime.datetime.utcnow)
     _last_seen_ts = db.Column('last_seen_ts', db.DateTime, default=datetime.datetime.utcnow)
 
@@ -783,10 +981,7 @@ class Alert(db.Model):
         self.status = status
         self.data = data
 
-    @staticmethod
-    def generate_alert_id(target, source, data):
-        id_bytes = target.encode() + source.encode() + json.dumps(data).encode()
-        return hashlib.sha3_224(id_bytes).hexdigest()
+    generate_alert_id = staticmethod(generate_alert_id)
 
     @hybrid_property
     def last_seen_ts(self):
@@ -806,50 +1001,112 @@ class Alert(db.Model):
 
     @hybrid_property
     def data(self):
-        return load_column(self._data)
+        return self._data if self._data is not None else {}
 
     @data.setter
     def data(self, value):
-        self._data = json.dumps(value)
+        self._data = value
 
 
-class Task(db.Model):
-    STATE_NEW = 'new'
-    STATE_PROCESSING = 'processing'
-    STATE_FINISHED = 'finished'
-    STATE_FAILED = 'failed'
+class AlertHistory(db.Model):
+    """Daily summary of archived alerts, the individual alerts are purged after compaction"""
+    __tablename__ = 'alert_history'
 
-    VALID_STATES = (
-        STATE_NEW,
-        STATE_PROCESSING,
-        STATE_FINISHED,
-        STATE_FAILED,
-    )
+    day = db.Column(db.Date, primary_key=True)
+    target = db.Column(db.String(64), primary_key=True)
+    source = db.Column(db.String(64), primary_key=True)
+    name = db.Column(db.String(256), primary_key=True)
+    num_alerts = db.Column(db.Integer, nullable=False, default=0)
+    first_seen_ts = db.Column(db.DateTime)
+    last_seen_ts = db.Column(db.DateTime)
 
-    KIND_WORKSPACE_VOLUME_BACKUP = 'workspace_volume_backup'
-    KIND_WORKSPACE_VOLUME_RESTORE = 'workspace_volume_restore'
 
-    VALID_KINDS = (
-        KIND_WORKSPACE_VOLUME_BACKUP,
-        KIND_WORKSPACE_VOLUME_RESTORE,
-    )
+class Task(TaskStates, db.Model):
+    PRIORITY_DEFAULT = 0
+    PRIORITY_HIGH = 10
+
+    # attempts before a task is marked failed, and the backoff between them
+    MAX_ATTEMPTS = 5
+    RETRY_BASE_SECONDS = 30
+    RETRY_MAX_SECONDS = 3600
 
     __tablename__ = 'tasks'
+    __table_args__ = (
+        db.Index('ix_tasks_state_kind', 'state', 'kind'),
+        # work queue order for claiming tasks
+        db.Index(
+            'ix_tasks_unfinished_priority_create_ts', 'priority', 'create_ts',
+            postgresql_where=text("state IN ('new', 'processing')"),
+            sqlite_where=text("state IN ('new', 'processing')"),
+        ),
+        # finished tasks accumulate, index only the ones the workers are still interested in
+        db.Index(
+            'ix_tasks_unfinished_kind_create_ts', 'kind', 'create_ts',
+            postgresql_where=text("state IN ('new', 'processing')"),
+            sqlite_where=text("state IN ('new', 'processing')"),
+        ),
+        # lookups by workspace in task data
+        db.Index('ix_tasks_data_workspace_id', text("(data ->> 'workspace_id')")).ddl_if(dialect='postgresql'),
+    )
 
     id = db.Column(db.String(64), primary_key=True)
     _kind = db.Column('kind', db.String(32), primary_key=True)
     _state = db.Column('state', db.String(32))
-    _data = db.Column('data', db.Text)
+    _data = db.Column('data', json_type())
     _create_ts = db.Column('create_ts', db.DateTime, default=datetime.datetime.utcnow)
     _complete_ts = db.Column('complete_ts', db.DateTime)
     _update_ts = db.Column('update_ts', db.DateTime, default=datetime.datetime.utcnow)
     _results = db.Column('results', db.Text)
-
-    def __init__(self, kind, state, data):
+    priority = db.Column(db.Integer, default=PRIORITY_DEFAULT, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    # tasks are not claimed before this, used for retry backoff and for spacing out job status checks
+    next_attempt_at = db.Column(db.DateTime)
+    # the worker that has claimed the task and until when
+    lease_owner = db.Column(db.String(64))
+    lease_expires_at = db.Column(db.DateTime)
+    # cluster the task runs Jobs in, copied from data for limiting concurrent Jobs per cluster
+    cluster = db.Column(db.String(64))
+
+    def __init__(self, kind, state, data, priority=PRIORITY_DEFAULT):
         self.id = uuid.uuid4().hex
         self.kind = kind
         self.state = state
         self.data = data
+        self.priority = priority
+        self.attempts = 0
+
+    @staticmethod
+    def insert_values(kind, state, data, priority=PRIORITY_DEFAULT):
+        """Column values for inserting a task in bulk with insert(Task), bypassing the ORM unit of work"""
+        if kind not in Task.VALID_KINDS:
+            raise ValueError("'%s' is not a valid kind for Task" % kind)
+        if state not in Task.VALID_STATES:
+            raise ValueError("'%s' is not a valid state for Task" % state)
+        return dict(
+            id=uuid.uuid4().hex,
+            _kind=kind,
+            _state=state,
+            _data=data,
+            priority=priority,
+            attempts=0,
+            cluster=data.get('cluster') or data.get('tgt_cluster'),
+        )
+
+    def release(self, delay=0):
+        """Release the lease and make the task available for claiming after delay seconds"""
+        self.lease_owner = None
+        self.lease_expires_at = None
+        self.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay) if delay else None
+
+    def fail_attempt(self):
+        """Record a failed attempt. Schedule a retry with exponential backoff, or mark the task failed if out of
+        attempts."""
+        self.attempts = (self.attempts or 0) + 1
+        if self.attempts >= Task.MAX_ATTEMPTS:
+            self.state = Task.STATE_FAILED
+            self.release()
+        else:
+            self.release(min(Task.RETRY_BASE_SECONDS * 2 ** (self.attempts - 1), Task.RETRY_MAX_SECONDS))
 
     @hybrid_property
     def kind(self):
@@ -885,11 +1142,13 @@ class Task(db.Model):
 
     @hybrid_property
     def data(self):
-        return load_column(self._data)
+        return self._data if self._data is not None else {}
 
     @data.setter
     def data(self, value):
-        self._data = json.dumps(value)
+        self._data = value
+        if isinstance(value, dict):
+            self.cluster = value.get('cluster') or value.get('tgt_cluster')
 
     @hybrid_property
     def create_ts(self):
@@ -939,8 +1198,11 @@ def load_yaml(yaml_data):
             id = values.pop('id')
             obj = cls(**values)
             obj.id = id
+            values['id'] = id
         else:
             obj = cls(**values)
+        # upsert_objects() needs to tell the attributes that are explicitly set to null from the unset ones
+        obj._yaml_keys = set(values)
 
         return obj
 
@@ -951,3 +1213,83 @@ def load_yaml(yaml_data):
     data = yaml.unsafe_load(yaml_data)
 
     return data
+
+
+def upsert_objects(objects, update=False, batch_size=500):
+    """
+    Insert model objects, e.g. the ones from load_yaml(), in bulk. The objects are grouped by model and diffed against
+    the existing rows with one query per table. New rows are inserted and, if update is set, changed rows are updated
+    with batched INSERT ... ON CONFLICT statements. Only the attributes that are set on an object are compared and
+    updated, the rest keep their existing values. Attributes that load_yaml() got as null are set to NULL. The caller
+    commits.
+
+    Returns a dict with inserted, updated and skipped counts, as reported by the database.
+    """
+    dialect_name = db.session.get_bind().dialect.name
+    if dialect_name == 'postgresql':
+        insert = postgresql.insert
+    elif dialect_name == 'sqlite':
+        insert = sqlite.insert
+    else:
+        raise RuntimeError('upsert not supported for %s' % dialect_name)
+
+    objects_by_table = {}
+    for obj in objects:
+        objects_by_table.setdefault(obj.__table__, []).append(obj)
+
+    counts = dict(inserted=0, updated=0, skipped=0)
+    num_rows = 0
+    # process tables in dependency order, so that rows are inserted before the rows referring to them
+    for table in [t for t in db.metadata.sorted_tables if t in objects_by_table]:
+        model_objects = objects_by_table[table]
+        column_attrs = sa_inspect(type(model_objects[0])).column_attrs
+        pk_keys = [c.key for c in table.primary_key.columns]
+
+        # column values that have been set on the objects, the rest are left to defaults or existing values
+        rows = []
+        for obj in model_objects:
+            yaml_keys = getattr(obj, '_yaml_keys', ())
+            rows.append({
+                prop.columns[0].key: getattr(obj, prop.key) for prop in column_attrs
+                if getattr(obj, prop.key) is not None or prop.key.lstrip('_') in yaml_keys
+            })
+
+        # rows without a primary key get one from the column defaults on insert, there is nothing to look up for them
+        existing = {}
+        pks = [tuple(row.get(key) for key in pk_keys) for row in rows]
+        lookup_pks = [pk for pk in pks if None not in pk]
+        for i in range(0, len(lookup_pks), batch_size):
+            for row in db.session.execute(
+                    select(table).where(
+                        tuple_(*table.primary_key.columns).in_(lookup_pks[i:i + batch_size]))).mappings():
+                existing[tuple(row[key] for key in pk_keys)] = row
+
+        # statements need the same columns on every row, so group the rows by the columns they set
+        inserts_by_keys = {}
+        updates_by_keys = {}
+        for pk, row in zip(pks, rows):
+            if pk not in existing:
+                inserts_by_keys.setdefault(tuple(sorted(row)), []).append(row)
+            elif update and any(existing[pk][key] != value for key, value in row.items()):
+                updates_by_keys.setdefault(tuple(sorted(row)), []).append(row)
+
+        # count the rows the statements actually wrote, ON CONFLICT DO NOTHING skips the rows that exist by now
+        for keys, key_rows in inserts_by_keys.items():
+            stmt = insert(table).on_conflict_do_nothing(index_elements=pk_keys).returning(*table.primary_key.columns)
+            for i in range(0, len(key_rows), batch_size):
+                counts['inserted'] += len(db.session.execute(stmt, key_rows[i:i + batch_size]).all())
+        for keys, key_rows in updates_by_keys.items():
+            stmt = insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=pk_keys,
+                set_={key: stmt.excluded[key] for key in keys if key not in pk_keys}
+            ).returning(*table.primary_key.columns)
+            for i in range(0, len(key_rows), batch_size):
+                counts['updated'] += len(db.session.execute(stmt, key_rows[i:i + batch_size]).all())
+        num_rows += len(rows)
+
+        logging.info('%s: %d rows, %d existing', table.name, len(rows), len(existing))
+
+    counts['skipped'] = num_rows - counts['inserted'] - counts['updated']
+
+    return counts
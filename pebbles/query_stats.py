@@ -0,0 +1,143 @@
+"""Per request SQL query statistics.
+
+Statements executed by any engine are counted and timed with SQLAlchemy cursor events. The statistics are collected
+only when a collector is active in the current context: the API opens one for each request, and tests can open their
+own with collect_queries() to assert query budgets.
+
+For each request the query count, the total database time and the slowest statement are added to the response as a
+Server-Timing header, which shows up in the browser developer tools. Requests that are slower or run more statements
+than the configured thresholds are logged with their statements, which makes N+1 query patterns easy to spot.
+Resources that wait on purpose, like long-polls and event streams, set LONG_RUNNING = True and are compared to the
+time threshold by their database time instead.
+"""
+import contextlib
+import contextvars
+import logging
+import time
+
+from flask import Flask, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+QUERY_START_KEY = 'pebbles_query_start'
+
+# how many characters of a statement are kept in the statistics
+MAX_STATEMENT_LENGTH = 500
+
+_collectors = contextvars.ContextVar('pebbles_query_stats_collectors', default=())
+
+
+class QueryStats:
+    """Query count, total time and the executed statements with their durations in seconds"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.statements = []
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+        self.statements.append((statement[:MAX_STATEMENT_LENGTH], duration))
+
+    @property
+    def slowest(self):
+        """The slowest (statement, duration) or None if there were no queries"""
+        return max(self.statements, key=lambda s: s[1], default=None)
+
+    def format_statements(self):
+        return '\n'.join('  %8.2f ms  %s' % (duration * 1000, ' '.join(statement.split()))
+                         for statement, duration in self.statements)
+
+
+def start_collecting():
+    """Start collecting statistics in the current context. Returns the statistics and a token for stop_collecting()"""
+    stats = QueryStats()
+    token = _collectors.set(_collectors.get() + (stats,))
+    return stats, token
+
+
+def stop_collecting(token):
+    _collectors.reset(token)
+
+
+@contextlib.contextmanager
+def collect_queries():
+    """Collect the statements executed in the block, including the ones from nested API requests"""
+    stats, token = start_collecting()
+    try:
+        yield stats
+    finally:
+        stop_collecting(token)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _collectors.get():
+        conn.info.setdefault(QUERY_START_KEY, []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    collectors = _collectors.get()
+    start_times = conn.info.get(QUERY_START_KEY)
+    if not (collectors and start_times):
+        return
+    duration = time.perf_counter() - start_times.pop()
+    for stats in collectors:
+        stats.add(statement, duration)
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(exception_context):
+    # failed statements are not counted, drop their start time
+    conn = exception_context.connection
+    if conn is not None and conn.info.get(QUERY_START_KEY):
+        conn.info[QUERY_START_KEY].pop()
+
+
+def server_timing_header(stats, request_time):
+    """Format the statistics as a Server-Timing header value, durations are in milliseconds"""
+    metrics = ['db;dur=%.2f;desc="%d queries"' % (stats.total_time * 1000, stats.count)]
+    slowest = stats.slowest
+    if slowest:
+        metrics.append('db-slowest;dur=%.2f' % (slowest[1] * 1000))
+    metrics.append('total;dur=%.2f' % (request_time * 1000))
+    return ', '.join(metrics)
+
+
+def init_query_stats(app: Flask):
+    """Collect query statistics for each request of the app"""
+
+    @app.before_request
+    def start_request_query_stats():
+        g.query_stats, g.query_stats_token = start_collecting()
+        g.request_start_ts = time.perf_counter()
+
+    @app.after_request
+    def add_query_stats(response):
+        stats = g.get('query_stats')
+        if stats is None:
+            return response
+        request_time = time.perf_counter() - g.request_start_ts
+        if app.config['SERVER_TIMING_ENABLED']:
+            response.headers['Server-Timing'] = server_timing_header(stats, request_time)
+
+        time_threshold = app.config['SLOW_REQUEST_LOG_THRESHOLD']
+        count_threshold = app.config['SLOW_REQUEST_LOG_QUERY_COUNT']
+        view_class = getattr(app.view_functions.get(request.endpoint), 'view_class', None)
+        slow_time = stats.total_time if getattr(view_class, 'LONG_RUNNING', False) else request_time
+        if (time_threshold and slow_time > time_threshold) or (count_threshold and stats.count > count_threshold):
+            logging.warning(
+                'slow request %s %s: %.1f ms, %d queries in %.1f ms\n%s',
+                request.method, request.path, request_time * 1000, stats.count, stats.total_time * 1000,
+                stats.format_statements()
+            )
+        return response
+
+    @app.teardown_request
+    def stop_request_query_stats(exc):
+        token = g.pop('query_stats_token', None)
+        if token is not None:
+            g.pop('query_stats', None)
+            stop_collecting(token)
@@ -1,6 +1,7 @@
+import datetime
 import itertools
 
-from sqlalchemy import or_, select, false, func
+from sqlalchemy import or_, select, false
 from sqlalchemy.orm import load_only
 from sqlalchemy.sql.expression import true
 
@@ -72,18 +73,15 @@ def generate_application_session_query(user, args=None):
         )
 
     if args and args.get('limit'):
-        # prioritize to_be_deleted
-        s = s.order_by(ApplicationSession.to_be_deleted == false())
-        # then sessions that are not in static states (failed, running, deleted)
+        # work queue mode for the workers: pick the sessions that are due for action. The range condition on
+        # next_action_at is served by an index, so the sort below only covers the sessions that are due.
+        s = s.where(ApplicationSession.next_action_at <= datetime.datetime.utcnow())
+        # prioritize to_be_deleted, then sessions that are starting up over running ones, then the most overdue
         s = s.order_by(
-            or_(
-                ApplicationSession.state == ApplicationSession.STATE_FAILED,
-                ApplicationSession.state == ApplicationSession.STATE_RUNNING,
-                ApplicationSession.state == ApplicationSession.STATE_DELETED,
-            )
+            ApplicationSession.to_be_deleted == false(),
+            ApplicationSession.state == ApplicationSession.STATE_RUNNING,
+            ApplicationSession.next_action_at,
         )
-        # finally random order as the last criteria
-        s = s.order_by(func.random())
         s = s.limit(int(args.get('limit')))
 
     return s
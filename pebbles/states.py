@@ -0,0 +1,48 @@
+"""State and kind constants of the models.
+
+The worker and the drivers only see the models as JSON from the API, but need the constants. They live here, free of
+the ORM, so that importing them does not drag in SQLAlchemy and the Flask app. The model classes inherit them, so both
+ApplicationSession.STATE_RUNNING and ApplicationSessionStates.STATE_RUNNING work.
+"""
+
+
+class ApplicationSessionStates:
+    STATE_QUEUEING = 'queueing'
+    STATE_PROVISIONING = 'provisioning'
+    STATE_STARTING = 'starting'
+    STATE_RUNNING = 'running'
+    STATE_DELETING = 'deleting'
+    STATE_DELETED = 'deleted'
+    STATE_FAILED = 'failed'
+
+    VALID_STATES = (
+        STATE_QUEUEING,
+        STATE_PROVISIONING,
+        STATE_STARTING,
+        STATE_RUNNING,
+        STATE_DELETING,
+        STATE_DELETED,
+        STATE_FAILED,
+    )
+
+
+class TaskStates:
+    STATE_NEW = 'new'
+    STATE_PROCESSING = 'processing'
+    STATE_FINISHED = 'finished'
+    STATE_FAILED = 'failed'
+
+    VALID_STATES = (
+        STATE_NEW,
+        STATE_PROCESSING,
+        STATE_FINISHED,
+        STATE_FAILED,
+    )
+
+    KIND_WORKSPACE_VOLUME_BACKUP = 'workspace_volume_backup'
+    KIND_WORKSPACE_VOLUME_RESTORE = 'workspace_volume_restore'
+
+    VALID_KINDS = (
+        KIND_WORKSPACE_VOLUME_BACKUP,
+        KIND_WORKSPACE_VOLUME_RESTORE,
+    )
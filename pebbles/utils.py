@@ -1,13 +1,19 @@
 import base64
-import importlib
+import concurrent.futures
+import hashlib
+import itertools
+import json
 import logging
+import math
+import multiprocessing
+import os
 import random
 from functools import wraps
 from logging.handlers import RotatingFileHandler
 import re
 
+import bcrypt
 import yaml
-from flask import abort, g
 from yaml import YAMLError
 
 from pebbles.config import LOG_FORMAT
@@ -22,7 +28,37 @@ def create_password(length=8):
     return password
 
 
+# below this many passwords, hashing inline is faster than starting a process pool
+PASSWORD_HASH_POOL_THRESHOLD = 16
+
+
+def hash_password(password, log_rounds):
+    """bcrypt hash that is compatible with flask_bcrypt. This is a top level function, so it can run in a process
+    pool."""
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(log_rounds)).decode('utf-8')
+
+
+def hash_passwords(passwords, log_rounds, max_workers=None):
+    """Hash a list of passwords with bcrypt. bcrypt is slow by design, so large lists are spread across a process
+    pool. The pool processes are spawned, not forked: a fork of a threaded API server process can inherit locks held
+    by the other threads and hang."""
+    if len(passwords) < PASSWORD_HASH_POOL_THRESHOLD:
+        return [hash_password(password, log_rounds) for password in passwords]
+    max_workers = max_workers or os.cpu_count()
+    mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers, mp_context=mp_context) as executor:
+        return list(executor.map(
+            hash_password,
+            passwords,
+            itertools.repeat(log_rounds),
+            chunksize=max(1, len(passwords) // (max_workers * 4))
+        ))
+
+
 def requires_admin(f):
+    # flask is imported here, at view definition time, to keep it out of the worker
+    from flask import abort, g
+
     @wraps(f)
     def decorated(*args, **kwargs):
         if not g.user.is_admin:
@@ -33,6 +69,8 @@ def requires_admin(f):
 
 
 def requires_workspace_owner_or_admin(f):
+    from flask import abort, g
+
     @wraps(f)
     def decorated(*args, **kwargs):
         if not g.user.is_admin and not g.user.is_workspace_owner:
@@ -182,6 +220,17 @@ def get_provisioning_config(application):
     return provisioning_config
 
 
+def generate_alert_id(target, source, data):
+    id_bytes = target.encode() + source.encode() + json.dumps(data).encode()
+    return hashlib.sha3_224(id_bytes).hexdigest()
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of a non-empty sorted list"""
+    rank = max(int(math.ceil(len(sorted_values) * pct / 100)), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
 def env_string_to_dict(keyval_string):
     """ Extract a dictionary from space separated key=val formatted string """
     res = dict()
@@ -273,18 +322,9 @@ def load_cluster_config(
 
 
 def find_driver_class(driver_name):
-    """tries to find a provisioning driver by name"""
-    driver_class = None
-    for module in 'kubernetes_driver', 'openshift_template_driver':
-        driver_class = getattr(
-            importlib.import_module('pebbles.drivers.provisioning.%s' % module),
-            driver_name,
-            None
-        )
-        if driver_class:
-            break
-
-    return driver_class
+    """tries to find a provisioning driver by name, see pebbles.drivers.provisioning for the registry"""
+    from pebbles.drivers.provisioning import find_driver_class as find_registered_driver_class
+    return find_registered_driver_class(driver_name)
 
 
 def load_auth_config(path):
@@ -3,10 +3,12 @@ import time
 
 import flask_restful as restful
 from flask import Blueprint as FlaskBlueprint
-from flask import abort, request
+from flask import abort, current_app, request
 from flask_restful import marshal_with, fields, reqparse
+from sqlalchemy import delete, exists, func, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
 
-from pebbles.models import Alert
+from pebbles.models import Alert, AlertHistory
 from pebbles.models import db
 from pebbles.utils import requires_admin
 from pebbles.views.commons import auth
@@ -58,8 +60,9 @@ class AlertList(restful.Resource):
     @requires_admin
     @marshal_with(alert_fields)
     def post(self):
-        res = []
-
+        # collect the rows by id, the last entry wins for duplicates
+        rows = {}
+        now = datetime.datetime.fromtimestamp(time.time())
         for entry in request.json:
             target = entry.get('target')
             source = entry.get('source')
@@ -69,18 +72,33 @@ class AlertList(restful.Resource):
                 return "target, source and status have to be defined", 422
 
             alert_id = Alert.generate_alert_id(target, source, data)
-            alert = Alert.query.filter_by(id=alert_id).first()
-            if not alert:
-                alert = Alert(alert_id, target, source, status, data)
-                db.session.add(alert)
-            else:
-                alert.status = status
-                alert.last_seen_ts = time.time()
-            res.append(alert)
+            rows[alert_id] = dict(
+                id=alert_id, target=target, source=source, status=status, data=data,
+                first_seen_ts=now, last_seen_ts=now,
+            )
 
+        if rows:
+            upsert_alerts(list(rows.values()))
         db.session.commit()
 
-        return res
+        alerts_by_id = {alert.id: alert for alert in Alert.query.filter(Alert.id.in_(rows.keys()))}
+        return [alerts_by_id[alert_id] for alert_id in rows.keys()]
+
+
+def upsert_alerts(rows):
+    """Insert or update alerts in a single statement. Existing alerts keep their first_seen_ts."""
+    dialect_name = db.session.get_bind().dialect.name
+    if dialect_name == 'postgresql':
+        stmt = postgresql.insert(Alert.__table__)
+    elif dialect_name == 'sqlite':
+        stmt = sqlite.insert(Alert.__table__)
+    else:
+        raise RuntimeError('upsert not supported for %s' % dialect_name)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Alert.__table__.c.id],
+        set_=dict(status=stmt.excluded.status, last_seen_ts=stmt.excluded.last_seen_ts)
+    )
+    db.session.execute(stmt, rows)
 
 
 class AlertView(restful.Resource):
@@ -119,13 +137,101 @@ class AlertReset(restful.Resource):
         return firing_alerts
 
 
+class AlertCompaction(restful.Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('retention_days', type=int, default=30, location='args')
+    parser.add_argument('history_retention_days', type=int, default=730, location='args')
+
+    @auth.login_required
+    @requires_admin
+    def post(self):
+        """Compact archived alerts older than the retention period into daily history and purge old history"""
+        args = self.parser.parse_args()
+        if args.get('retention_days') < 0 or args.get('history_retention_days') < 0:
+            return dict(error='retention periods cannot be negative'), 422
+
+        cutoff = datetime.datetime.fromtimestamp(time.time() - args.get('retention_days') * 86400)
+        num_compacted = compact_archived_alerts(cutoff)
+
+        history_cutoff = datetime.date.today() - datetime.timedelta(days=args.get('history_retention_days'))
+        num_history_purged = db.session.execute(
+            delete(AlertHistory).where(AlertHistory.day < history_cutoff)
+        ).rowcount
+        db.session.commit()
+
+        return dict(num_compacted=num_compacted, num_history_purged=num_history_purged)
+
+
+def compact_archived_alerts(cutoff):
+    """Merge archived alerts last seen before cutoff into alert_history and delete them. Returns the number of alerts
+    compacted. The caller commits."""
+    archived_before_cutoff = (Alert.status == 'archived', Alert._last_seen_ts < cutoff)
+    alert_name = func.coalesce(Alert._data['labels']['alertname'].as_string(), '')
+    day = func.date(Alert._first_seen_ts)
+    rows = db.session.execute(
+        select(
+            day.label('day'),
+            Alert.target,
+            Alert.source,
+            alert_name.label('name'),
+            func.count().label('num_alerts'),
+            func.min(Alert._first_seen_ts).label('first_seen_ts'),
+            func.max(Alert._last_seen_ts).label('last_seen_ts'),
+        )
+        .where(*archived_before_cutoff)
+        .group_by(day, Alert.target, Alert.source, alert_name)
+    ).mappings().all()
+    if not rows:
+        return 0
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        stmt = postgresql.insert(AlertHistory.__table__)
+        least, greatest = func.least, func.greatest
+    else:
+        stmt = sqlite.insert(AlertHistory.__table__)
+        least, greatest = func.min, func.max
+    history = AlertHistory.__table__.c
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[history.day, history.target, history.source, history.name],
+        set_=dict(
+            num_alerts=history.num_alerts + stmt.excluded.num_alerts,
+            first_seen_ts=least(history.first_seen_ts, stmt.excluded.first_seen_ts),
+            last_seen_ts=greatest(history.last_seen_ts, stmt.excluded.last_seen_ts),
+        )
+    )
+    db.session.execute(stmt, [
+        dict(row, day=to_date(row['day']))
+        for row in rows
+    ])
+
+    return db.session.execute(delete(Alert).where(*archived_before_cutoff)).rowcount
+
+
+def to_date(value):
+    # SQLite returns date() as a string
+    return datetime.date.fromisoformat(value) if isinstance(value, str) else value
+
+
 class SystemStatus(restful.Resource):
+    # the status is requested by every page load, cache it for a while in the process
+    cached_status = None
+    cached_ts = 0
+
     @staticmethod
     def get():
-        active_alerts = Alert.query.filter(Alert.status != 'archived').all()
-
-        for alert in active_alerts:
-            if alert.status == 'firing' or alert.last_seen_ts < time.time() - EXPIRY_AGE_LIMIT:
-                return 'warning'
-
-        return 'ok'
+        cache_ttl = current_app.config['SYSTEM_STATUS_CACHE_TTL']
+        if SystemStatus.cached_status and SystemStatus.cached_ts + cache_ttl > time.time():
+            return SystemStatus.cached_status
+
+        expiry_limit = datetime.datetime.fromtimestamp(time.time() - EXPIRY_AGE_LIMIT)
+        # firing alerts or expired 'ok' status from a cluster. The IN condition matches the partial index on alerts.
+        has_warnings = db.session.scalar(
+            select(exists().where(
+                Alert.status.in_(('firing', 'ok')),
+                or_(Alert.status == 'firing', Alert._last_seen_ts < expiry_limit),
+            ))
+        )
+        status = 'warning' if has_warnings else 'ok'
+
+        SystemStatus.cached_status, SystemStatus.cached_ts = status, time.time()
+        return status
@@ -1,16 +1,21 @@
 import datetime
 import json
 import logging
+import threading
+import time
 
 import flask_restful as restful
 from flask import Blueprint as FlaskBlueprint
-from flask import abort, g, current_app
+from flask import Response, abort, g, current_app, request, stream_with_context
 from flask_restful import marshal_with, fields, reqparse
-from sqlalchemy import select
+from sqlalchemy import select, func
 
 from pebbles import rules, utils
+from pebbles.change_feed import change_feed
+from pebbles.config import application_session_stream_max_per_process
 from pebbles.forms import ApplicationSessionForm
 from pebbles.models import db, Application, ApplicationSession, ApplicationSessionLog, User
+from pebbles.models import acquire_advisory_lock
 from pebbles.utils import requires_admin
 from pebbles.views.commons import auth, is_workspace_manager, requires_workspace_manager_or_admin
 
@@ -185,29 +190,32 @@ class ApplicationSessionList(restful.Resource):
             logging.warning('application_session creation failed, application %s is disabled', application_id)
             return 'Application is disabled', 409
 
-        # check existing sessions and enforce limits. There is still a potential race here by request flooding, this
-        # can be fixed later by obtaining a lock per user
-        application_sessions_for_user = ApplicationSession.query.filter_by(
-            user_id=user.id
-        ).filter(ApplicationSession.state != 'deleted').all()
+        # serialize session creation per user and per workspace for the limit checks below. The locks are always
+        # taken in the same order and released when the transaction ends
+        acquire_advisory_lock('application_session_create_user_%s' % user.id)
+        acquire_advisory_lock('application_session_create_workspace_%s' % application.workspace_id)
+
+        # check existing sessions and enforce limits
+        application_ids_for_user = db.session.scalars(
+            select(ApplicationSession.application_id)
+            .where(ApplicationSession.user_id == user.id)
+            .where(ApplicationSession.state != ApplicationSession.STATE_DELETED)
+        ).all()
         # first check the global limit
-        if not user.is_admin and len(application_sessions_for_user) >= MAX_APPLICATION_SESSIONS_PER_USER:
+        if not user.is_admin and len(application_ids_for_user) >= MAX_APPLICATION_SESSIONS_PER_USER:
             return 'Application session limit %s reached. Please close existing sessions first' \
                    ' before starting this application.' % MAX_APPLICATION_SESSIONS_PER_USER, 409
         # then check that we don't have an existing session already
-        for session in application_sessions_for_user:
-            if session.application_id == application_id:
-                return 'There is already an existing session for this application', 409
-
-        # then check that workspace is not out of resources
-        application_sessions_in_ws = ApplicationSession.query \
-            .filter(ApplicationSession.state != 'deleted') \
-            .join(Application) \
-            .filter_by(workspace_id=application.workspace_id).all()
-        # sum up existing resources + the new session on top
-        ws_consumed_mem = application.config.get('memory_gib', application.base_config.get('memory_gib', 1.0))
-        for sess in application_sessions_in_ws:
-            ws_consumed_mem += sess.provisioning_config.get('memory_gib', 1.0)
+        if application_id in application_ids_for_user:
+            return 'There is already an existing session for this application', 409
+
+        # then check that workspace is not out of resources: sum up existing resources + the new session on top
+        ws_consumed_mem = db.session.scalar(
+            select(func.coalesce(func.sum(func.coalesce(ApplicationSession.memory_gib, 1.0)), 0))
+            .where(ApplicationSession.workspace_id == application.workspace_id)
+            .where(ApplicationSession.state != ApplicationSession.STATE_DELETED)
+        )
+        ws_consumed_mem += application.config.get('memory_gib', application.base_config.get('memory_gib', 1.0))
 
         if ws_consumed_mem > application.workspace.memory_limit_gib:
             logging.info('workspace %s is over memory limit', application.workspace_id)
@@ -293,6 +301,7 @@ class ApplicationSessionView(restful.Resource):
     patch_parser.add_argument('to_be_deleted', type=bool)
     patch_parser.add_argument('log_fetch_pending', type=bool)
     patch_parser.add_argument('send_email', type=bool)
+    patch_parser.add_argument('backoff', type=bool)
 
     @auth.login_required
     @requires_workspace_manager_or_admin
@@ -322,6 +331,7 @@ class ApplicationSessionView(restful.Resource):
             if state not in ApplicationSession.VALID_STATES:
                 abort(422)
             application_session.state = args['state']
+            application_session.record_transition(application_session.state)
             if application_session.state == ApplicationSession.STATE_RUNNING:
                 if not application_session.provisioned_at:
                     application_session.provisioned_at = datetime.datetime.utcnow()
@@ -347,6 +357,11 @@ class ApplicationSessionView(restful.Resource):
                 logging.warning("invalid session_data passed to view: %s" % args['session_data'])
             db.session.commit()
 
+        # worker reports that there was nothing to do yet, postpone the next check
+        if args.get('backoff'):
+            application_session.back_off()
+            db.session.commit()
+
 
 class ApplicationSessionLogs(restful.Resource):
 
@@ -403,6 +418,13 @@ class ApplicationSessionLogs(restful.Resource):
                 )
                 db.session.add(application_session_log)
 
+            # provisioning milestones also go to the transition ledger of the session
+            milestone = ApplicationSession.PROVISIONING_LOG_MILESTONES.get(log_record['message'])
+            if log_record['log_type'] == 'provisioning' and milestone:
+                application_session = db.session.get(ApplicationSession, application_session_id)
+                if application_session:
+                    application_session.record_transition(milestone, float(log_record['timestamp']))
+
             db.session.commit()
 
         return 'ok'
@@ -416,6 +438,297 @@ class ApplicationSessionLogs(restful.Resource):
         delete_logs_from_db(application_session_id, args.get('log_type'))
 
 
+class ApplicationSessionChanges(restful.Resource):
+    """Long-poll endpoint for the workers. Returns application session changes after the given cursor, blocking until
+    there are some, a session becomes due for action or the timeout expires. A cursor from another API process, or
+    one that is too old, is answered right away with resync set: the caller has to check all the sessions."""
+
+    MAX_TIMEOUT = 50
+    # waiting for changes is not slow, the slow request log looks at the database time only
+    LONG_RUNNING = True
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('since', type=str, location='args')
+    parser.add_argument('timeout', type=float, default=25, location='args')
+
+    @auth.login_required
+    @requires_admin
+    def get(self):
+        args = self.parser.parse_args()
+        change_feed.ensure_listener(db.engine)
+
+        # no cursor given, return the current position of the feed to start from
+        if args.get('since') is None:
+            return dict(cursor=change_feed.latest_cursor(), changes=[], due=False, resync=False)
+        since = change_feed.parse_cursor(args.get('since'))
+        if since is None:
+            return dict(cursor=change_feed.latest_cursor(), changes=[], due=False, resync=True)
+
+        # wake up the caller when the next scheduled action is due, even if nothing changes in the meantime
+        timeout = min(max(args.get('timeout'), 0), self.MAX_TIMEOUT)
+        next_action_at = db.session.scalar(
+            select(func.min(ApplicationSession.next_action_at))
+            .where(ApplicationSession.state != ApplicationSession.STATE_DELETED)
+        )
+        # release the database connection before blocking
+        db.session.remove()
+
+        due = False
+        if next_action_at:
+            seconds_to_next_action = (next_action_at - datetime.datetime.utcnow()).total_seconds()
+            if seconds_to_next_action <= timeout:
+                timeout = max(seconds_to_next_action, 0)
+                due = True
+
+        changes, cursor = change_feed.wait_for_changes(
+            since, timeout, predicate=lambda c: c['kind'] == 'application_session')
+        return dict(cursor=cursor, changes=changes, due=due and not changes, resync=False)
+
+
+class StreamSlots:
+    """Number of streams open in this process, bounded by APPLICATION_SESSION_STREAM_MAX_PER_PROCESS"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open_streams = 0
+
+    def acquire(self, limit):
+        with self.lock:
+            if limit and self.open_streams >= limit:
+                return False
+            self.open_streams += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.open_streams -= 1
+
+
+class ApplicationSessionStream(restful.Resource):
+    """Server-sent event stream of changes to the user's own application sessions. Only deltas are sent: state changes,
+    new session data (endpoints) and new provisioning log lines. The stream is closed after a while, clients reconnect
+    with the Last-Event-ID header to continue where they left off. If that is not possible, e.g. the client reconnects
+    to another API process, the stream starts with a 'resync' event and the client has to reload its sessions.
+
+    Browsers cannot send an Authorization header with EventSource, so the stream also accepts a short-lived token
+    from ApplicationSessionStreamToken in the 'token' query parameter. The token is only checked when the stream is
+    opened. When the browser reconnects with an expired token the stream fails with 401, and the client gets a new
+    token and opens the stream again, passing the id of the last event it got in 'since'.
+
+    Each open stream holds a server thread, so the number of streams per process is capped. Beyond the cap, or when
+    the stream is disabled, the request is answered with 503 and clients poll the session list instead."""
+
+    HEARTBEAT_INTERVAL = 15
+    MAX_DURATION = 300
+    LONG_RUNNING = True
+    # clients that get no stream should poll for a while before trying again
+    RETRY_AFTER = 60
+    STREAM_TOKEN_SCOPE = 'application_session_stream'
+
+    slots = StreamSlots()
+
+    @staticmethod
+    def load_events(changes):
+        """Turn changes into (id, event, data) tuples. The changes only carry ids, the session data and the log records
+        are loaded here."""
+        session_ids = {c['id'] for c in changes if c.get('session_data_changed')}
+        log_ids = [c['log_id'] for c in changes if c['kind'] == 'application_session_log']
+        session_data = {}
+        if session_ids:
+            session_data = dict(db.session.execute(
+                select(ApplicationSession.id, ApplicationSession._session_data)
+                .where(ApplicationSession.id.in_(session_ids))
+            ).all())
+        log_records = {}
+        if log_ids:
+            for log in db.session.scalars(select(ApplicationSessionLog).where(ApplicationSessionLog.id.in_(log_ids))):
+                log_records[log.id] = dict(
+                    log_level=log.log_level, log_type=log.log_type, timestamp=log.timestamp, message=log.message)
+        # give the connection back while waiting for more
+        db.session.remove()
+
+        events = []
+        for change in changes:
+            if change['kind'] == 'application_session':
+                data = dict(id=change['id'], state=change['state'], to_be_deleted=change['to_be_deleted'])
+                if change['session_data_changed'] and session_data.get(change['id']) is not None:
+                    data['session_data'] = session_data[change['id']]
+            elif change['log_id'] in log_records:
+                data = dict(id=change['id'], log_record=log_records[change['log_id']])
+            else:
+                # the log has been deleted in the meantime
+                continue
+            events.append((change['cursor'], change['kind'], data))
+        return events
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('since', type=str, location='args')
+    parser.add_argument('duration', type=float, default=MAX_DURATION, location='args')
+    parser.add_argument('token', type=str, location='args')
+
+    @auth.login_required(optional=True)
+    def get(self):
+        args = self.parser.parse_args()
+        if auth.current_user():
+            user = g.user
+        else:
+            user = User.verify_auth_token(args.get('token'), current_app.config['SECRET_KEY'], self.STREAM_TOKEN_SCOPE)
+        if not user:
+            abort(401)
+        change_feed.ensure_listener(db.engine)
+
+        user_id = user.id
+        # without a cursor the stream starts from the current position of the feed
+        cursor = args.get('since') or request.headers.get('Last-Event-ID') or change_feed.latest_cursor()
+        deadline = time.time() + min(max(args.get('duration'), 0), self.MAX_DURATION)
+
+        if not current_app.config['APPLICATION_SESSION_STREAM_ENABLED']:
+            return dict(error='stream not enabled, poll the application sessions instead'), 503, \
+                {'Retry-After': str(self.RETRY_AFTER)}
+        if not self.slots.acquire(application_session_stream_max_per_process(current_app.config)):
+            logging.info('application session stream limit reached, client falls back to polling')
+            return dict(error='too many open streams, poll the application sessions instead'), 503, \
+                {'Retry-After': str(self.RETRY_AFTER)}
+
+        # the stream only needs the database briefly to load the event details, see load_events()
+        db.session.remove()
+
+        def generate_events(cursor):
+            # instruct the client to reconnect quickly after we close the stream
+            yield 'retry: 1000\n\n'
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                since = change_feed.parse_cursor(cursor)
+                if since is None:
+                    # the cursor is from another process or the events after it are gone, the client has to reload
+                    cursor = change_feed.latest_cursor()
+                    yield 'id: %s\nevent: resync\ndata: {}\n\n' % cursor
+                    continue
+                changes, cursor = change_feed.wait_for_changes(
+                    since, min(remaining, self.HEARTBEAT_INTERVAL), predicate=lambda c: c['user_id'] == user_id)
+                for event_id, event, data in self.load_events(changes):
+                    yield 'id: %s\nevent: %s\ndata: %s\n\n' % (event_id, event, json.dumps(data))
+                if not changes or changes[-1]['cursor'] != cursor:
+                    # an event without data is not dispatched, but it moves the Last-Event-ID of the client past the
+                    # events of the other users
+                    yield ': heartbeat\nid: %s\n\n' % cursor
+
+        response = Response(
+            stream_with_context(generate_events(cursor)),
+            mimetype='text/event-stream',
+            # ask proxies not to buffer the stream
+            headers={'X-Accel-Buffering': 'no'},
+        )
+        # called by the server when the stream ends or the client goes away
+        response.call_on_close(self.slots.release)
+        return response
+
+
+class ApplicationSessionStreamToken(restful.Resource):
+    """Short-lived token for opening ApplicationSessionStream from a browser. The token is scoped to the stream and
+    is not accepted by the rest of the API."""
+
+    @auth.login_required
+    def post(self):
+        expires_in = current_app.config['APPLICATION_SESSION_STREAM_TOKEN_LIFETIME']
+        token = g.user.generate_auth_token(
+            current_app.config['SECRET_KEY'], expires_in=expires_in, scope=ApplicationSessionStream.STREAM_TOKEN_SCOPE)
+        return dict(token=token, expires_in=expires_in)
+
+
+class ApplicationSessionPhaseDurations(restful.Resource):
+    """Percentiles of the time application sessions spent in each phase of their lifecycle, computed from the
+    transition ledger and grouped by cluster, application or image. Durations are in seconds.
+
+    Sessions are attributed to the window in which they were created. A phase is counted only for the sessions that
+    have both of its ends recorded, e.g. image_pull is missing when the image was already on the node.
+    """
+    # name, start transitions, end transitions. The earliest recorded one of the alternatives is used: the drivers
+    # report only the latest pod event at each check, so e.g. a pull that started right away hides the scheduling.
+    PHASES = (
+        ('queueing', (ApplicationSession.STATE_QUEUEING,), (ApplicationSession.STATE_PROVISIONING,)),
+        ('provisioning', (ApplicationSession.STATE_PROVISIONING,), (ApplicationSession.STATE_STARTING,)),
+        ('scheduling', (ApplicationSession.STATE_STARTING,), (
+            ApplicationSession.MILESTONE_SCHEDULED,
+            ApplicationSession.MILESTONE_IMAGE_PULLING,
+            ApplicationSession.MILESTONE_CONTAINER_STARTING,
+        )),
+        ('image_pull', (ApplicationSession.MILESTONE_IMAGE_PULLING,), (ApplicationSession.MILESTONE_CONTAINER_STARTING,)),
+        ('container_start', (ApplicationSession.MILESTONE_CONTAINER_STARTING,), (ApplicationSession.STATE_RUNNING,)),
+        ('starting', (ApplicationSession.STATE_STARTING,), (ApplicationSession.STATE_RUNNING,)),
+        ('total', (ApplicationSession.STATE_QUEUEING,), (ApplicationSession.STATE_RUNNING,)),
+        ('deprovisioning', (ApplicationSession.STATE_DELETING,), (ApplicationSession.STATE_DELETED,)),
+    )
+    PERCENTILES = (50, 95, 99)
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('start_ts', type=int, location='args', required=True)
+    parser.add_argument('end_ts', type=int, location='args', required=True)
+    parser.add_argument('group_by', type=str, location='args', default='cluster',
+                        choices=('cluster', 'application', 'image'))
+
+    @auth.login_required
+    @requires_admin
+    def get(self):
+        args = self.parser.parse_args()
+        if args.end_ts <= args.start_ts:
+            logging.warning('invalid phase duration window %s - %s', args.start_ts, args.end_ts)
+            return dict(error='end_ts must be greater than start_ts'), 422
+
+        start = datetime.datetime.fromtimestamp(args.start_ts, datetime.timezone.utc).replace(tzinfo=None)
+        end = datetime.datetime.fromtimestamp(args.end_ts, datetime.timezone.utc).replace(tzinfo=None)
+        group_column = dict(
+            cluster=ApplicationSession.cluster,
+            application=ApplicationSession.application_id,
+            image=ApplicationSession._provisioning_config,
+        )[args.group_by]
+
+        rows = db.session.execute(
+            select(group_column, ApplicationSession._transitions)
+            .where(ApplicationSession.created_at >= start)
+            .where(ApplicationSession.created_at < end)
+            .where(ApplicationSession._transitions.is_not(None))
+            .execution_options(yield_per=1000)
+        )
+        durations = {}
+        for key, transitions in rows:
+            if args.group_by == 'image':
+                key = (key or {}).get('image')
+            for phase, start_transitions, end_transitions in self.PHASES:
+                start_ts = min((transitions[t] for t in start_transitions if t in transitions), default=None)
+                end_ts = min((transitions[t] for t in end_transitions if t in transitions), default=None)
+                if start_ts is None or end_ts is None:
+                    continue
+                duration = end_ts - start_ts
+                # milestones come from cluster event timestamps, skip the ones skewed before their start
+                if duration >= 0:
+                    durations.setdefault(key, {}).setdefault(phase, []).append(duration)
+
+        names = {}
+        if args.group_by == 'application':
+            names = dict(db.session.execute(
+                select(Application.id, Application.name).where(Application.id.in_(list(durations.keys())))
+            ).all())
+
+        groups = []
+        for key in sorted(durations.keys(), key=str):
+            group = dict(key=key, phases={})
+            if args.group_by == 'application':
+                group['name'] = names.get(key)
+            for phase, _, _ in self.PHASES:
+                values = sorted(durations[key].get(phase, []))
+                if not values:
+                    continue
+                group['phases'][phase] = dict(count=len(values))
+                for pct in self.PERCENTILES:
+                    group['phases'][phase]['p%d' % pct] = round(utils.percentile(values, pct), 3)
+            groups.append(group)
+
+        return dict(start_ts=args.start_ts, end_ts=args.end_ts, group_by=args.group_by, groups=groups)
+
+
 def get_logs_from_db(application_session_id, log_type=None):
     logs_query = ApplicationSessionLog.query \
         .filter_by(application_session_id=application_session_id) \
@@ -244,10 +244,16 @@ class ApplicationView(restful.Resource):
         error = check_config_against_attribute_limits(application.config, application.attribute_limits)
         if error:
             return 'Application config failed attribute limit check: %s' % error, 422
-        application.maximum_lifetime = application.config.get(
+        maximum_lifetime = application.config.get(
             'maximum_lifetime',
             application.maximum_lifetime
         )
+        if maximum_lifetime != application.maximum_lifetime:
+            application.maximum_lifetime = maximum_lifetime
+            # move the expiry of running sessions in the work queue
+            for application_session in application.application_sessions.filter_by(
+                    state=ApplicationSession.STATE_RUNNING, to_be_deleted=False):
+                application_session.schedule_next_action(maximum_lifetime)
 
         db.session.commit()
         application = process_application(application)
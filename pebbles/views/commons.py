@@ -1,11 +1,17 @@
+import csv
+import io
+import json
 import logging
 from functools import wraps
 
+import sqlalchemy as sa
 from flask import g, abort, current_app
 from flask_httpauth import HTTPBasicAuth
 from flask_restful import fields
 
+from pebbles.metrics import count_auth_cache_lookup
 from pebbles.models import db, User, Workspace, WorkspaceMembership
+from pebbles.utils import create_password, hash_passwords
 
 user_fields = {
     'id': fields.String,
@@ -36,6 +42,9 @@ auth.authenticate_header = lambda: "Authentication Required"
 # Delimiter between optional identity domain/prefix and username(eppn/vppn/email)
 EXT_ID_PREFIX_DELIMITER = '/'
 
+# number of users inserted per transaction in bulk user creation
+USER_BULK_INSERT_BATCH_SIZE = 500
+
 
 @auth.verify_password
 def verify_password(userid_or_token, password):
@@ -70,6 +79,90 @@ def create_user(ext_id, password, is_admin=False, email_id=None, expiry_ts=None,
     return user
 
 
+def parse_user_import(text, data_format):
+    """Parse a user import file. CSV needs a header row with ext_id and optionally password and email_id columns,
+    JSON is a list of objects with the same keys. Returns a list of dicts."""
+    if data_format == 'csv':
+        rows = list(csv.DictReader(io.StringIO(text)))
+    elif data_format == 'json':
+        rows = json.loads(text)
+    else:
+        raise ValueError('unknown user import format "%s"' % data_format)
+
+    if not isinstance(rows, list):
+        raise ValueError('user import data should be a list')
+    users = []
+    for row in rows:
+        if not isinstance(row, dict) or not row.get('ext_id'):
+            raise ValueError('user import entry without ext_id: %s' % row)
+        users.append(dict(
+            ext_id=row.get('ext_id').strip(),
+            password=row.get('password') or None,
+            email_id=row.get('email_id') or None,
+        ))
+    return users
+
+
+def create_users_bulk(users, expiry_ts=None, max_workers=None):
+    """Create a list of non-admin users, given as dicts with ext_id and optional password and email_id. Existing
+    ext_ids are checked with one query per batch, passwords are hashed across a process pool and the users and their
+    System.default memberships are inserted in batched transactions. Users without a password get a generated one.
+
+    Returns a tuple (created, skipped): created is a list of dicts with id, ext_id and the generated password if any,
+    skipped is a list of the ext_ids that already existed."""
+    # drop duplicates, the first entry for an ext_id wins
+    users_by_ext_id = {}
+    for user in users:
+        users_by_ext_id.setdefault(user['ext_id'].lower(), user)
+
+    existing = set()
+    ext_ids = list(users_by_ext_id.keys())
+    for i in range(0, len(ext_ids), USER_BULK_INSERT_BATCH_SIZE):
+        # ext_ids are stored in lower case
+        existing.update(db.session.scalars(
+            sa.select(User._ext_id).where(User._ext_id.in_(ext_ids[i:i + USER_BULK_INSERT_BATCH_SIZE]))
+        ))
+    new_users = [dict(user, ext_id=ext_id) for ext_id, user in users_by_ext_id.items() if ext_id not in existing]
+    for user in new_users:
+        if not user.get('password'):
+            user['generated_password'] = create_password(8)
+
+    password_hashes = hash_passwords(
+        [user.get('password') or user.get('generated_password') for user in new_users],
+        current_app.config.get('BCRYPT_LOG_ROUNDS', 12),
+        max_workers=max_workers,
+    )
+
+    # new users have no taints, so they can all join the default workspace
+    system_default_workspace_id = db.session.scalar(
+        sa.select(Workspace.id).where(Workspace.name == 'System.default'))
+
+    created = []
+    for i in range(0, len(new_users), USER_BULK_INSERT_BATCH_SIZE):
+        user_values = [
+            User.insert_values(user['ext_id'], password_hash, email_id=user.get('email_id'), expiry_ts=expiry_ts)
+            for user, password_hash in zip(
+                new_users[i:i + USER_BULK_INSERT_BATCH_SIZE],
+                password_hashes[i:i + USER_BULK_INSERT_BATCH_SIZE]
+            )
+        ]
+        db.session.execute(sa.insert(User), user_values)
+        if system_default_workspace_id:
+            db.session.execute(
+                sa.insert(WorkspaceMembership),
+                [dict(workspace_id=system_default_workspace_id, user_id=v['id']) for v in user_values]
+            )
+        db.session.commit()
+
+        for user, values in zip(new_users[i:i + USER_BULK_INSERT_BATCH_SIZE], user_values):
+            created.append(dict(id=values['id'], ext_id=values['_ext_id']))
+            if user.get('generated_password'):
+                created[-1]['password'] = user['generated_password']
+
+    logging.info('created %d users, skipped %d existing', len(created), len(existing))
+    return created, sorted(existing)
+
+
 def update_email(ext_id, email_id=None):
     user = User.query.filter_by(ext_id=ext_id).first()
     if email_id:
@@ -122,6 +215,7 @@ def is_workspace_manager(user, workspace=None):
             return False
         manager_cache = g.setdefault('manager_cache', dict())
         key = '%s:%s' % (user.id, workspace.id)
+        count_auth_cache_lookup('manager', key in manager_cache)
         if key not in manager_cache.keys():
             logging.debug('manager cache: adding key %s' % key)
             manager_cache[key] = user.id in (wm.user_id for wm in workspace.memberships if wm.is_manager)
@@ -138,6 +232,7 @@ def is_workspace_owner(user, workspace=None):
 
         owner_cache = g.setdefault('owner_cache', dict())
         key = '%s:%s' % (user.id, workspace.id)
+        count_auth_cache_lookup('owner', key in owner_cache)
         if key not in owner_cache.keys():
             logging.debug('owner cache: adding key %s' % key)
             owner_cache[key] = user.id in (wm.user_id for wm in workspace.memberships if wm.is_owner)
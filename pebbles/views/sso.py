@@ -60,10 +60,11 @@ def oauth2_login():
         abort(500)
 
     # get provider's well known config to get JWKS URI and download JWK to verify claims
+    request_timeout = current_app.config['OAUTH2_REQUEST_TIMEOUT']
     well_known_config = None
     oidc_jwk = None
     try:
-        resp = requests.get(oauth2_config['openidConfigurationUrl'])
+        resp = requests.get(oauth2_config['openidConfigurationUrl'], timeout=request_timeout)
         if resp.status_code != 200:
             logging.warning('Login aborted: error downloading oauth2 configuration: %s', resp.status_code)
             abort(500)
@@ -73,7 +74,7 @@ def oauth2_login():
             logging.warning('Login aborted: provider well-known config could not be fetched')
             abort(500)
 
-        resp = requests.get(well_known_config['jwks_uri'])
+        resp = requests.get(well_known_config['jwks_uri'], timeout=request_timeout)
         if resp.status_code != 200:
             logging.warning('Login aborted: error downloading JWKS: %s', resp.status_code)
             abort(500)
@@ -90,7 +91,8 @@ def oauth2_login():
         oidc_userinfo_endpoint = well_known_config['userinfo_endpoint']
         userinfo = requests.get(
             oidc_userinfo_endpoint,
-            headers={'Authorization': 'Bearer %s' % access_token}
+            headers={'Authorization': 'Bearer %s' % access_token},
+            timeout=request_timeout
         ).json()
         logging.debug('got userinfo %s', userinfo)
     except requests.exceptions.RequestException as e:
@@ -1,13 +1,15 @@
+import datetime
 import logging
 import time
 
 import flask_restful as restful
 from flask import Blueprint as FlaskBlueprint
-from flask import abort, request
+from flask import abort, current_app, request
 from flask_restful import marshal_with, fields, reqparse
+from sqlalchemy import and_, func, or_, select
 
 from pebbles.models import Task
-from pebbles.models import db
+from pebbles.models import db, acquire_advisory_lock
 from pebbles.utils import requires_admin
 from pebbles.views.commons import auth
 
@@ -22,14 +24,22 @@ task_fields = {
     'complete_ts': fields.Integer,
     'update_ts': fields.Integer,
     'results': fields.Raw,
+    'priority': fields.Integer,
+    'attempts': fields.Integer,
+    'cluster': fields.String,
+    'lease_owner': fields.String,
 }
 
+# how many candidates to consider per requested task, the rest can be skipped due to per-cluster limits
+CLAIM_CANDIDATE_FACTOR = 3
+
 
 class TaskList(restful.Resource):
     get_parser = reqparse.RequestParser()
     get_parser.add_argument('kind', type=str, location='args')
     get_parser.add_argument('state', type=str, location='args')
     get_parser.add_argument('unfinished', type=bool, location='args')
+    get_parser.add_argument('workspace_id', type=str, location='args')
 
     @auth.login_required
     @requires_admin
@@ -50,6 +60,10 @@ class TaskList(restful.Resource):
         if state:
             q = q.filter_by(state=state)
 
+        workspace_id = args.get('workspace_id', None)
+        if workspace_id:
+            q = q.filter(Task._data['workspace_id'].as_string() == workspace_id)
+
         q = q.order_by(Task._create_ts)
         results = q.all()
         return results
@@ -60,12 +74,13 @@ class TaskList(restful.Resource):
     def post(self):
         kind = request.json.get('kind')
         data = request.json.get('data')
+        priority = request.json.get('priority', Task.PRIORITY_DEFAULT)
         if not (kind and data):
             logging.warning('kind and data have to be defined')
             abort(422)
 
         try:
-            task = Task(kind, Task.STATE_NEW, data)
+            task = Task(kind, Task.STATE_NEW, data, priority=int(priority))
             db.session.add(task)
             db.session.commit()
             return task
@@ -98,6 +113,8 @@ class TaskView(restful.Resource):
             task.update_ts = time.time()
             if task.state == Task.STATE_FINISHED:
                 task.complete_ts = time.time()
+            if task.state in (Task.STATE_FINISHED, Task.STATE_FAILED):
+                task.release()
             db.session.commit()
             return task
         except ValueError as ve:
@@ -105,6 +122,104 @@ class TaskView(restful.Resource):
             return '%s' % ve, 422
 
 
+class TaskClaim(restful.Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('worker_id', type=str, required=True)
+    parser.add_argument('limit', type=int, default=10)
+    parser.add_argument('lease_seconds', type=int, default=300)
+
+    @auth.login_required
+    @requires_admin
+    @marshal_with(task_fields)
+    def post(self):
+        """Claim unfinished tasks that are due, in priority order, by taking a lease on them. Tasks that would start
+        a new Job are only claimed while the cluster has fewer than TASK_MAX_JOBS_PER_CLUSTER Jobs running."""
+        args = self.parser.parse_args()
+        now = datetime.datetime.utcnow()
+        unfinished = Task.state.in_([Task.STATE_NEW, Task.STATE_PROCESSING])
+
+        # count the Jobs per cluster: processing tasks and new tasks claimed by workers. The lock serializes the
+        # admission of new tasks, so that concurrent claims do not exceed the limit, and it is taken before the
+        # candidates are selected so that the counts and the candidates come from the same state.
+        acquire_advisory_lock('task-claim-cluster-jobs')
+        jobs_per_cluster = dict(db.session.execute(
+            select(Task.cluster, func.count())
+            .where(or_(
+                Task.state == Task.STATE_PROCESSING,
+                and_(Task.state == Task.STATE_NEW, Task.lease_expires_at >= now),
+            ))
+            .group_by(Task.cluster)
+        ).all())
+        max_jobs_per_cluster = current_app.config['TASK_MAX_JOBS_PER_CLUSTER']
+        full_clusters = [c for c, jobs in jobs_per_cluster.items() if c is not None and jobs >= max_jobs_per_cluster]
+
+        # lock the candidate rows, skipping the ones other workers are claiming at the same time. New tasks for full
+        # clusters are left out here, otherwise a backlog in one cluster could fill the candidates and starve the rest.
+        candidates = db.session.scalars(
+            select(Task)
+            .where(unfinished)
+            .where(or_(
+                Task.state == Task.STATE_PROCESSING,
+                Task.cluster.is_(None),
+                Task.cluster.not_in(full_clusters),
+            ))
+            .where(or_(Task.next_attempt_at.is_(None), Task.next_attempt_at <= now))
+            .where(or_(Task.lease_expires_at.is_(None), Task.lease_expires_at < now))
+            .order_by(Task.priority.desc(), Task._create_ts)
+            .limit(args.get('limit') * CLAIM_CANDIDATE_FACTOR)
+            .with_for_update(skip_locked=True)
+        ).all()
+
+        claimed_tasks = []
+        for task in candidates:
+            if len(claimed_tasks) >= args.get('limit'):
+                break
+            if task.state == Task.STATE_NEW:
+                if jobs_per_cluster.get(task.cluster, 0) >= max_jobs_per_cluster:
+                    continue
+                jobs_per_cluster[task.cluster] = jobs_per_cluster.get(task.cluster, 0) + 1
+            task.lease_owner = args.get('worker_id')
+            task.lease_expires_at = now + datetime.timedelta(seconds=args.get('lease_seconds'))
+            claimed_tasks.append(task)
+
+        db.session.commit()
+        return claimed_tasks
+
+
+class TaskRelease(restful.Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('worker_id', type=str, required=True)
+    parser.add_argument('delay', type=int, default=0)
+    parser.add_argument('error', type=str)
+
+    @auth.login_required
+    @requires_admin
+    @marshal_with(task_fields)
+    def post(self, task_id):
+        """Release the lease on a task. With an error, the attempt counts as failed and the task is retried later.
+        Only the current lease owner can release: a worker whose lease expired and was claimed by another worker gets
+        409."""
+        args = self.parser.parse_args()
+        task = Task.query.filter_by(id=task_id).with_for_update().first()
+        if not task:
+            abort(404)
+        if task.lease_owner != args.get('worker_id'):
+            logging.warning('worker %s tried to release task %s leased by %s',
+                            args.get('worker_id'), task.id, task.lease_owner)
+            abort(409)
+
+        if args.get('error'):
+            task.results = task.results + args.get('error').splitlines()
+            task.fail_attempt()
+            if task.state == Task.STATE_FAILED:
+                logging.warning('task %s failed after %d attempts', task.id, task.attempts)
+        else:
+            task.release(max(args.get('delay'), 0))
+        task.update_ts = time.time()
+        db.session.commit()
+        return task
+
+
 class TaskAddResults(restful.Resource):
     # Admin can add more lines to task results
     parser = reqparse.RequestParser()
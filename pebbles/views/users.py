@@ -4,13 +4,14 @@ import re
 
 import flask_restful as restful
 from flask import Blueprint as FlaskBlueprint
-from flask import abort, g
+from flask import abort, current_app, g, request
 from flask_restful import marshal_with, reqparse, inputs
 
 from pebbles.models import db, User
 from pebbles.rules import apply_filter_users, apply_rules_workspace_memberships
 from pebbles.utils import requires_admin, create_password
-from pebbles.views.commons import user_fields, auth, workspace_membership_fields, create_user
+from pebbles.views.commons import user_fields, auth, workspace_membership_fields, create_user, create_users_bulk, \
+    parse_user_import
 
 users = FlaskBlueprint('users', __name__)
 
@@ -54,6 +55,34 @@ class UserList(restful.Resource):
         return {'id': user.id, 'ext_id': user.ext_id, 'password': password, 'expiry_ts': expiry_ts}
 
 
+class UserImport(restful.Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('lifetime_in_days', type=int, location='args')
+
+    @auth.login_required
+    @requires_admin
+    def post(self):
+        """Creates users in bulk from a CSV (Content-Type text/csv) or JSON request body, see parse_user_import()"""
+        args = self.parser.parse_args()
+        lifetime_in_days = args.get('lifetime_in_days')
+        if lifetime_in_days is not None and not lifetime_in_days >= 1:
+            abort(400, "lifetime_in_days should be >= 1")
+        expiry_ts = time.time() + 3600 * 24 * lifetime_in_days if lifetime_in_days else None
+
+        data_format = 'csv' if request.mimetype == 'text/csv' else 'json'
+        try:
+            user_data = parse_user_import(request.get_data(as_text=True), data_format)
+        except ValueError as e:
+            logging.warning('invalid user import data: %s', e)
+            return dict(error='Invalid user import data: %s' % e), 422
+        max_users = current_app.config['USER_IMPORT_MAX_USERS']
+        if len(user_data) > max_users:
+            return dict(error='At most %d users can be imported at once' % max_users), 422
+
+        created, skipped = create_users_bulk(user_data, expiry_ts=expiry_ts)
+        return dict(created=created, skipped=skipped)
+
+
 class UserView(restful.Resource):
     @auth.login_required
     @marshal_with(user_fields)
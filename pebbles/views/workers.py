@@ -0,0 +1,66 @@
+import datetime
+
+import flask_restful as restful
+from flask import Blueprint as FlaskBlueprint
+from flask import abort
+from flask_restful import marshal_with, fields
+
+from pebbles.models import db, WorkerHeartbeat
+from pebbles.utils import requires_admin
+from pebbles.views.commons import auth
+
+workers = FlaskBlueprint('workers', __name__)
+
+worker_heartbeat_fields = {
+    'id': fields.String,
+    'updated_at': fields.DateTime
+}
+
+
+def query_live_workers():
+    """Return the workers that have sent a heartbeat within the TTL, ordered by id"""
+    limit_ts = datetime.datetime.utcnow() - datetime.timedelta(seconds=WorkerHeartbeat.HEARTBEAT_TTL)
+    return WorkerHeartbeat.query \
+        .filter(WorkerHeartbeat.updated_at > limit_ts) \
+        .order_by(WorkerHeartbeat.id) \
+        .all()
+
+
+class WorkerList(restful.Resource):
+
+    @auth.login_required
+    @requires_admin
+    @marshal_with(worker_heartbeat_fields)
+    def get(self):
+        return query_live_workers()
+
+
+class WorkerView(restful.Resource):
+
+    @auth.login_required
+    @requires_admin
+    @marshal_with(worker_heartbeat_fields)
+    def put(self, worker_id):
+        """Record a heartbeat for the worker and return the live workers, including the caller"""
+        heartbeat = db.session.get(WorkerHeartbeat, worker_id)
+        if heartbeat:
+            heartbeat.updated_at = datetime.datetime.utcnow()
+        else:
+            db.session.add(WorkerHeartbeat(worker_id))
+
+        # forget workers that have been gone for a long time
+        limit_ts = datetime.datetime.utcnow() - datetime.timedelta(seconds=WorkerHeartbeat.HEARTBEAT_TTL * 60)
+        WorkerHeartbeat.query.filter(WorkerHeartbeat.updated_at < limit_ts).delete()
+        db.session.commit()
+
+        return query_live_workers()
+
+    @auth.login_required
+    @requires_admin
+    def delete(self, worker_id):
+        """Remove the worker from the registry, so that the others can take over its share right away"""
+        heartbeat = db.session.get(WorkerHeartbeat, worker_id)
+        if not heartbeat:
+            abort(404)
+        db.session.delete(heartbeat)
+        db.session.commit()
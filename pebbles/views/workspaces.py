@@ -1,4 +1,6 @@
+import csv
 import datetime
+import io
 import json
 import logging
 import re
@@ -8,15 +10,19 @@ import flask_restful as restful
 import sqlalchemy as sa
 import sqlalchemy.orm
 from flask import Blueprint as FlaskBlueprint, current_app
-from flask import abort, g, request
+from flask import Response, abort, g, request, stream_with_context
 from flask_restful import marshal, reqparse, fields, inputs
 
 from pebbles.forms import WorkspaceForm, WS_TYPE_LONG_RUNNING
 from pebbles.models import db, Workspace, User, WorkspaceMembership, Application, ApplicationSession, Task
+from pebbles.models import seconds_between, year_month
 from pebbles.utils import requires_admin, requires_workspace_owner_or_admin, load_cluster_config
 from pebbles.views import commons
 from pebbles.views.commons import auth, can_user_join_workspace
 
+# maximum number of workspaces in a bulk status change
+WORKSPACE_BULK_STATUS_CHANGE_LIMIT = 100
+
 workspaces = FlaskBlueprint('workspaces', __name__)
 join_workspace = FlaskBlueprint('join_workspace', __name__)
 
@@ -111,12 +117,29 @@ def marshal_based_on_role(user, workspace):
 class WorkspaceList(restful.Resource):
     get_parser = reqparse.RequestParser()
     get_parser.add_argument('membership_expiry_policy_kind', type=str, location='args', required=False)
+    # admins: return only the ids of the active workspaces that have expired before the given timestamp
+    get_parser.add_argument('expired_before', type=float, location='args', required=False)
+
+    patch_parser = reqparse.RequestParser()
+    patch_parser.add_argument('workspace_ids', type=str, action='append', required=True)
+    patch_parser.add_argument('status', type=str, required=True)
 
     @auth.login_required
     def get(self):
         user = g.user
         args = self.get_parser.parse_args()
 
+        if args.get('expired_before') is not None:
+            if not user.is_admin:
+                abort(403)
+            return db.session.scalars(
+                sa.select(Workspace.id)
+                .where(Workspace._status == Workspace.STATUS_ACTIVE)
+                .where(Workspace._expiry_ts < datetime.datetime.fromtimestamp(args.get('expired_before')))
+                .where(sa.not_(Workspace.name.startswith('System')))
+                .order_by(Workspace._expiry_ts)
+            ).all()
+
         workspace_user_query = WorkspaceMembership.query
         results = []
         if not user.is_admin:
@@ -147,6 +170,28 @@ class WorkspaceList(restful.Resource):
 
         return results
 
+    @auth.login_required
+    @requires_admin
+    def patch(self):
+        """Change the status of a batch of workspaces in one transaction. If any of the changes is refused, none of
+        them is applied."""
+        user = g.user
+        args = self.patch_parser.parse_args()
+        workspace_ids = args.get('workspace_ids')
+        if len(workspace_ids) > WORKSPACE_BULK_STATUS_CHANGE_LIMIT:
+            msg = 'at most %d workspaces can be changed at once' % WORKSPACE_BULK_STATUS_CHANGE_LIMIT
+            logging.warning(msg)
+            return dict(error=msg), 422
+
+        for workspace_id in workspace_ids:
+            res = WorkspaceView.handle_status_change(user, workspace_id, args.get('status'), commit=False)
+            if isinstance(res, tuple):
+                db.session.rollback()
+                return res
+        db.session.commit()
+
+        return dict(num_changed=len(workspace_ids))
+
     @auth.login_required
     @requires_workspace_owner_or_admin
     def post(self):
@@ -319,7 +364,8 @@ class WorkspaceView(restful.Resource):
         user = g.user
         return self.handle_status_change(user, workspace_id, Workspace.STATUS_DELETED)
 
-    def handle_status_change(self, user, workspace_id, new_status):
+    @staticmethod
+    def handle_status_change(user, workspace_id, new_status, commit=True):
         workspace = Workspace.query.filter_by(id=workspace_id).first()
 
         if not workspace:
@@ -348,7 +394,6 @@ class WorkspaceView(restful.Resource):
             applications = workspace.applications.all()
             for application in applications:
                 application.status = Application.STATUS_DELETED
-            db.session.commit()
 
         # delete
         if new_status == Workspace.STATUS_DELETED:
@@ -365,6 +410,8 @@ class WorkspaceView(restful.Resource):
                     application_session.to_be_deleted = True
                     application_session.state = ApplicationSession.STATE_DELETING
                     application_session.deprovisioned_at = datetime.datetime.utcnow()
+
+        if commit:
             db.session.commit()
 
         # marshal based on role
@@ -607,6 +654,30 @@ class WorkspaceClearMembers(restful.Resource):
             return {"error": "Only the workspace owner can clear members"}, 403
 
 
+def delete_expired_memberships(workspace_ids, timeout_days):
+    """Delete the memberships in the given workspaces that have expired according to an activity timeout policy, with
+    one DELETE statement. Returns the (workspace_id, user_id) rows of the deleted memberships. Caller commits."""
+    # members that have either
+    # - last login older than the policy limit
+    # - have never logged in but have been created earlier than the policy limit (guest users)
+    expiry_limit = datetime.datetime.fromtimestamp(time.time() - timeout_days * 24 * 3600)
+    expired_users = sa.select(User.id).where(
+        sa.or_(User._last_login_ts < expiry_limit,
+               sa.and_(User._last_login_ts == sa.null(),
+                       User._joining_ts < expiry_limit
+                       )
+               )
+    )
+    return db.session.execute(
+        sa.delete(WorkspaceMembership)
+        .where(WorkspaceMembership.workspace_id.in_(workspace_ids))
+        .where(WorkspaceMembership.is_owner == sa.false(), WorkspaceMembership.is_manager == sa.false())
+        .where(WorkspaceMembership.user_id.in_(expired_users))
+        .returning(WorkspaceMembership.workspace_id, WorkspaceMembership.user_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+
 class WorkspaceClearExpiredMembers(restful.Resource):
     parser = reqparse.RequestParser()
     parser.add_argument('workspace_id', type=str)
@@ -627,31 +698,44 @@ class WorkspaceClearExpiredMembers(restful.Resource):
             logging.warning(msg)
             return {"error": msg}, 422
 
-        # list members that have either
-        # - last login older than the policy limit
-        # - have never logged in but have been created earlier than the policy limit (guest users)
         timeout_days = workspace.membership_expiry_policy.get('timeout_days')
-        expiry_limit = datetime.datetime.fromtimestamp(time.time() - timeout_days * 24 * 3600)
-        membership_query = WorkspaceMembership.query \
-            .filter_by(workspace_id=workspace_id, is_owner=False, is_manager=False) \
-            .join(WorkspaceMembership.user) \
-            .filter(sa.or_(User._last_login_ts < expiry_limit,
-                           sa.and_(User._last_login_ts == sa.null(),
-                                   User._joining_ts < expiry_limit
-                                   )
-                           )
-                    )
-
-        num_deleted = 0
-        for membership in membership_query.all():
-            logging.info('removing expired membership in workspace %s for user %s', workspace_id, membership.user.id)
-            db.session.delete(membership)
-            num_deleted += 1
-
-        if num_deleted:
+        deleted = delete_expired_memberships([workspace_id], timeout_days)
+        for _, user_id in deleted:
+            logging.info('removing expired membership in workspace %s for user %s', workspace_id, user_id)
+
+        if deleted:
             db.session.commit()
 
-        return dict(num_deleted=num_deleted)
+        return dict(num_deleted=len(deleted))
+
+
+class WorkspaceListClearExpiredMembers(restful.Resource):
+
+    @auth.login_required
+    @requires_admin
+    def post(self):
+        """Remove expired memberships from all active workspaces that have an activity timeout policy. Returns the
+        total number of removed memberships and the numbers per workspace."""
+        # group the workspaces by policy timeout, so that each distinct policy takes one DELETE
+        workspace_ids_by_timeout = {}
+        rows = db.session.execute(
+            sa.select(Workspace.id, Workspace._membership_expiry_policy)
+            .where(Workspace._status == Workspace.STATUS_ACTIVE)
+            .where(Workspace._membership_expiry_policy.contains(Workspace.MEP_ACTIVITY_TIMEOUT))
+        ).all()
+        for ws_id, policy_json in rows:
+            policy = json.loads(policy_json)
+            if policy.get('kind') == Workspace.MEP_ACTIVITY_TIMEOUT:
+                workspace_ids_by_timeout.setdefault(policy.get('timeout_days'), []).append(ws_id)
+
+        num_deleted = {}
+        for timeout_days, workspace_ids in workspace_ids_by_timeout.items():
+            for ws_id, user_id in delete_expired_memberships(workspace_ids, timeout_days):
+                logging.info('removing expired membership in workspace %s for user %s', ws_id, user_id)
+                num_deleted[ws_id] = num_deleted.get(ws_id, 0) + 1
+        db.session.commit()
+
+        return dict(num_deleted=sum(num_deleted.values()), workspaces=num_deleted)
 
 
 class WorkspaceAccounting(restful.Resource):
@@ -659,28 +743,101 @@ class WorkspaceAccounting(restful.Resource):
     @auth.login_required
     @requires_admin
     def get(self, workspace_id):
-        applications = Application.query.filter_by(workspace_id=workspace_id).all()
+        gib_hours = db.session.execute(
+            sa.select(sa.func.coalesce(sa.func.sum(session_gib_hours_expression()), 0))
+            .where(ApplicationSession.workspace_id == workspace_id)
+            .where(*accounted_session_filters())
+        ).scalar()
 
         session_accounting = {}
-        total_gib_hours = 0
-        for application in applications:
-            for session in application.application_sessions:
-                if not (session.deprovisioned_at and session.provisioned_at):
-                    continue
+        session_accounting['workspace_id'] = workspace_id
+        session_accounting['gib_hours'] = gib_hours
 
-                duration = session.deprovisioned_at - session.provisioned_at
+        return session_accounting
 
-                if not session.provisioning_config.get('memory_gib'):
-                    continue
 
-                gib_hours = session.provisioning_config['memory_gib'] * duration.total_seconds() / 3600
+class WorkspaceAccountingReport(restful.Resource):
+    """Resource for GiB-hour usage of all workspaces in a time window, grouped by workspace, cluster and month.
 
-                total_gib_hours = total_gib_hours + gib_hours
+    Sessions are attributed to the window and month in which they were provisioned.
+    """
+    parser = reqparse.RequestParser()
+    parser.add_argument('start_ts', type=int, location='args', required=True)
+    parser.add_argument('end_ts', type=int, location='args', required=True)
+    parser.add_argument('format', type=str, location='args', default='json', choices=('json', 'csv'))
 
-        session_accounting['workspace_id'] = workspace_id
-        session_accounting['gib_hours'] = total_gib_hours
+    report_columns = ('workspace_id', 'workspace_name', 'cluster', 'month', 'gib_hours')
 
-        return session_accounting
+    @auth.login_required
+    @requires_admin
+    def get(self):
+        args = self.parser.parse_args()
+        if args.end_ts <= args.start_ts:
+            logging.warning('invalid accounting window %s - %s', args.start_ts, args.end_ts)
+            return dict(error='end_ts must be greater than start_ts'), 422
+
+        start = datetime.datetime.fromtimestamp(args.start_ts, datetime.timezone.utc).replace(tzinfo=None)
+        end = datetime.datetime.fromtimestamp(args.end_ts, datetime.timezone.utc).replace(tzinfo=None)
+        month = year_month(ApplicationSession.provisioned_at)
+
+        query = sa.select(
+            Workspace.id,
+            Workspace.name,
+            ApplicationSession.cluster,
+            month,
+            sa.func.sum(session_gib_hours_expression()),
+        ).join(
+            Workspace, ApplicationSession.workspace_id == Workspace.id
+        ).where(
+            *accounted_session_filters()
+        ).where(
+            ApplicationSession.provisioned_at >= start,
+            ApplicationSession.provisioned_at < end,
+        ).group_by(
+            Workspace.id, Workspace.name, ApplicationSession.cluster, month
+        ).order_by(
+            Workspace.id, ApplicationSession.cluster, month
+        ).execution_options(yield_per=1000)
+
+        # stream the rows from a server-side cursor instead of materializing the whole report
+        rows = db.session.execute(query)
+        if args.format == 'csv':
+            return Response(stream_with_context(self.generate_csv(rows)), mimetype='text/csv')
+        return Response(stream_with_context(self.generate_json(rows)), mimetype='application/json')
+
+    def generate_csv(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.report_columns)
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    def generate_json(self, rows):
+        yield '['
+        separator = ''
+        for row in rows:
+            yield separator + json.dumps(dict(zip(self.report_columns, row)))
+            separator = ','
+        yield ']'
+
+
+def session_gib_hours_expression():
+    """SQL expression for the GiB-hours consumed by a single application session"""
+    return ApplicationSession.memory_gib * seconds_between(
+        ApplicationSession.provisioned_at, ApplicationSession.deprovisioned_at) / 3600
+
+
+def accounted_session_filters():
+    """Filters selecting the application sessions that have a complete accounting record"""
+    return (
+        ApplicationSession.provisioned_at.isnot(None),
+        ApplicationSession.deprovisioned_at.isnot(None),
+        ApplicationSession.memory_gib.isnot(None),
+    )
 
 
 class WorkspaceMemoryLimitGiB(restful.Resource):
@@ -862,6 +1019,8 @@ class WorkspaceCreateVolumeTasks(restful.Resource):
     parser.add_argument('task_kind', type=str, required=True)
     parser.add_argument('src_cluster', type=str, required=False)
     parser.add_argument('tgt_cluster', type=str, required=False)
+    # back up all the volumes of the workspace in a single task/Job instead of one task per volume
+    parser.add_argument('batch', type=inputs.boolean, default=False)
 
     @auth.login_required
     @requires_admin
@@ -882,38 +1041,48 @@ class WorkspaceCreateVolumeTasks(restful.Resource):
                 message = 'Kind %s needs src_cluster and tgt_cluster defined' % task_kind
                 logging.warning(message)
                 return dict(error=message), 422
+            if args.get('batch'):
+                message = 'Kind %s does not support batch mode' % task_kind
+                logging.warning(message)
+                return dict(error=message), 422
             cluster_data = dict(src_cluster=args.get('src_cluster'), tgt_cluster=args.get('tgt_cluster'))
         else:
             logging.warning('Unsupported task kind %s', task_kind)
             return dict(error='Unsupported task kind %s' % task_kind), 422
 
-        # task for shared data
-        task = Task(
-            kind=task_kind,
-            state=Task.STATE_NEW,
-            data=dict(
-                workspace_id=workspace_id,
-                type='shared-data'
-            ) | cluster_data,
-        )
-        db.session.add(task)
-
-        # tasks for user data
-        num_tasks = 1
-        for membership in workspace.memberships:
-            task = Task(
-                kind=task_kind,
-                state=Task.STATE_NEW,
-                data=dict(
-                    workspace_id=workspace_id,
-                    type='user-data',
-                    pseudonym=membership.user.pseudonym
-                ) | cluster_data,
+        if args.get('batch'):
+            # one task for all the volumes in the workspace
+            task_values = [Task.insert_values(
+                task_kind,
+                Task.STATE_NEW,
+                dict(workspace_id=workspace_id, type='workspace-data') | cluster_data,
+            )]
+        else:
+            # task for shared data, needed by all members, process it first
+            task_values = [Task.insert_values(
+                task_kind,
+                Task.STATE_NEW,
+                dict(workspace_id=workspace_id, type='shared-data') | cluster_data,
+                priority=Task.PRIORITY_HIGH,
+            )]
+            # tasks for user data, fetch the member pseudonyms in one query
+            pseudonyms = db.session.scalars(
+                sa.select(User.pseudonym)
+                .join(WorkspaceMembership, WorkspaceMembership.user_id == User.id)
+                .where(WorkspaceMembership.workspace_id == workspace_id)
+            ).all()
+            task_values.extend(
+                Task.insert_values(
+                    task_kind,
+                    Task.STATE_NEW,
+                    dict(workspace_id=workspace_id, type='user-data', pseudonym=pseudonym) | cluster_data,
+                )
+                for pseudonym in pseudonyms
             )
-            db.session.add(task)
-            logging.debug('generated task %s %s', task.kind, task.data)
-            num_tasks += 1
 
+        db.session.execute(sa.insert(Task), task_values)
         db.session.commit()
+        num_tasks = len(task_values)
+        logging.info('generated %d %s tasks for workspace %s', num_tasks, task_kind, workspace_id)
 
         return dict(message='generated %d %s tasks' % (num_tasks, task_kind))
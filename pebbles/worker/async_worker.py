@@ -0,0 +1,209 @@
+"""
+Asyncio runtime for the worker.
+
+The controllers run as independent tasks with their own cadences, so that a slow cluster API call in one of them does
+not stall the others. Application session operations are processed concurrently, bounded by
+WORKER_MAX_CONCURRENT_SESSION_OPERATIONS. Each operation and controller round has a timeout instead of the global
+watchdog alarm of the synchronous runtime.
+
+The driver and API calls are blocking, so they are run in a thread pool sized for the concurrency. A thread cannot be
+stopped when its call times out, so a controller does not start a new round and a session operation keeps its
+concurrency slot until the thread has finished. A liveness check exits the process when a controller round or a
+session operation has been running for LIVENESS_TIMEOUT_ROUNDS operation timeouts, so that the pod gets restarted.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import signal
+from time import time
+
+from pebbles.client import AsyncPBClient
+from pebbles.metrics import start_worker_metrics_listener, time_worker_loop
+from pebbles.worker.controllers import SESSION_CHANGE_FEED_TIMEOUT
+from pebbles.worker.main import Worker
+
+# API calls that are not long-polls should not take longer than this
+API_CALL_TIMEOUT = 30
+
+# exit when a controller round or a session operation has been running for this many operation timeouts
+LIVENESS_TIMEOUT_ROUNDS = 3
+LIVENESS_CHECK_INTERVAL = 10
+
+
+class AsyncWorker(Worker):
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.client.request_timeout = API_CALL_TIMEOUT
+        self.max_concurrent_session_operations = int(conf['WORKER_MAX_CONCURRENT_SESSION_OPERATIONS'])
+        self.operation_timeout = int(conf['WORKER_OPERATION_TIMEOUT'])
+        self.async_client = AsyncPBClient(self.client, timeout=API_CALL_TIMEOUT)
+        # ids of the sessions that have an operation running in the thread pool
+        self.sessions_in_progress = set()
+        # keep references to the session operation tasks until they are done
+        self.session_tasks = set()
+        # start times of the controller rounds and session operations running in the thread pool
+        self.running_since = {}
+
+    def run(self):
+        logging.info('async worker "%s" starting' % self.id)
+        start_worker_metrics_listener(self.config['WORKER_METRICS_PORT'])
+        # no watchdog alarm in async mode, operations have individual timeouts
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        asyncio.run(self.run_controllers())
+
+    async def run_controllers(self):
+        loop = asyncio.get_running_loop()
+        # threads for session operations plus the controller rounds, the change feed and session refresh
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(self.max_concurrent_session_operations + 8))
+        self.session_operation_semaphore = asyncio.Semaphore(self.max_concurrent_session_operations)
+
+        tasks = [
+            asyncio.create_task(self.liveness_loop()),
+            asyncio.create_task(self.refresh_session_loop()),
+            asyncio.create_task(self.session_controller_loop()),
+            asyncio.create_task(self.controller_loop(self.cluster_controller)),
+            asyncio.create_task(self.controller_loop(self.workspace_controller)),
+        ]
+
+        # SIGTERM sets the terminate flag, stop the controllers then
+        while not self.terminate:
+            await asyncio.sleep(1)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.to_thread(self.leave)
+
+    async def refresh_session_loop(self):
+        while True:
+            try:
+                await self.async_client.check_and_refresh_session('worker@pebbles', self.api_key)
+            except Exception as e:
+                logging.warning('refreshing worker session failed: %s', e)
+            await asyncio.sleep(60)
+
+    def track_running(self, name, future):
+        """Keep track of the start time of a call running in the thread pool until it finishes"""
+        self.running_since[name] = time()
+        future.add_done_callback(lambda _: self.running_since.pop(name, None))
+
+    def check_liveness(self):
+        """Return the description of a stuck controller round or session operation, None if all is well"""
+        max_age = LIVENESS_TIMEOUT_ROUNDS * self.operation_timeout
+        now = time()
+        for name, ts in self.running_since.items():
+            if now - ts > max_age:
+                return '%s has been running for %d seconds' % (name, now - ts)
+        return None
+
+    async def liveness_loop(self):
+        while True:
+            await asyncio.sleep(LIVENESS_CHECK_INTERVAL)
+            problem = self.check_liveness()
+            if problem:
+                logging.error('worker is stuck, exiting: %s', problem)
+                # a clean exit would wait for the stuck threads
+                os._exit(1)
+
+    async def controller_loop(self, controller):
+        """Run process() rounds of a controller in its own cadence. A round that times out keeps running in its
+        thread, the next round is started only after it has finished."""
+        controller_name = controller.controller_name
+        future = None
+        while True:
+            if future and not future.done():
+                logging.warning('%s previous round still running, skipping', controller_name)
+            else:
+                future = asyncio.get_running_loop().run_in_executor(None, controller.process)
+                self.track_running('%s round' % controller_name, future)
+                try:
+                    with time_worker_loop(controller_name):
+                        await asyncio.wait_for(asyncio.shield(future), self.operation_timeout)
+                except asyncio.TimeoutError:
+                    logging.warning('%s round timed out', controller_name)
+                except Exception as e:
+                    logging.warning('%s round failed: %s', controller_name, e)
+            await asyncio.sleep(max(controller.next_check_ts - time(), 1))
+
+    async def session_controller_loop(self):
+        controller = self.application_session_controller
+        controller_name = controller.controller_name
+        future = None
+        while True:
+            if time() >= controller.next_check_ts:
+                controller.start_round()
+                if future and not future.done():
+                    logging.warning('%s previous round still running, skipping', controller_name)
+                else:
+                    future = asyncio.get_running_loop().run_in_executor(
+                        None, controller.get_sessions_to_process, set(self.sessions_in_progress))
+                    self.track_running('%s round' % controller_name, future)
+                    await self.start_session_operations(future)
+
+            if not await self.wait_for_session_changes():
+                await asyncio.sleep(1)
+            else:
+                # the change feed returns early when sessions are due, wait until the controller is ready for a round
+                await asyncio.sleep(max(controller.next_check_ts - time(), 0))
+
+    async def start_session_operations(self, future):
+        """Wait for the sessions to process from the controller and start an operation task for each"""
+        try:
+            with time_worker_loop(self.application_session_controller.controller_name):
+                sessions, locked_session_ids = await asyncio.wait_for(asyncio.shield(future), self.operation_timeout)
+        except Exception as e:
+            logging.warning('fetching sessions to process failed: %s', repr(e))
+            return
+
+        for session in sessions:
+            if session['id'] in self.sessions_in_progress:
+                continue
+            self.sessions_in_progress.add(session['id'])
+            task = asyncio.create_task(self.process_session(session, locked_session_ids))
+            self.session_tasks.add(task)
+            task.add_done_callback(self.session_tasks.discard)
+
+    async def wait_for_session_changes(self):
+        """Block on the change feed until there is something to do. Returns False if the feed is not available."""
+        controller = self.application_session_controller
+        # come back early to pick up the results of the operations in progress
+        timeout = 2 if self.sessions_in_progress else SESSION_CHANGE_FEED_TIMEOUT
+        try:
+            if controller.change_cursor is None:
+                controller.change_cursor = (await self.async_client.get_application_session_changes())['cursor']
+            res = await self.async_client.get_application_session_changes(
+                controller.change_cursor, timeout, call_timeout=timeout + API_CALL_TIMEOUT)
+        except Exception as e:
+            logging.warning('application session change feed not available: %s', repr(e))
+            controller.change_cursor = None
+            return False
+
+        controller.handle_changes(res)
+        return True
+
+    async def process_session(self, session, locked_session_ids):
+        controller = self.application_session_controller
+        session_id = session['id']
+        try:
+            await self.session_operation_semaphore.acquire()
+        except asyncio.CancelledError:
+            self.sessions_in_progress.discard(session_id)
+            raise
+        future = asyncio.get_running_loop().run_in_executor(
+            None, controller.process_session_with_lock, session, locked_session_ids)
+        self.track_running('operation on session %s' % session_id, future)
+
+        def operation_done(_):
+            # the session stays in progress and keeps its slot until the thread finishes, even if we stop waiting
+            self.sessions_in_progress.discard(session_id)
+            self.session_operation_semaphore.release()
+
+        future.add_done_callback(operation_done)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.operation_timeout)
+        except asyncio.TimeoutError:
+            logging.warning('processing session %s timed out', session.get('name'))
+        except Exception as e:
+            logging.warning('processing session %s failed: %s', session.get('name'), e)
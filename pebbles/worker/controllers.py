@@ -1,19 +1,43 @@
+import concurrent.futures
 import logging
 import os
+import threading
 import time
 import traceback
 from random import randrange
 
 import requests
 
-from pebbles.models import ApplicationSession, Task
-from pebbles.utils import find_driver_class
+from pebbles.drivers.provisioning import find_driver_class
+from pebbles.metrics import count_lock_attempt, count_session_processed, LOCK_OBTAINED, LOCK_CONFLICT, \
+    LOCK_SKIPPED
+from pebbles.states import ApplicationSessionStates, TaskStates
+from pebbles.utils import generate_alert_id
+from pebbles.worker.sharding import HashRing
 
-WS_CONTROLLER_TASK_LOCK_NAME = 'workspace-controller-tasks'
+# tasks are leased for this long when claimed, after that another worker can pick them up
+TASK_LEASE_SECONDS = 300
+# interval for checking the Jobs of tasks in progress
+TASK_CHECK_INTERVAL = 10
+# maximum number of task batches to claim in one round
+TASK_MAX_BATCHES_PER_ROUND = 10
 
 SESSION_CONTROLLER_LIMIT_SIZE = 50
 
+# maximum time to block on the application session change feed
+SESSION_CHANGE_FEED_TIMEOUT = 25
+
+# maximum number of clusters to poll for alerts in parallel
+ALERT_POLLING_MAX_THREADS = 10
+# send the full set of firing alerts at least this often, in between only changes are sent
+ALERT_FULL_UPDATE_INTERVAL = 600
+
+# how often workers update their membership heartbeat, has to be well below WorkerHeartbeat.HEARTBEAT_TTL
+WORKER_HEARTBEAT_INTERVAL = 15
+
 DRIVER_CACHE_LIFETIME = 900
+# the driver cache is shared by the controllers, which the async runtime calls from multiple threads
+DRIVER_CACHE_LOCK = threading.Lock()
 
 
 class ControllerBase:
@@ -28,6 +52,10 @@ class ControllerBase:
     def get_driver(self, cluster_name):
         """Create driver instance for given cluster.
         We cache the driver instances to avoid login for every new request"""
+        with DRIVER_CACHE_LOCK:
+            return self._get_driver(cluster_name)
+
+    def _get_driver(self, cluster_name):
         cluster = None
         for c in self.cluster_config['clusters']:
             if c.get('name') == cluster_name:
@@ -82,6 +110,75 @@ class ApplicationSessionController(ControllerBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.polling_interval_min, self.polling_interval_max = self.get_polling_interval(2, 5)
+        self.change_cursor = None
+        # start time of the last round of processing
+        self.round_ts = 0
+        # ring of live workers for sharding the sessions, None until the first heartbeat goes through
+        self.hash_ring = None
+        self.heartbeat_ts = 0
+        # the sync worker also sends the heartbeats from a thread of its own, see Worker.run_heartbeat()
+        self.membership_lock = threading.Lock()
+
+    def update_membership(self):
+        """Send a heartbeat and update the hash ring from the live workers, rate limited"""
+        with self.membership_lock:
+            if time.time() < self.heartbeat_ts + WORKER_HEARTBEAT_INTERVAL:
+                return
+            try:
+                live_workers = self.client.send_worker_heartbeat(self.worker_id)
+                self.heartbeat_ts = time.time()
+            except Exception as e:
+                # keep using the previous ring, the locks guard against overlap anyway
+                logging.warning('worker heartbeat failed: %s', e)
+                return
+
+            # we are live even if the list does not show it yet, e.g. when it was read from a lagging replica. Without
+            # us on the ring we would skip all the sessions.
+            members = sorted(set(live_workers) | {self.worker_id})
+            if self.hash_ring is None or self.hash_ring.members != members:
+                logging.info('live workers: %s', ', '.join(members))
+                self.hash_ring = HashRing(members)
+
+    def is_own_session(self, session):
+        """Check if the session belongs to the shard of this worker. Without a ring, all sessions are ours."""
+        if not self.hash_ring:
+            return True
+        return self.hash_ring.get_owner(session['id']) == self.worker_id
+
+    def wait_for_changes(self, timeout):
+        """
+        Block on the application session change feed for at most 'timeout' seconds. When there are changes or sessions
+        that are due for action, the next process() call will query the sessions right away. Returns False if the
+        change feed is not available and the caller should fall back to polling.
+        """
+        try:
+            if self.change_cursor is None:
+                self.change_cursor = self.client.get_application_session_changes()['cursor']
+            res = self.client.get_application_session_changes(self.change_cursor, timeout=max(int(timeout), 0))
+        except Exception as e:
+            logging.warning('application session change feed not available: %s', e)
+            self.change_cursor = None
+            return False
+
+        self.handle_changes(res)
+        return True
+
+    def handle_changes(self, res):
+        """Advance the change feed cursor and schedule an immediate check if there is something to do"""
+        self.change_cursor = res['cursor']
+        if res['changes']:
+            logging.debug('woken up by %d changes', len(res['changes']))
+            self.next_check_ts = 0
+        elif res['due'] or res.get('resync'):
+            # A session can stay due, e.g. when it is locked by or sharded to another worker, or keeps failing. Keep
+            # the minimum polling interval between the rounds, so that such a session cannot make us hot loop. The
+            # same goes for resyncs, which happen every time the long-poll lands on another API process.
+            logging.debug('woken up by sessions due for action or a change feed resync')
+            self.next_check_ts = min(self.next_check_ts, self.round_ts + self.polling_interval_min)
+
+    def start_round(self):
+        self.round_ts = time.time()
+        self.update_next_check_ts(self.polling_interval_min, self.polling_interval_max)
 
     def update_application_session(self, application_session):
         logging.debug('updating %s' % application_session)
@@ -99,7 +196,7 @@ class ApplicationSessionController(ControllerBase):
 
     def process_application_session(self, application_session):
         # check if we need to deprovision the application session
-        if application_session.get('state') in [ApplicationSession.STATE_RUNNING]:
+        if application_session.get('state') in [ApplicationSessionStates.STATE_RUNNING]:
             if not application_session.get('lifetime_left') and application_session.get('maximum_lifetime'):
                 logging.info(
                     'deprovisioning triggered for %s (reason: maximum lifetime exceeded)',
@@ -114,21 +211,36 @@ class ApplicationSessionController(ControllerBase):
         # process sessions in increased intervals
         if time.time() < self.next_check_ts:
             return
-        self.update_next_check_ts(self.polling_interval_min, self.polling_interval_max)
+        self.start_round()
+
+        sessions, locked_session_ids = self.get_sessions_to_process()
+        for session in sessions:
+            self.process_session_with_lock(session, locked_session_ids)
+
+    def get_sessions_to_process(self, sessions_in_progress=()):
+        """
+        Return a list of sessions that need action and ids of sessions that are locked by other workers.
+        Sessions in 'sessions_in_progress' are being processed by this worker, their locks are left alone.
+        """
+        self.update_membership()
 
-        # Query all non-deleted application sessions. This will be a list of candidates, because other
-        # workers could fetch the overlapping sessions as well.
-        sessions = self.client.get_application_sessions(limit=SESSION_CONTROLLER_LIMIT_SIZE)
-        logging.debug('got %d sessions', len(sessions))
+        # Query the sessions that are due for action. Scale the limit by the number of workers, so that we get about
+        # SESSION_CONTROLLER_LIMIT_SIZE sessions from our own shard and skip the rest, which belong to other workers.
+        # This will still be a list of candidates, because during membership changes the workers could disagree on the
+        # shards.
+        num_workers = len(self.hash_ring) if self.hash_ring else 1
+        sessions = self.client.get_application_sessions(limit=SESSION_CONTROLLER_LIMIT_SIZE * max(num_workers, 1))
+        sessions = [s for s in sessions if self.is_own_session(s)]
+        logging.debug('got %d sessions in own shard', len(sessions))
 
         # extract sessions that need to be processed
         # waiting to be provisioned
-        queueing_sessions = filter(lambda x: x['state'] == ApplicationSession.STATE_QUEUEING, sessions)
+        queueing_sessions = filter(lambda x: x['state'] == ApplicationSessionStates.STATE_QUEUEING, sessions)
         # starting asynchronously
-        starting_sessions = filter(lambda x: x['state'] == ApplicationSession.STATE_STARTING, sessions)
+        starting_sessions = filter(lambda x: x['state'] == ApplicationSessionStates.STATE_STARTING, sessions)
         # log fetching needed
         log_fetch_application_sessions = filter(
-            lambda x: x['state'] == ApplicationSession.STATE_RUNNING and x['log_fetch_pending'], sessions)
+            lambda x: x['state'] == ApplicationSessionStates.STATE_RUNNING and x['log_fetch_pending'], sessions)
         # expired sessions in need of deprovisioning
         expired_sessions = filter(
             lambda x: x['to_be_deleted'] or (x['lifetime_left'] == 0 and x['maximum_lifetime']),
@@ -142,42 +254,58 @@ class ApplicationSessionController(ControllerBase):
         processed_sessions.extend(expired_sessions)
         processed_sessions.extend(log_fetch_application_sessions)
 
-        if len(processed_sessions):
-            # get locks for sessions that are already being processed by another worker
-            locks = self.client.query_locks()
-            locked_session_ids = [lock['id'] for lock in locks]
+        if not len(processed_sessions):
+            return [], []
 
-            # delete leftover locks that we own
-            for lock in locks:
-                if lock['owner'] == self.worker_id:
-                    self.client.release_lock(lock['id'], self.worker_id)
+        # get locks for sessions that are already being processed by another worker
+        locks = self.client.query_locks()
+        locked_session_ids = [lock['id'] for lock in locks]
 
-            for session in processed_sessions:
-                # skip the ones that are already in progress
-                if session['id'] in locked_session_ids:
-                    logging.debug('skipping locked session %s', session['id'])
-                    continue
+        # delete leftover locks that we own
+        for lock in locks:
+            if lock['owner'] == self.worker_id and lock['id'] not in sessions_in_progress:
+                self.client.release_lock(lock['id'], self.worker_id)
 
-                # try to obtain a lock. Should we lose the race, the winner takes it and we move on
-                lock_id = self.client.obtain_lock(session.get('id'), self.worker_id)
-                if not lock_id:
-                    logging.debug('failed to acquire lock on session %s, skipping', session['id'])
-                    continue
+        return processed_sessions, locked_session_ids
 
-                # process session and release the lock
-                try:
-                    # Now we have the lock, and we can fetch the definite state for the session
-                    # If the session has been already deleted by another worker, we'll get None
-                    fresh_session = self.client.get_application_session(session.get('id'), suppress_404=True)
-                    if fresh_session and fresh_session.get('state') == session.get('state'):
-                        self.process_application_session(fresh_session)
-                    else:
-                        logging.info('session %s already processed by another worker', session.get('name'))
-                except Exception as e:
-                    logging.warning(e)
-                    logging.debug(traceback.format_exc().splitlines()[-5:])
-                finally:
-                    self.client.release_lock(lock_id, self.worker_id)
+    def process_session_with_lock(self, session, locked_session_ids):
+        # skip the ones that are already in progress
+        if session['id'] in locked_session_ids:
+            logging.debug('skipping locked session %s', session['id'])
+            count_lock_attempt(LOCK_SKIPPED)
+            return
+
+        # try to obtain a lock. Should we lose the race, the winner takes it and we move on
+        lock_id = self.client.obtain_lock(session.get('id'), self.worker_id)
+        if not lock_id:
+            logging.debug('failed to acquire lock on session %s, skipping', session['id'])
+            count_lock_attempt(LOCK_CONFLICT)
+            return
+        count_lock_attempt(LOCK_OBTAINED)
+
+        # process session and release the lock
+        try:
+            # Now we have the lock, and we can fetch the definite state for the session
+            # If the session has been already deleted by another worker, we'll get None
+            fresh_session = self.client.get_application_session(session.get('id'), suppress_404=True)
+            if fresh_session and fresh_session.get('state') == session.get('state'):
+                self.process_application_session(fresh_session)
+                count_session_processed(fresh_session.get('state'))
+            else:
+                logging.info('session %s already processed by another worker', session.get('name'))
+        except Exception as e:
+            logging.warning(e)
+            logging.debug(traceback.format_exc().splitlines()[-5:])
+            self.back_off_session(session)
+        finally:
+            self.client.release_lock(lock_id, self.worker_id)
+
+    def back_off_session(self, session):
+        """Postpone the next action on a session that failed to process, so that it is not retried right away"""
+        try:
+            self.client.do_application_session_patch(session['id'], json_data=dict(backoff=True))
+        except Exception as e:
+            logging.warning('unable to postpone session %s: %s', session['id'], e)
 
 
 class ClusterController(ControllerBase):
@@ -189,6 +317,8 @@ class ClusterController(ControllerBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.polling_interval_min, self.polling_interval_max = self.get_polling_interval(30, 90)
+        # alert ids last posted for each cluster and the time of the last full update, used for sending only changes
+        self.posted_alerts = {}
 
     def process(self):
         # process clusters in increased intervals
@@ -198,89 +328,104 @@ class ClusterController(ControllerBase):
 
         logging.debug('checking cluster alerts')
 
+        clusters = []
         for cluster in self.cluster_config['clusters']:
-            cluster_name = cluster['name']
-
             if 'appDomain' not in cluster.keys():
                 continue
-
             if cluster.get('disableAlerts', False):
-                logging.debug('alerts disabled for cluster %s', cluster_name)
+                logging.debug('alerts disabled for cluster %s', cluster['name'])
                 continue
+            clusters.append(cluster)
 
-            try:
-                logging.debug('getting alerts for cluster %s', cluster_name)
-                res = requests.get(
-                    url="https://" + cluster['appDomain'] + "/prometheus/api/v1/alerts",
-                    auth=('token', cluster.get('monitoringToken')),
-                    timeout=5
-                )
-            except requests.exceptions.RequestException:
-                res = None
+        if not clusters:
+            return
 
-            if not (res and res.ok):
-                logging.warning('unable to get alerts from cluster %s', cluster_name)
-                continue
+        # poll the clusters in parallel, so that a slow one does not hold up the rest
+        with concurrent.futures.ThreadPoolExecutor(min(len(clusters), ALERT_POLLING_MAX_THREADS)) as executor:
+            for cluster, alerts in zip(clusters, executor.map(self.fetch_cluster_alerts, clusters)):
+                if alerts is None:
+                    continue
+                try:
+                    self.publish_cluster_alerts(cluster['name'], alerts)
+                except Exception as e:
+                    logging.warning('unable to update alerts in api for cluster %s: %s', cluster['name'], e)
 
-            alert_data = res.json()
-            alerts = alert_data['data']['alerts']
+    def fetch_cluster_alerts(self, cluster):
+        """Fetch the firing alerts from cluster monitoring. Returns None if the alerts could not be fetched."""
+        cluster_name = cluster['name']
+        try:
+            logging.debug('getting alerts for cluster %s', cluster_name)
+            res = requests.get(
+                url="https://" + cluster['appDomain'] + "/prometheus/api/v1/alerts",
+                auth=('token', cluster.get('monitoringToken')),
+                timeout=5
+            )
+        except requests.exceptions.RequestException:
+            res = None
 
-            logging.debug('got %d alert entries for cluster %s', len(alert_data), cluster_name)
+        if not (res and res.ok):
+            logging.warning('unable to get alerts from cluster %s', cluster_name)
+            return None
 
-            # the watchdog alert should be always firing
-            if len(alerts) == 0:
-                logging.warning('zero alerts, watchdog is not working for cluster %s', cluster_name)
-                continue
+        alert_data = res.json()
+        alerts = alert_data['data']['alerts']
 
-            # filter out low severity ('none', 'info') and speculative alerts (state not 'firing')
+        logging.debug('got %d alert entries for cluster %s', len(alert_data), cluster_name)
+
+        # the watchdog alert should be always firing
+        if len(alerts) == 0:
+            logging.warning('zero alerts, watchdog is not working for cluster %s', cluster_name)
+            return None
+
+        # filter out low severity ('none', 'info') and speculative alerts (state not 'firing')
+        real_alerts = list(filter(
+            lambda x: x['labels'].get('severity', 'none') not in ('none', 'info') and x['state'] == 'firing',
+            alerts
+        ))
+
+        if 'ALERTNAMES_TO_IGNORE' in os.environ:
+            alertnames_to_ignore = os.environ.get('ALERTNAMES_TO_IGNORE').split(',')
             real_alerts = list(filter(
-                lambda x: x['labels'].get('severity', 'none') not in ('none', 'info') and x['state'] == 'firing',
-                alerts
+                lambda x: x['labels']['alertname'] not in alertnames_to_ignore,
+                real_alerts
             ))
 
-            if 'ALERTNAMES_TO_IGNORE' in os.environ:
-                alertnames_to_ignore = os.environ.get('ALERTNAMES_TO_IGNORE').split(',')
-                real_alerts = list(filter(
-                    lambda x: x['labels']['alertname'] not in alertnames_to_ignore,
-                    real_alerts
-                ))
-
-            if len(real_alerts) > 0:
-                json_data = []
-                logging.info('found %d alerts for cluster %s', len(real_alerts), cluster_name)
-
-                # add real alerts to post data
-                for alert in real_alerts:
-                    json_data.append(
-                        dict(
-                            target=cluster_name,
-                            source='prometheus',
-                            status='firing',
-                            data=alert
-                        )
-                    )
-
-                # add notification that the cluster has been polled successfully
-                json_data.append(
-                    dict(
-                        target=cluster_name,
-                        source='prometheus',
-                        status='ok',
-                        data=dict()
-                    )
-                )
-                res = self.client.do_post(
-                    object_url='alerts',
-                    json_data=json_data
-                )
-            else:
-                # inform API that cluster is ok and archive any firing alerts
-                res = self.client.do_post(
-                    object_url='alert_reset/%s/%s' % (cluster_name, 'prometheus'),
-                    json_data=None)
+        return real_alerts
+
+    def publish_cluster_alerts(self, cluster_name, real_alerts):
+        alert_ids = frozenset(generate_alert_id(cluster_name, 'prometheus', alert) for alert in real_alerts)
+        posted_alert_ids, full_update_ts = self.posted_alerts.get(cluster_name, (None, 0))
+        full_update = alert_ids != posted_alert_ids or time.time() >= full_update_ts + ALERT_FULL_UPDATE_INTERVAL
+
+        # notification that the cluster has been polled successfully
+        ok_entry = dict(target=cluster_name, source='prometheus', status='ok', data=dict())
+
+        if not full_update:
+            # nothing has changed, just refresh the cluster status
+            logging.debug('no changes in alerts for cluster %s', cluster_name)
+            res = self.client.do_post(object_url='alerts', json_data=[ok_entry])
+        elif len(real_alerts) > 0:
+            logging.info('found %d alerts for cluster %s', len(real_alerts), cluster_name)
+            json_data = [
+                dict(target=cluster_name, source='prometheus', status='firing', data=alert)
+                for alert in real_alerts
+            ]
+            json_data.append(ok_entry)
+            res = self.client.do_post(object_url='alerts', json_data=json_data)
+        else:
+            # inform API that cluster is ok and archive any firing alerts
+            res = self.client.do_post(
+                object_url='alert_reset/%s/%s' % (cluster_name, 'prometheus'),
+                json_data=None)
+
+        if not res.ok:
+            logging.warning('unable to update alerts in api, code/reason: %s/%s', res.status_code, res.reason)
+            # make sure we send the full set next time
+            self.posted_alerts.pop(cluster_name, None)
+            return
 
-            if not res.ok:
-                logging.warning('unable to update alerts in api, code/reason: %s/%s', res.status_code, res.reason)
+        if full_update:
+            self.posted_alerts[cluster_name] = (alert_ids, time.time())
 
 
 class WorkspaceController(ControllerBase):
@@ -290,8 +435,9 @@ class WorkspaceController(ControllerBase):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.polling_interval_min, self.polling_interval_max = self.get_polling_interval(30, 90)
+        self.polling_interval_min, self.polling_interval_max = self.get_polling_interval(10, 20)
         self.max_concurrent_tasks = 20
+        self.volume_job_statuses = {}
 
     def process(self):
         # process workspace management in increased intervals
@@ -299,43 +445,45 @@ class WorkspaceController(ControllerBase):
             return
         self.update_next_check_ts(self.polling_interval_min, self.polling_interval_max)
 
-        # Try to obtain a global lock for WorkspaceTaskProcessing.
-        # Should we lose the race, the winner takes it, and we try next time we are active
-        lock = self.client.obtain_lock(WS_CONTROLLER_TASK_LOCK_NAME, self.worker_id)
-        if lock is None:
-            logging.debug('WorkspaceController did not acquire lock, skipping')
-            return
+        # job statuses are listed once per namespace in a round, see get_volume_job_statuses()
+        self.volume_job_statuses = {}
+
+        # Claim batches of due tasks until there are none left. Claiming takes a lease on the tasks, so other workers
+        # can work on the queue at the same time. The API limits the number of concurrent Jobs per cluster.
+        logging.debug('WorkspaceController: checking tasks')
+        for _ in range(TASK_MAX_BATCHES_PER_ROUND):
+            tasks = self.client.claim_tasks(
+                self.worker_id, limit=self.max_concurrent_tasks, lease_seconds=TASK_LEASE_SECONDS)
+            if not tasks:
+                break
+            for task in tasks:
+                self.process_task(task)
 
+    def process_task(self, task):
+        logging.debug(task)
         try:
-            logging.debug('WorkspaceController: checking tasks')
-            unfinished_tasks = self.client.get_tasks(unfinished=1)
+            if task.get('kind') == TaskStates.KIND_WORKSPACE_VOLUME_BACKUP:
+                done = self.process_volume_backup_task(task)
+            elif task.get('kind') == TaskStates.KIND_WORKSPACE_VOLUME_RESTORE:
+                done = self.process_volume_restore_task(task)
+            else:
+                raise RuntimeWarning('unknown task kind: %s' % task.get('kind'))
+        except Exception as e:
+            # the API retries the task with a backoff, or marks it FAILED when it is out of attempts
+            logging.warning('Task %s attempt %d failed due to "%s"', task.get('id'), task.get('attempts', 0) + 1, e)
+            self.client.release_task(task.get('id'), self.worker_id, error='\n'.join(e.__str__().splitlines()[:4]))
+            return
 
-            unfinished_tasks = sorted(
-                unfinished_tasks,
-                key=lambda t: '%d-%s' % (t.get('create_ts'), t.get('id')),
-                reverse=True
-            )
-            tasks = unfinished_tasks[:self.max_concurrent_tasks]
+        if not done:
+            # the Job is in progress, check it again later
+            self.client.release_task(task.get('id'), self.worker_id, delay=TASK_CHECK_INTERVAL)
 
-            for task in tasks:
-                logging.debug(task)
-                # process tasks and release the lock
-                try:
-                    if task.get('kind') == Task.KIND_WORKSPACE_VOLUME_BACKUP:
-                        self.process_volume_backup_task(task)
-                    elif task.get('kind') == Task.KIND_WORKSPACE_VOLUME_RESTORE:
-                        self.process_volume_restore_task(task)
-                    else:
-                        logging.warning('unknown task kind: %s' % task.kind)
-                except Exception as e:
-                    logging.warning('Marking task %s FAILED due to "%s"', task.get('id'), e)
-                    self.client.update_task(task.get('id'), state=Task.STATE_FAILED)
-                    self.client.add_task_results(
-                        task.get('id'),
-                        results='\n'.join(e.__str__().splitlines()[:4])
-                    )
-        finally:
-            self.client.release_lock(WS_CONTROLLER_TASK_LOCK_NAME, self.worker_id)
+    def get_volume_job_statuses(self, driver, cluster_name, workspace_id):
+        """Return the statuses of the backup and restore jobs for a workspace, listing them only once per round"""
+        key = (cluster_name, workspace_id)
+        if key not in self.volume_job_statuses:
+            self.volume_job_statuses[key] = driver.list_volume_jobs(self.client.token, workspace_id)
+        return self.volume_job_statuses[key]
 
     @staticmethod
     def get_volume_name(task_data):
@@ -351,26 +499,60 @@ class WorkspaceController(ControllerBase):
         if not driver:
             raise RuntimeError(
                 'No driver for cluster %s in task %s' % (task.get('data').get('cluster'), task.get('id')))
-        if task.get('state') == Task.STATE_NEW:
+        if task.get('data').get('type') == 'workspace-data':
+            return self.process_workspace_backup_task(task, driver)
+        if task.get('state') == TaskStates.STATE_NEW:
             logging.info('Starting processing of task %s', task.get('id'))
-            self.client.update_task(task.get('id'), state=Task.STATE_PROCESSING)
-
             driver.create_volume_backup_job(
                 self.client.token,
                 task.get('data').get('workspace_id'),
                 self.get_volume_name(task.get('data')),
             )
-        elif task.get('state') == Task.STATE_PROCESSING:
+            self.client.update_task(task.get('id'), state=TaskStates.STATE_PROCESSING)
+        elif task.get('state') == TaskStates.STATE_PROCESSING:
+            ws_id = task.get('data').get('workspace_id')
             if driver.check_volume_backup_job(
                     self.client.token,
-                    task.get('data').get('workspace_id'),
+                    ws_id,
                     self.get_volume_name(task.get('data')),
+                    self.get_volume_job_statuses(driver, task.get('data').get('cluster'), ws_id),
             ):
                 logging.info('Task %s FINISHED', task.get('id'))
-                self.client.update_task(task.get('id'), state=Task.STATE_FINISHED)
+                self.client.update_task(task.get('id'), state=TaskStates.STATE_FINISHED)
+                return True
         else:
             logging.warning(
                 'task %s in state %s should not end up in processing', task.get('id'), task.get('state'))
+            return True
+
+    def process_workspace_backup_task(self, task, driver):
+        """Back up all the volumes of a workspace in one Job, recording the status of each volume in task results"""
+        ws_id = task.get('data').get('workspace_id')
+        if task.get('state') == TaskStates.STATE_NEW:
+            logging.info('Starting processing of task %s', task.get('id'))
+            volume_names = driver.create_workspace_backup_job(self.client.token, ws_id)
+            self.client.update_task(task.get('id'), state=TaskStates.STATE_PROCESSING)
+            self.client.add_task_results(task.get('id'), 'backing up %d volumes' % len(volume_names))
+        elif task.get('state') == TaskStates.STATE_PROCESSING:
+            done, progress = driver.check_workspace_backup_job(self.client.token, ws_id)
+            # report the volumes that have been processed since the last check
+            new_results = [
+                '%s: %s' % (name, status) for name, status in sorted(progress.items())
+                if '%s: %s' % (name, status) not in task.get('results', [])
+            ]
+            if new_results:
+                self.client.add_task_results(task.get('id'), '\n'.join(new_results))
+            if done:
+                failed = sorted(name for name, status in progress.items() if status != 'ok')
+                if failed:
+                    raise RuntimeWarning('Backup failed for volumes %s' % ', '.join(failed))
+                logging.info('Task %s FINISHED', task.get('id'))
+                self.client.update_task(task.get('id'), state=TaskStates.STATE_FINISHED)
+                return True
+        else:
+            logging.warning(
+                'task %s in state %s should not end up in processing', task.get('id'), task.get('state'))
+            return True
 
     def process_volume_restore_task(self, task):
         task_data = task.get('data')
@@ -385,10 +567,9 @@ class WorkspaceController(ControllerBase):
         if not src_cluster:
             raise RuntimeError('No data.src_cluster in task %s' % task.get('id'))
 
-        if task.get('state') == Task.STATE_NEW:
+        if task.get('state') == TaskStates.STATE_NEW:
             logging.info('Starting processing of task %s', task.get('id'))
             ws = self.client.get_workspace(ws_id)
-            self.client.update_task(task.get('id'), state=Task.STATE_PROCESSING)
 
             # figure out right size for user work volume
             if task_data.get('type') == 'shared-data':
@@ -408,10 +589,18 @@ class WorkspaceController(ControllerBase):
                 storage_class=storage_class_name,
                 src_cluster=src_cluster,
             )
-        elif task.get('state') == Task.STATE_PROCESSING:
-            if driver.check_volume_restore_job(self.client.token, ws_id, self.get_volume_name(task_data)):
+            self.client.update_task(task.get('id'), state=TaskStates.STATE_PROCESSING)
+        elif task.get('state') == TaskStates.STATE_PROCESSING:
+            if driver.check_volume_restore_job(
+                    self.client.token,
+                    ws_id,
+                    self.get_volume_name(task_data),
+                    self.get_volume_job_statuses(driver, task_data.get('tgt_cluster'), ws_id),
+            ):
                 logging.info('Task %s FINISHED', task.get('id'))
-                self.client.update_task(task.get('id'), state=Task.STATE_FINISHED)
+                self.client.update_task(task.get('id'), state=TaskStates.STATE_FINISHED)
+                return True
         else:
             logging.warning(
                 'task %s in state %s should not end up in processing', task.get('id'), task.get('state'))
+            return True
@@ -1,13 +1,16 @@
 import logging
 import os
 import signal
+import threading
 from random import randrange
-from time import sleep
+from time import sleep, time
 
 from pebbles.client import PBClient
 from pebbles.config import RuntimeConfig
+from pebbles.metrics import start_worker_metrics_listener, time_worker_loop
 from pebbles.utils import init_logging, load_cluster_config
-from pebbles.worker.controllers import ApplicationSessionController, ClusterController, WorkspaceController
+from pebbles.worker.controllers import ApplicationSessionController, ClusterController, WorkspaceController, \
+    SESSION_CHANGE_FEED_TIMEOUT, WORKER_HEARTBEAT_INTERVAL
 
 
 class Worker:
@@ -71,33 +74,74 @@ class Worker:
 
     def run(self):
         logging.info('worker "%s" starting' % self.id)
+        start_worker_metrics_listener(self.config['WORKER_METRICS_PORT'])
 
         # TODO:
         # - housekeeping
 
+        # cluster alert polling runs in its own thread, so that slow cluster monitoring does not delay sessions
+        threading.Thread(target=self.run_cluster_controller, name='cluster-controller', daemon=True).start()
+        # A round of session processing can take longer than the heartbeat TTL, which would drop us from the ring of
+        # live workers and move our shard to the others. Keep the heartbeat going from a thread of its own.
+        heartbeat_thread = threading.Thread(target=self.run_heartbeat, name='worker-heartbeat', daemon=True)
+        heartbeat_thread.start()
+
         # check if we are being terminated and drop out of the loop
         while not self.terminate:
             logging.debug('worker main loop')
             # set watchdog timer
             signal.alarm(60 * 5)
 
-            # make sure we have a fresh session
-            self.client.check_and_refresh_session('worker@pebbles', self.api_key)
-
-            # process application sessions
-            self.application_session_controller.process()
+            with time_worker_loop('main'):
+                # make sure we have a fresh session
+                self.client.check_and_refresh_session('worker@pebbles', self.api_key)
 
-            # process clusters
-            self.cluster_controller.process()
+                # process application sessions
+                self.application_session_controller.process()
 
-            # process workspaces
-            self.workspace_controller.process()
+                # process workspaces
+                self.workspace_controller.process()
 
             # stop the watchdog
             signal.alarm(0)
 
+            # block on session changes until the next workspace check is due, fall back to polling
+            timeout = min(self.workspace_controller.next_check_ts - time(), SESSION_CHANGE_FEED_TIMEOUT)
+            if timeout < 1 or not self.application_session_controller.wait_for_changes(timeout):
+                sleep(1)
+            else:
+                # the change feed returns early when sessions are due, do not start a round before the controllers
+                # are ready for it
+                next_check_ts = min(
+                    self.application_session_controller.next_check_ts, self.workspace_controller.next_check_ts)
+                sleep(max(next_check_ts - time(), 0))
+
+        # make sure the heartbeat does not bring us back after we have left
+        heartbeat_thread.join(timeout=WORKER_HEARTBEAT_INTERVAL)
+        self.leave()
+
+    def run_cluster_controller(self):
+        while not self.terminate:
+            try:
+                with time_worker_loop(self.cluster_controller.controller_name):
+                    self.cluster_controller.process()
+            except Exception as e:
+                logging.warning('cluster controller failed: %s', e)
+            sleep(max(self.cluster_controller.next_check_ts - time(), 1))
+
+    def run_heartbeat(self):
+        while not self.terminate:
+            # rate limited to WORKER_HEARTBEAT_INTERVAL, check often to notice termination
+            self.application_session_controller.update_membership()
             sleep(1)
 
+    def leave(self):
+        # remove our heartbeat so that the other workers take over our shard right away
+        try:
+            self.client.delete_worker_heartbeat(self.id)
+        except Exception as e:
+            logging.warning('unable to delete worker heartbeat: %s', e)
+
 
 if __name__ == '__main__':
 
@@ -118,7 +162,11 @@ if __name__ == '__main__':
 
     init_logging(config, 'worker')
 
-    worker = Worker(config)
+    if config['WORKER_RUNTIME'] == 'async':
+        from pebbles.worker.async_worker import AsyncWorker
+        worker = AsyncWorker(config)
+    else:
+        worker = Worker(config)
     logging.getLogger().name = worker.id
 
     try:
@@ -0,0 +1,36 @@
+import bisect
+import hashlib
+
+# number of points per worker on the ring, more points give a more even distribution
+VIRTUAL_NODES = 64
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring for assigning keys (session ids) to workers. When a worker joins or leaves, only the keys
+    between its points and their predecessors move, the rest of the assignments stay put.
+    """
+
+    def __init__(self, members=(), virtual_nodes=VIRTUAL_NODES):
+        self.members = sorted(set(members))
+        points = sorted(
+            (ring_hash('%s#%d' % (member, i)), member)
+            for member in self.members
+            for i in range(virtual_nodes)
+        )
+        self.hashes = [h for h, _ in points]
+        self.owners = [m for _, m in points]
+
+    def __len__(self):
+        return len(self.members)
+
+    def get_owner(self, key):
+        """Return the member that owns the key, None for an empty ring"""
+        if not self.hashes:
+            return None
+        idx = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        return self.owners[idx]
@@ -2,6 +2,7 @@
 # PyTest global setup and fixture file
 #
 import base64
+import contextlib
 import datetime
 import json
 import time
@@ -15,6 +16,7 @@ from pebbles.models import (
     User, Workspace, WorkspaceMembership, ApplicationTemplate, Application,
     Message, ServiceAnnouncement, ApplicationSession, ApplicationSessionLog)
 from pebbles.models import db
+from pebbles.query_stats import collect_queries
 
 ADMIN_TOKEN = None
 USER_TOKEN = None
@@ -428,6 +430,15 @@ def rmaker(client, pri_data):
     return RequestMaker(client, pri_data)
 
 
+@contextlib.contextmanager
+def assert_max_queries(max_queries):
+    """Fail if the block, typically a single API request, runs more than max_queries SQL statements"""
+    with collect_queries() as stats:
+        yield stats
+    assert stats.count <= max_queries, 'expected at most %d queries, got %d:\n%s' % (
+        max_queries, stats.count, stats.format_statements())
+
+
 class RequestMaker():
     def __init__(self, client, pri_data: PrimaryData):
         self.client = client
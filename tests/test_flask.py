@@ -1,5 +1,6 @@
 from flask import Flask
 
+from pebbles.metrics import metrics_enabled
 from tests.conftest import PrimaryData, RequestMaker
 
 
@@ -10,3 +11,21 @@ def test_headers(app: Flask, rmaker: RequestMaker, pri_data: PrimaryData):
     required_headers = ('Cache-Control', 'Expires', 'Strict-Transport-Security', 'Content-Security-Policy')
     for h in required_headers:
         assert h in response.headers.keys()
+
+
+def test_metrics(app: Flask, rmaker: RequestMaker, pri_data: PrimaryData):
+    """Test that /metrics reports the API request latencies, or is not found without prometheus_client"""
+    rmaker.make_request(path='/api/v1/config')
+    response = rmaker.make_request(path='/metrics')
+    if not metrics_enabled():
+        assert response.status_code == 404
+        return
+
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    text = response.get_data(as_text=True)
+    assert 'pebbles_api_request_duration_seconds_count{endpoint="/api/v1/config",method="GET",status="200"}' in text
+
+    app.config['METRICS_ENABLED'] = False
+    response = rmaker.make_request(path='/metrics')
+    assert response.status_code == 404
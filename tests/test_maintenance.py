@@ -1,12 +1,14 @@
 # Test fixture methods to be called from app context so we can access the db
 import datetime
 import json
+import time
 
 from flask import Flask
 
 import pebbles.utils
-from pebbles.maintenance.main import run_workspace_expiry_cleanup, WORKSPACE_EXPIRY_GRACE_PERIOD
-from pebbles.models import Workspace
+from pebbles.maintenance.main import run_workspace_expiry_cleanup, run_alert_retention, \
+    run_membership_expiry_cleanup, WORKSPACE_EXPIRY_GRACE_PERIOD
+from pebbles.models import db, Alert, AlertHistory, User, Workspace, WorkspaceMembership
 from tests.conftest import PrimaryData
 
 
@@ -58,6 +60,24 @@ class PBClientMock:
         resp = self.request_api.delete('api/v1/%s' % url, headers=headers)
         return MockResponseAdapter(resp)
 
+    def do_post(self, url):
+        headers = {
+            'Accept': 'application/json',
+            'Authorization': 'Basic %s' % self.auth,
+            'token': self.token
+        }
+        resp = self.request_api.post('api/v1/%s' % url, headers=headers)
+        return MockResponseAdapter(resp)
+
+    def do_patch(self, url, json_data=None):
+        headers = {
+            'Accept': 'application/json',
+            'Authorization': 'Basic %s' % self.auth,
+            'token': self.token
+        }
+        resp = self.request_api.patch('api/v1/%s' % url, headers=headers, json=json_data)
+        return MockResponseAdapter(resp)
+
     def delete_workspace(self, workspace_id):
         return self.do_delete('workspaces/%s' % workspace_id)
 
@@ -94,3 +114,44 @@ def test_workspace_cleanup(app: Flask, pri_data: PrimaryData):
         assert ws.id in [w.id for w in wss_after]
     for ws in expired_workspaces_beyond_grace:
         assert ws.id not in [w.id for w in wss_after]
+
+
+def test_alert_retention(app: Flask, pri_data: PrimaryData):
+    old_alert = Alert(None, 'cluster-1', 'prometheus', 'archived', dict(labels=dict(alertname='Test')))
+    old_alert.first_seen_ts = old_alert.last_seen_ts = time.time() - 3600 * 24 * 60
+    new_alert = Alert(None, 'cluster-1', 'prometheus', 'archived', dict(labels=dict(alertname='Test'), x=1))
+    db.session.add_all([old_alert, new_alert])
+    db.session.commit()
+
+    pb_client = PBClientMock(app.test_client())
+    pb_client.login('admin@example.org', 'admin')
+    run_alert_retention(pb_client)
+
+    assert [a.id for a in Alert.query.all()] == [new_alert.id]
+    assert AlertHistory.query.one().num_alerts == 1
+
+
+def test_membership_expiry_cleanup(app: Flask, pri_data: PrimaryData):
+    # two workspaces with different timeouts, one member in each that has not logged in for 50 days
+    memberships = []
+    for timeout_days in (30, 60):
+        ws = Workspace(name='MembershipExpiry%d' % timeout_days)
+        ws.membership_expiry_policy = dict(kind=Workspace.MEP_ACTIVITY_TIMEOUT, timeout_days=timeout_days)
+        user = User('member-%d@example.org' % timeout_days, 'member')
+        user.last_login_ts = time.time() - 50 * 24 * 3600
+        owner = User('owner-%d@example.org' % timeout_days, 'owner')
+        owner.last_login_ts = time.time() - 100 * 24 * 3600
+        memberships.append(WorkspaceMembership(user=user, workspace=ws))
+        memberships.append(WorkspaceMembership(user=owner, workspace=ws, is_manager=True, is_owner=True))
+        db.session.add(ws)
+    db.session.commit()
+    ws30_id, ws60_id = memberships[0].workspace_id, memberships[2].workspace_id
+
+    pb_client = PBClientMock(app.test_client())
+    pb_client.login('admin@example.org', 'admin')
+    run_membership_expiry_cleanup(pb_client)
+
+    # only the member in the workspace with 30 day timeout is removed, owners are kept
+    assert WorkspaceMembership.query.filter_by(workspace_id=ws30_id).count() == 1
+    assert WorkspaceMembership.query.filter_by(workspace_id=ws30_id).one().is_owner
+    assert WorkspaceMembership.query.filter_by(workspace_id=ws60_id).count() == 2
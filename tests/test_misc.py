@@ -1,5 +1,13 @@
+import subprocess
+import sys
+
+import bcrypt
+import pytest
 from pyfakefs.fake_filesystem_unittest import Patcher
-from pebbles.utils import env_string_to_dict, read_list_from_text_file
+
+from pebbles.utils import env_string_to_dict, read_list_from_text_file, hash_passwords, PASSWORD_HASH_POOL_THRESHOLD, \
+    percentile
+from pebbles.views.commons import parse_user_import
 
 
 def test_parse_env_value():
@@ -38,3 +46,151 @@ def test_read_list_from_text_file():
         patcher.fs.create_file('/foo/test_file.txt', contents=file_contents)
         filtered_contents = read_list_from_text_file('/foo/test_file.txt')
         assert filtered_contents == ['test', 'hello', 'nowhitespace', 'alphabetic', 'Capital']
+
+
+def test_hash_ring():
+    from pebbles.worker.sharding import HashRing
+    keys = ['session-%d' % i for i in range(1000)]
+
+    assert HashRing().get_owner('foo') is None
+
+    ring = HashRing(['w1', 'w2', 'w3'])
+    owners = {key: ring.get_owner(key) for key in keys}
+    # all workers get a reasonable share
+    for worker in ('w1', 'w2', 'w3'):
+        assert 200 < list(owners.values()).count(worker) < 500
+
+    # when a worker leaves, only its keys move
+    ring2 = HashRing(['w1', 'w3'])
+    for key in keys:
+        if owners[key] != 'w2':
+            assert ring2.get_owner(key) == owners[key]
+        else:
+            assert ring2.get_owner(key) in ('w1', 'w3')
+
+
+def test_hash_passwords():
+    # enough passwords to use the process pool
+    passwords = ['password-%d' % i for i in range(PASSWORD_HASH_POOL_THRESHOLD + 1)]
+    hashes = hash_passwords(passwords, 4, max_workers=2)
+    assert len(hashes) == len(passwords)
+    for password, password_hash in zip(passwords, hashes):
+        assert bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 100) == 100
+    assert percentile(values, 0) == 1
+    assert percentile([7], 99) == 7
+    assert percentile([1, 2], 50) == 1
+
+
+def test_find_driver_class():
+    from pebbles.drivers import provisioning
+    from pebbles.drivers.provisioning.simulated_kubernetes_driver import SimulatedKubernetesDriver
+    assert provisioning.find_driver_class('SimulatedKubernetesDriver') is SimulatedKubernetesDriver
+    assert provisioning.find_driver_class('NoSuchDriver') is None
+    assert 'KubernetesLocalDriver' in provisioning.registered_drivers()
+
+    provisioning.register_driver(
+        'TestDriver', 'pebbles.drivers.provisioning.simulated_kubernetes_driver:SimulatedKubernetesDriver')
+    try:
+        assert provisioning.find_driver_class('TestDriver') is SimulatedKubernetesDriver
+    finally:
+        provisioning._drivers.pop('TestDriver')
+
+
+def test_worker_imports():
+    # the worker should not drag in the ORM, the API framework or the drivers at startup
+    code = 'import sys, pebbles.worker.main; print(" ".join(sorted(sys.modules)))'
+    modules = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.split()
+    for module in ('pebbles.models', 'flask', 'flask_sqlalchemy', 'sqlalchemy', 'jose', 'kubernetes', 'jinja2'):
+        assert module not in modules
+
+
+def test_gunicorn_config_workers():
+    from pebbles import gunicorn_config
+    assert gunicorn_config.default_workers('sync', 2) == 5
+    assert gunicorn_config.default_workers('gthread', 1) == 2
+    assert gunicorn_config.default_workers('gthread', 8) == 8
+
+    with Patcher() as patcher:
+        assert gunicorn_config.cgroup_cpu_limit() is None
+        patcher.fs.create_file(gunicorn_config.CGROUP_V1_CPU_QUOTA, contents='150000\n')
+        patcher.fs.create_file(gunicorn_config.CGROUP_V1_CPU_PERIOD, contents='100000\n')
+        assert gunicorn_config.cgroup_cpu_limit() == 1.5
+        patcher.fs.create_file(gunicorn_config.CGROUP_V2_CPU_MAX, contents='max 100000\n')
+        assert gunicorn_config.cgroup_cpu_limit() is None
+        patcher.fs.remove(gunicorn_config.CGROUP_V2_CPU_MAX)
+        patcher.fs.create_file(gunicorn_config.CGROUP_V2_CPU_MAX, contents='50000 100000\n')
+        assert gunicorn_config.cgroup_cpu_limit() == 0.5
+        assert gunicorn_config.available_cpus() == 1
+
+
+def test_gunicorn_config_streams():
+    from pebbles import gunicorn_config
+    from pebbles.config import BaseConfig, application_session_stream_max_per_process
+    config = BaseConfig()
+    # by default the streams can take half of the threads or gevent connections of a process
+    assert application_session_stream_max_per_process(config) == config.GUNICORN_THREADS // 2
+    config.GUNICORN_THREADS = 64
+    assert application_session_stream_max_per_process(config) == 32
+    config.GUNICORN_WORKER_CLASS = 'gevent'
+    assert application_session_stream_max_per_process(config) == config.GUNICORN_WORKER_CONNECTIONS // 2
+    config = BaseConfig()
+    assert gunicorn_config.check_stream_config(config, 'gthread', config.GUNICORN_THREADS) is None
+    assert gunicorn_config.check_stream_config(config, 'gevent', 1) is None
+    # streams would take all the threads
+    assert 'too few' in gunicorn_config.check_stream_config(config, 'gthread', config.GUNICORN_THREADS // 2)
+    config.APPLICATION_SESSION_STREAM_MAX_PER_PROCESS = 0
+    assert 'unlimited' in gunicorn_config.check_stream_config(config, 'gthread', config.GUNICORN_THREADS)
+    # a stream would block a sync worker until it is killed
+    with pytest.raises(RuntimeError):
+        gunicorn_config.check_stream_config(config, 'sync', 1)
+    config.APPLICATION_SESSION_STREAM_ENABLED = False
+    assert gunicorn_config.check_stream_config(config, 'sync', 1) is None
+
+
+def test_parse_user_import():
+    csv_data = 'ext_id,password,email_id\nuser-1@example.org,secret,\n user-2@example.org ,,u2@example.org\n'
+    assert parse_user_import(csv_data, 'csv') == [
+        dict(ext_id='user-1@example.org', password='secret', email_id=None),
+        dict(ext_id='user-2@example.org', password=None, email_id='u2@example.org'),
+    ]
+    assert parse_user_import('[{"ext_id": "user-1@example.org"}]', 'json') == [
+        dict(ext_id='user-1@example.org', password=None, email_id=None),
+    ]
+    for data, data_format in (('email_id\nu1@example.org\n', 'csv'), ('{"ext_id": "x"}', 'json'), ('', 'xml')):
+        try:
+            parse_user_import(data, data_format)
+            assert False, 'should have raised ValueError'
+        except ValueError:
+            pass
+
+
+def test_change_feed_cursors():
+    from pebbles.change_feed import ChangeFeed
+    feed = ChangeFeed(max_events=3)
+    start = feed.latest_cursor()
+    assert feed.parse_cursor(start) == 0
+    for i in range(3):
+        feed.publish(dict(kind='application_session', id='s%d' % i))
+    changes, cursor = feed.wait_for_changes(feed.parse_cursor(start), 0)
+    assert [c['id'] for c in changes] == ['s0', 's1', 's2']
+    assert cursor == changes[-1]['cursor'] == feed.latest_cursor()
+
+    # events that do not match the predicate move the cursor forward too
+    changes, cursor = feed.wait_for_changes(feed.parse_cursor(start), 0, predicate=lambda c: c['id'] == 's0')
+    assert [c['id'] for c in changes] == ['s0']
+    assert cursor == feed.latest_cursor()
+
+    # the cursors of other feeds and the ones that have fallen out of the feed cannot be used
+    feed.publish(dict(kind='application_session', id='s3'))
+    assert feed.parse_cursor(start) is None
+    assert feed.parse_cursor(changes[0]['cursor']) == 1
+    assert ChangeFeed().parse_cursor(feed.latest_cursor()) is None
+    for cursor in (None, '', '1700000000.5', '%s-x' % feed.feed_id, '%s-99' % feed.feed_id):
+        assert feed.parse_cursor(cursor) is None
@@ -9,8 +9,8 @@ from flask import Flask
 from jose import jwt
 
 from pebbles.models import PEBBLES_TAINT_KEY
-from pebbles.models import User, Workspace, ApplicationTemplate, Application, ApplicationSession
-from pebbles.models import db
+from pebbles.models import User, Workspace, ApplicationTemplate, Application, ApplicationSession, WorkspaceMembership
+from pebbles.models import db, load_yaml, upsert_objects
 
 
 @pytest.fixture()
@@ -94,6 +94,47 @@ def test_application_session_states(model_data: ModelDataFixture):
             pass
 
 
+def test_application_session_denormalized_columns(model_data: ModelDataFixture):
+    s1 = ApplicationSession(model_data.known_application, model_data.known_user)
+    assert s1.workspace_id == model_data.known_group.id
+
+    s1.provisioning_config = dict(memory_gib=2, cluster='dev_cluster')
+    assert s1.memory_gib == 2.0
+    assert s1.cluster == 'dev_cluster'
+
+    s1.provisioning_config = dict(memory_gib='foo')
+    assert s1.memory_gib is None
+    assert s1.cluster is None
+
+
+def test_json_column_modification_tracking(model_data: ModelDataFixture):
+    ws = model_data.known_group
+    ws.config = dict(allow_expiry_extension=False)
+    db.session.commit()
+
+    # modify in place, the change should be persisted
+    ws.config['allow_expiry_extension'] = True
+    db.session.commit()
+    db.session.expire_all()
+    assert Workspace.query.filter_by(id=ws.id).first().config == dict(allow_expiry_extension=True)
+
+    # NULL is read back as an empty dict
+    ws.config = None
+    db.session.commit()
+    db.session.expire_all()
+    ws = Workspace.query.filter_by(id=ws.id).first()
+    assert ws._config is None
+    assert ws.config == {}
+
+    application = model_data.known_application
+    application.labels = ['a', 'b']
+    db.session.commit()
+    application.labels.append('c')
+    db.session.commit()
+    db.session.expire_all()
+    assert Application.query.filter_by(id=application.id).first().labels == ['a', 'b', 'c']
+
+
 def test_token_generation(model_data: ModelDataFixture):
     u1 = model_data.known_user
     token = u1.generate_auth_token('test_secret', expires_in=100)
@@ -247,3 +288,80 @@ def test_application_session_name_generation():
     """
     names = {ApplicationSession.generate_name("pb") for _ in range(1000)}
     assert len(names) > 990
+
+
+def test_upsert_objects(model_data: ModelDataFixture):
+    data = """
+data:
+  - !WorkspaceMembership
+    workspace_id: ws-upsert
+    user_id: u-upsert
+    is_owner: True
+  - !Workspace
+    id: ws-upsert
+    name: Upsert
+    cluster: cluster-1
+  - !User
+    id: u-upsert
+    ext_id: upsert@example.org
+    password: upsert
+"""
+    counts = upsert_objects(load_yaml(data)['data'])
+    db.session.commit()
+    assert counts == dict(inserted=3, updated=0, skipped=0)
+    assert Workspace.query.filter_by(id='ws-upsert').one().cluster == 'cluster-1'
+    assert WorkspaceMembership.query.filter_by(workspace_id='ws-upsert', user_id='u-upsert').one().is_owner
+    user = User.query.filter_by(id='u-upsert').one()
+    assert user.check_password('upsert')
+    assert user.joining_ts
+
+    # without update, existing entries are skipped
+    counts = upsert_objects(load_yaml(data.replace('cluster-1', 'cluster-2'))['data'])
+    db.session.commit()
+    assert counts == dict(inserted=0, updated=0, skipped=3)
+    assert Workspace.query.filter_by(id='ws-upsert').one().cluster == 'cluster-1'
+
+    # with update, only changed entries are updated. Users are updated every time, password hashes have a new salt.
+    counts = upsert_objects(load_yaml(data.replace('cluster-1', 'cluster-2'))['data'], update=True)
+    db.session.commit()
+    assert counts == dict(inserted=0, updated=2, skipped=1)
+    db.session.expire_all()
+    assert Workspace.query.filter_by(id='ws-upsert').one().cluster == 'cluster-2'
+    assert User.query.filter_by(id='u-upsert').one().check_password('upsert')
+
+    # explicit nulls clear the columns, attributes that are not set are left alone
+    workspace_data = """
+data:
+  - !Workspace
+    id: ws-upsert
+    name: Upsert
+    cluster: null
+    description: null
+"""
+    workspace = Workspace.query.filter_by(id='ws-upsert').one()
+    workspace.description = 'to be cleared'
+    workspace.expiry_ts = 2000000000
+    db.session.commit()
+    counts = upsert_objects(load_yaml(workspace_data)['data'], update=True)
+    db.session.commit()
+    assert counts == dict(inserted=0, updated=1, skipped=0)
+    db.session.expire_all()
+    workspace = Workspace.query.filter_by(id='ws-upsert').one()
+    assert workspace.cluster is None
+    assert workspace.description is None
+    assert workspace.expiry_ts == 2000000000
+
+    # the counts come from the database, the second entry with the same id is not inserted
+    duplicate_data = """
+data:
+  - !Workspace
+    id: ws-upsert-2
+    name: Upsert 2
+  - !Workspace
+    id: ws-upsert-2
+    name: Upsert 2 again
+"""
+    counts = upsert_objects(load_yaml(duplicate_data)['data'])
+    db.session.commit()
+    assert counts == dict(inserted=1, updated=0, skipped=1)
+    assert Workspace.query.filter_by(id='ws-upsert-2').one().name == 'Upsert 2'
@@ -0,0 +1,79 @@
+#
+# Query budgets for the busiest endpoints.
+#
+# The number of SQL statements per request is checked against a budget for each role, so that an N+1 pattern, or any
+# other change that adds queries, fails here instead of in production. When a change legitimately needs more queries,
+# raise the budget in the same commit.
+#
+import logging
+
+import pytest
+
+from pebbles.query_stats import collect_queries
+from tests.conftest import PrimaryData, RequestMaker, assert_max_queries
+
+ROLES = ('admin', 'workspace_owner', 'user')
+
+# path, budgets for admin, workspace owner and user
+QUERY_BUDGETS = (
+    ('/api/v1/workspaces', (12, 8, 7)),
+    ('/api/v1/workspaces/{workspace_id}/members', (4, 4, 2)),
+    ('/api/v1/applications', (6, 2, 2)),
+    ('/api/v1/application_sessions', (4, 6, 7)),
+    ('/api/v1/workspaces/{workspace_id}/accounting', (2, 1, 1)),
+)
+
+
+@pytest.mark.parametrize('path,budgets', QUERY_BUDGETS)
+def test_query_budgets(rmaker: RequestMaker, pri_data: PrimaryData, path, budgets):
+    path = path.format(workspace_id=pri_data.known_workspace_id)
+    for role, budget in zip(ROLES, budgets):
+        make_request = getattr(rmaker, 'make_authenticated_%s_request' % role)
+        # the first request logs in and warms up caches
+        make_request(path=path)
+        with assert_max_queries(budget):
+            make_request(path=path)
+
+
+def test_server_timing_header(rmaker: RequestMaker, pri_data: PrimaryData):
+    rmaker.make_authenticated_admin_request(path='/api/v1/workspaces')
+    with collect_queries() as stats:
+        response = rmaker.make_authenticated_admin_request(path='/api/v1/workspaces')
+    assert response.status_code == 200
+    server_timing = response.headers['Server-Timing']
+    assert 'desc="%d queries"' % stats.count in server_timing
+    assert 'db-slowest;dur=' in server_timing
+    assert 'total;dur=' in server_timing
+
+
+def test_slow_request_logging(app, rmaker: RequestMaker, pri_data: PrimaryData, caplog):
+    rmaker.make_authenticated_admin_request(path='/api/v1/workspaces')
+    with caplog.at_level(logging.WARNING):
+        rmaker.make_authenticated_admin_request(path='/api/v1/workspaces')
+    assert 'slow request' not in caplog.text
+
+    app.config['SLOW_REQUEST_LOG_QUERY_COUNT'] = 1
+    with caplog.at_level(logging.WARNING):
+        rmaker.make_authenticated_admin_request(path='/api/v1/workspaces')
+    assert 'slow request GET /api/v1/workspaces' in caplog.text
+    assert 'SELECT' in caplog.text
+
+
+def test_slow_request_logging_long_poll(app, rmaker: RequestMaker, pri_data: PrimaryData, caplog):
+    resp = rmaker.make_authenticated_admin_request(path='/api/v1/application_sessions/changes')
+    cursor = resp.json['cursor']
+    app.config['SLOW_REQUEST_LOG_THRESHOLD'] = 0.05
+
+    # waiting for changes does not make the long-poll slow
+    with caplog.at_level(logging.WARNING):
+        resp = rmaker.make_authenticated_admin_request(
+            path='/api/v1/application_sessions/changes?since=%s&timeout=0.2' % cursor)
+    assert resp.status_code == 200
+    assert 'slow request' not in caplog.text
+
+    # slow database time still does
+    app.config['SLOW_REQUEST_LOG_THRESHOLD'] = 1e-9
+    with caplog.at_level(logging.WARNING):
+        rmaker.make_authenticated_admin_request(
+            path='/api/v1/application_sessions/changes?since=%s&timeout=0.2' % cursor)
+    assert 'slow request GET /api/v1/application_sessions/changes' in caplog.text
@@ -0,0 +1,215 @@
+import logging
+import time
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from kubernetes.client.rest import ApiException
+
+from pebbles.config import BaseConfig
+from pebbles.drivers.provisioning.simulated_kubernetes_driver import SimulatedCluster, SimulatedKubernetesDriver, \
+    parse_label_selector
+
+
+def create_cluster(**kwargs):
+    cluster_config = dict(name='simulated', simulatedApiLatency=0, simulatedPodStartupTime=60, simulatedImagePullTime=0)
+    cluster_config.update(kwargs)
+    cluster = SimulatedCluster(cluster_config)
+    cluster.create('Namespace', None, dict(metadata=dict(name='ns-1')))
+    return cluster
+
+
+def make_ready(cluster, namespace, pod_name):
+    cluster.objects[('Pod', namespace, pod_name)]['_simulation']['ready_ts'] = time.time() - 1
+
+
+def list_names(cluster, kind, namespace='ns-1', label_selector=None):
+    return sorted(o['metadata']['name'] for o in cluster.get(kind, namespace, label_selector=label_selector)['items'])
+
+
+def deployment_body(name):
+    labels = dict(app=name)
+    return dict(
+        metadata=dict(name=name),
+        spec=dict(
+            selector=dict(matchLabels=labels),
+            template=dict(metadata=dict(labels=labels), spec=dict(containers=[dict(name='c', image='img')]))
+        )
+    )
+
+
+def job_body(name, suspend=False):
+    return dict(
+        metadata=dict(name=name),
+        spec=dict(
+            suspend=suspend,
+            template=dict(
+                metadata=dict(labels=dict(application='test-job')),
+                spec=dict(
+                    containers=[dict(name='c', image='img')],
+                    volumes=[dict(name='v', persistentVolumeClaim=dict(claimName='pvc-1'))],
+                )
+            )
+        )
+    )
+
+
+def test_parse_label_selector():
+    assert parse_label_selector('') == []
+    assert parse_label_selector('app=foo') == [('app', {'foo'})]
+    assert parse_label_selector('app in (foo, bar),job-name=backup-1') == [
+        ('app', {'foo', 'bar'}),
+        ('job-name', {'backup-1'}),
+    ]
+    assert parse_label_selector('pebbles.csc.fi/backup=yes, tier = web') == [
+        ('pebbles.csc.fi/backup', {'yes'}),
+        ('tier', {'web'}),
+    ]
+    for label_selector in ('!app', 'app!=foo', 'app notin (foo)'):
+        with pytest.raises(ApiException) as e:
+            parse_label_selector(label_selector)
+        assert e.value.status == 400
+
+
+def test_deployment_delete_cascades_to_pods():
+    cluster = create_cluster()
+    cluster.create('Deployment', 'ns-1', deployment_body('d1'))
+    cluster.create('Deployment', 'ns-1', deployment_body('d2'))
+    pods = list_names(cluster, 'Pod')
+    assert len(pods) == 2
+    assert len(list_names(cluster, 'Pod', label_selector='app=d1')) == 1
+
+    cluster.delete('Deployment', 'ns-1', name='d1')
+    assert list_names(cluster, 'Deployment') == ['d2']
+    assert list_names(cluster, 'Pod') == list_names(cluster, 'Pod', label_selector='app=d2')
+    assert len(list_names(cluster, 'Pod')) == 1
+
+    with pytest.raises(ApiException) as e:
+        cluster.delete('Deployment', 'ns-1', name='d1')
+    assert e.value.status == 404
+
+
+def test_namespace_delete_cascades():
+    cluster = create_cluster()
+    cluster.create('Namespace', None, dict(metadata=dict(name='ns-2')))
+    cluster.create('Deployment', 'ns-1', deployment_body('d1'))
+    cluster.create('Deployment', 'ns-2', deployment_body('d1'))
+    cluster.create('PersistentVolumeClaim', 'ns-1', dict(metadata=dict(name='pvc-1')))
+
+    cluster.delete('Namespace', name='ns-1')
+    assert [key for key in cluster.objects if key[1] == 'ns-1'] == []
+    assert list_names(cluster, 'Deployment', 'ns-2') == ['d1']
+    assert len(list_names(cluster, 'Pod', 'ns-2')) == 1
+    assert list_names(cluster, 'Namespace', None) == ['ns-2']
+
+    # objects cannot be created in a namespace that does not exist
+    with pytest.raises(ApiException) as e:
+        cluster.create('Deployment', 'ns-1', deployment_body('d1'))
+    assert e.value.status == 404
+
+
+def test_pod_phases():
+    cluster = create_cluster()
+    cluster.create('Deployment', 'ns-1', deployment_body('d1'))
+    pod_name = list_names(cluster, 'Pod')[0]
+    pod = cluster.get('Pod', 'ns-1', name=pod_name)
+    assert pod['status']['phase'] == 'Pending'
+    assert not pod['status']['containerStatuses'][0]['ready']
+
+    make_ready(cluster, 'ns-1', pod_name)
+    pod = cluster.get('Pod', 'ns-1', name=pod_name)
+    assert pod['status']['phase'] == 'Running'
+    assert pod['status']['containerStatuses'][0]['ready']
+    events = cluster.get('Event', 'ns-1', field_selector='involvedObject.name=%s' % pod_name)['items']
+    assert events[-1]['message'] == 'Created container pebbles-session'
+
+    # a pod that fails to pull its image never becomes ready
+    failing_cluster = create_cluster(simulatedPodFailureRate=1)
+    failing_cluster.create('Deployment', 'ns-1', deployment_body('d1'))
+    pod_name = list_names(failing_cluster, 'Pod')[0]
+    make_ready(failing_cluster, 'ns-1', pod_name)
+    pod = failing_cluster.get('Pod', 'ns-1', name=pod_name)
+    assert pod['status']['phase'] == 'Pending'
+    assert not pod['status']['containerStatuses'][0]['ready']
+    events = failing_cluster.get('Event', 'ns-1', field_selector='involvedObject.name=%s' % pod_name)['items']
+    assert events[-1]['message'].startswith('Failed to pull image')
+
+
+def test_job_phases():
+    cluster = create_cluster()
+    job = cluster.create('Job', 'ns-1', job_body('job-1'))
+    assert job['status'] == {}
+    pod_name = list_names(cluster, 'Pod', label_selector='job-name=job-1')[0]
+    assert cluster.get('Pod', 'ns-1', name=pod_name)['status']['phase'] == 'Pending'
+
+    make_ready(cluster, 'ns-1', pod_name)
+    assert cluster.get('Pod', 'ns-1', name=pod_name)['status']['phase'] == 'Succeeded'
+    job = cluster.get('Job', 'ns-1', name='job-1')
+    assert job['status']['succeeded'] == 1
+    assert job['status']['conditions'] == [dict(type='Complete', status='True')]
+
+    failing_cluster = create_cluster(simulatedPodFailureRate=1)
+    failing_cluster.create('Job', 'ns-1', job_body('job-1'))
+    pod_name = list_names(failing_cluster, 'Pod', label_selector='job-name=job-1')[0]
+    make_ready(failing_cluster, 'ns-1', pod_name)
+    assert failing_cluster.get('Pod', 'ns-1', name=pod_name)['status']['phase'] == 'Failed'
+    job = failing_cluster.get('Job', 'ns-1', name='job-1')
+    assert job['status']['failed'] == 1
+    assert job['status']['conditions'] == [dict(type='Failed', status='True')]
+
+
+def test_suspended_job():
+    cluster = create_cluster()
+    cluster.create('Job', 'ns-1', job_body('job-1', suspend=True))
+    assert list_names(cluster, 'Pod') == []
+    assert cluster.get('Job', 'ns-1', name='job-1')['status'] == {}
+
+    # resuming the job starts its pod
+    job = cluster.patch('Job', 'ns-1', 'job-1', dict(spec=dict(suspend=False)))
+    assert job['spec']['suspend'] is False
+    assert len(list_names(cluster, 'Pod', label_selector='job-name=job-1')) == 1
+
+
+def test_workspace_backup_jobs():
+    cluster_config = dict(
+        name='simulated-backup', simulatedApiLatency=0, simulatedPodStartupTime=0, simulatedImagePullTime=0,
+        backupVolumesPerPod=2, backupParallelism=2,
+    )
+    driver = SimulatedKubernetesDriver(logging.getLogger(), BaseConfig(), cluster_config, None)
+    driver.pb_client = mock.Mock()
+    driver.pb_client.get_workspace.return_value = dict(pseudonym='ws-1')
+    driver.connect()
+    cluster = driver.dynamic_client.cluster
+    namespace = driver.get_namespace('ws-1')
+    cluster.create('Namespace', None, dict(metadata=dict(name=namespace)))
+    pvc_names = ['pvc-%d' % i for i in range(5)]
+    for pvc_name in pvc_names:
+        cluster.create('PersistentVolumeClaim', namespace, dict(
+            metadata=dict(name=pvc_name, annotations={'pebbles.csc.fi/backup': 'yes'})))
+
+    with mock.patch.object(Path, 'read_text', return_value='secret'):
+        assert driver.create_workspace_backup_job(None, 'ws-1') == pvc_names
+
+    # one job per chunk, each pod mounts only the volumes of its chunk and the jobs beyond parallelism wait
+    jobs = {o['metadata']['name']: o for o in cluster.get('Job', namespace)['items']}
+    assert sorted(jobs) == ['backup-workspace-0', 'backup-workspace-1', 'backup-workspace-2']
+    assert [jobs[name]['spec']['suspend'] for name in sorted(jobs)] == [False, False, True]
+    mounted = sorted(
+        [v['persistentVolumeClaim']['claimName'] for v in job['spec']['template']['spec']['volumes']
+         if 'persistentVolumeClaim' in v]
+        for job in jobs.values()
+    )
+    assert mounted == [['pvc-0', 'pvc-1'], ['pvc-2', 'pvc-3'], ['pvc-4']]
+
+    # the finished jobs make room for the suspended one
+    done, progress = driver.check_workspace_backup_job(None, 'ws-1')
+    assert not done
+    assert all(progress[name] == 'ok' for name in pvc_names[:4])
+    assert not cluster.get('Job', namespace, name='backup-workspace-2')['spec']['suspend']
+
+    done, progress = driver.check_workspace_backup_job(None, 'ws-1')
+    assert done
+    assert progress == {name: 'ok' for name in pvc_names}
+    assert list_names(cluster, 'Job', namespace) == []
+    assert list_names(cluster, 'Pod', namespace) == []
+    assert list_names(cluster, 'Secret', namespace) == []
@@ -0,0 +1,238 @@
+import asyncio
+import signal
+import threading
+
+import pytest
+
+from pebbles.client import PBClient
+from pebbles.config import BaseConfig
+from pebbles.worker.async_worker import AsyncWorker, LIVENESS_TIMEOUT_ROUNDS
+from pebbles.worker.controllers import ApplicationSessionController
+
+
+class StubClient:
+    """Stands in for PBClient, records the calls made by the controllers"""
+
+    def __init__(self, sessions=(), fail_get_session=False):
+        self.sessions = list(sessions)
+        self.fail_get_session = fail_get_session
+        self.calls = []
+        # workers returned by the heartbeat, by default only the caller
+        self.live_workers = None
+        self.heartbeat_sent = threading.Event()
+
+    def send_worker_heartbeat(self, worker_id):
+        self.heartbeat_sent.set()
+        return [worker_id] if self.live_workers is None else self.live_workers
+
+    def get_application_sessions(self, limit=None):
+        self.calls.append(('get_application_sessions',))
+        return self.sessions
+
+    def get_application_session(self, session_id, suppress_404=False):
+        if self.fail_get_session:
+            raise RuntimeError('simulated failure')
+        return next(s for s in self.sessions if s['id'] == session_id)
+
+    def query_locks(self):
+        return []
+
+    def obtain_lock(self, lock_id, owner):
+        self.calls.append(('obtain_lock', lock_id))
+        return lock_id
+
+    def release_lock(self, lock_id, owner):
+        self.calls.append(('release_lock', lock_id))
+
+    def do_application_session_patch(self, session_id, json_data):
+        self.calls.append(('patch', session_id, json_data))
+
+
+def create_session_controller(client):
+    return ApplicationSessionController('worker-1', {}, dict(clusters=[]), client, 'APPLICATION_SESSION_CONTROLLER')
+
+
+def test_due_sessions_keep_polling_interval():
+    client = StubClient()
+    controller = create_session_controller(client)
+    controller.process()
+    assert client.calls == [('get_application_sessions',)]
+
+    # a session that stays due wakes the controller up, but the next round waits for the minimum polling interval
+    for _ in range(5):
+        controller.handle_changes(dict(cursor=1, changes=[], due=True))
+        assert controller.next_check_ts == controller.round_ts + controller.polling_interval_min
+        controller.process()
+    assert client.calls == [('get_application_sessions',)]
+
+    # so does a resync after the long-poll landed on another API process
+    controller.handle_changes(dict(cursor='feed-2', changes=[], due=False, resync=True))
+    assert controller.next_check_ts == controller.round_ts + controller.polling_interval_min
+    controller.process()
+    assert client.calls == [('get_application_sessions',)]
+
+    # real changes are acted on right away
+    controller.handle_changes(dict(cursor=2, changes=[dict(kind='application_session', id='s1')], due=False))
+    assert controller.next_check_ts == 0
+    controller.process()
+    assert client.calls == [('get_application_sessions',)] * 2
+
+
+def test_session_processing_failure_backs_off():
+    session = dict(id='s1', name='session-1', state='queueing', to_be_deleted=False, lifetime_left=0,
+                   maximum_lifetime=0, log_fetch_pending=False)
+    client = StubClient(sessions=[session], fail_get_session=True)
+    controller = create_session_controller(client)
+    controller.process()
+    assert client.calls == [
+        ('get_application_sessions',),
+        ('obtain_lock', 's1'),
+        ('patch', 's1', dict(backoff=True)),
+        ('release_lock', 's1'),
+    ]
+
+
+def test_session_controller_membership():
+    client = StubClient()
+    controller = create_session_controller(client)
+
+    # the heartbeat response can miss us, e.g. when it is read from a lagging replica, we still own a shard
+    client.live_workers = ['worker-2', 'worker-3']
+    controller.update_membership()
+    assert controller.hash_ring.members == ['worker-1', 'worker-2', 'worker-3']
+    assert any(controller.is_own_session(dict(id='session-%d' % i)) for i in range(20))
+
+    # rate limited
+    client.live_workers = ['worker-1']
+    controller.update_membership()
+    assert len(controller.hash_ring) == 3
+    controller.heartbeat_ts = 0
+    controller.update_membership()
+    assert controller.hash_ring.members == ['worker-1']
+
+
+class StubController:
+    """Controller whose process() blocks until released, recording how many rounds run at the same time"""
+
+    def __init__(self, controller_name='STUB_CONTROLLER'):
+        self.controller_name = controller_name
+        self.next_check_ts = 0
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.running = 0
+        self.max_running = 0
+
+    def enter(self):
+        with self.lock:
+            self.calls += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def leave(self):
+        with self.lock:
+            self.running -= 1
+
+    def process(self):
+        self.enter()
+        self.release.wait(10)
+        self.leave()
+
+    def process_session_with_lock(self, session, locked_session_ids):
+        self.process()
+
+
+@pytest.fixture
+def async_worker(monkeypatch, tmp_path):
+    monkeypatch.setattr(PBClient, 'login', lambda self, ext_id, password: None)
+    cluster_config_file = tmp_path / 'cluster-config.yaml'
+    cluster_config_file.write_text('clusters: []\n')
+    cluster_passwords_file = tmp_path / 'cluster-passwords.yaml'
+    cluster_passwords_file.write_text('{}\n')
+    config = BaseConfig()
+    config.CLUSTER_CONFIG_FILE = str(cluster_config_file)
+    config.CLUSTER_PASSWORDS_FILE = str(cluster_passwords_file)
+    config.WORKER_MAX_CONCURRENT_SESSION_OPERATIONS = 2
+
+    # the worker installs signal handlers, put the original ones back afterwards
+    signal_handlers = {s: signal.getsignal(s) for s in (signal.SIGTERM, signal.SIGALRM)}
+    worker = AsyncWorker(config)
+    worker.operation_timeout = 0.1
+    yield worker
+    for s, handler in signal_handlers.items():
+        signal.signal(s, handler)
+
+
+def test_async_controller_rounds_do_not_overlap(async_worker):
+    controller = StubController()
+
+    async def run():
+        task = asyncio.create_task(async_worker.controller_loop(controller))
+        # the first round times out but keeps running, the following rounds are skipped until it has finished
+        await asyncio.sleep(2.5)
+        assert controller.calls == 1
+        controller.release.set()
+        await asyncio.sleep(1.5)
+        task.cancel()
+
+    asyncio.run(run())
+    assert controller.calls >= 2
+    assert controller.max_running == 1
+    assert async_worker.check_liveness() is None
+
+
+def test_async_session_operations_are_bounded(async_worker):
+    controller = StubController()
+    async_worker.application_session_controller = controller
+
+    async def run():
+        async_worker.session_operation_semaphore = asyncio.Semaphore(async_worker.max_concurrent_session_operations)
+        sessions = [dict(id='s%d' % i, name='session-%d' % i) for i in range(5)]
+        async_worker.sessions_in_progress.update(s['id'] for s in sessions)
+        tasks = [asyncio.create_task(async_worker.process_session(s, [])) for s in sessions]
+        # the operations time out, but the hung threads keep their slots
+        await asyncio.sleep(0.5)
+        assert controller.calls == 2
+        assert len(async_worker.running_since) == 2
+        controller.release.set()
+        await asyncio.gather(*tasks)
+        # let the done callbacks of the last threads run
+        while async_worker.sessions_in_progress:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert controller.calls == 5
+    assert controller.max_running == 2
+    assert not async_worker.running_since
+
+
+def test_async_worker_liveness(async_worker):
+    controller = StubController()
+
+    async def run():
+        task = asyncio.create_task(async_worker.controller_loop(controller))
+        await asyncio.sleep(0.2)
+        assert async_worker.check_liveness() is None
+        # the round hangs for longer than the liveness limit
+        await asyncio.sleep(LIVENESS_TIMEOUT_ROUNDS * async_worker.operation_timeout)
+        assert 'STUB_CONTROLLER round' in async_worker.check_liveness()
+        controller.release.set()
+        await asyncio.sleep(0.1)
+        assert async_worker.check_liveness() is None
+        task.cancel()
+
+    asyncio.run(run())
+
+
+def test_worker_heartbeat_thread(async_worker):
+    # the heartbeat is sent while the main loop is busy with a long round
+    client = StubClient()
+    async_worker.application_session_controller.client = client
+    heartbeat_thread = threading.Thread(target=async_worker.run_heartbeat, daemon=True)
+    heartbeat_thread.start()
+    assert client.heartbeat_sent.wait(5)
+    assert async_worker.application_session_controller.hash_ring.members == [async_worker.id]
+
+    async_worker.terminate = True
+    heartbeat_thread.join(5)
+    assert not heartbeat_thread.is_alive()
@@ -1,5 +1,8 @@
+import datetime
 import json
+import time
 
+from pebbles.models import db, Alert, AlertHistory
 from tests.conftest import PrimaryData, RequestMaker
 
 
@@ -110,3 +113,103 @@ def test_alerts_admin(rmaker: RequestMaker, pri_data: PrimaryData):
     )
     assert response.status_code == 200
     assert len(response.json) == 3
+
+
+def test_alerts_upsert(rmaker: RequestMaker, pri_data: PrimaryData):
+    alert = dict(target='cluster-1', source='prometheus', status='firing', data=dict(name='alert1'))
+    ok = dict(target='cluster-1', source='prometheus', status='ok', data=dict())
+
+    # duplicates in the same batch are merged
+    response = rmaker.make_authenticated_admin_request(
+        method='POST',
+        path='/api/v1/alerts',
+        data=json.dumps([alert, ok, alert])
+    )
+    assert response.status_code == 200
+    assert [a['status'] for a in response.json] == ['firing', 'ok']
+    first_seen_ts = response.json[0]['first_seen_ts']
+
+    # existing alerts are updated in place and keep their first_seen_ts
+    time.sleep(1)
+    alert['status'] = 'archived'
+    response = rmaker.make_authenticated_admin_request(
+        method='POST',
+        path='/api/v1/alerts',
+        data=json.dumps([alert])
+    )
+    assert response.status_code == 200
+    assert response.json[0]['status'] == 'archived'
+    assert response.json[0]['first_seen_ts'] == first_seen_ts
+    assert response.json[0]['last_seen_ts'] > first_seen_ts
+
+
+def test_system_status(app, rmaker: RequestMaker, pri_data: PrimaryData):
+    response = rmaker.make_request(path='/api/v1/status')
+    assert response.status_code == 200
+    assert response.json == 'ok'
+
+    ok = dict(target='cluster-1', source='prometheus', status='ok', data=dict())
+    alert = dict(target='cluster-1', source='prometheus', status='firing', data=dict(name='alert1'))
+    rmaker.make_authenticated_admin_request(method='POST', path='/api/v1/alerts', data=json.dumps([ok]))
+    response = rmaker.make_request(path='/api/v1/status')
+    assert response.json == 'ok'
+
+    rmaker.make_authenticated_admin_request(method='POST', path='/api/v1/alerts', data=json.dumps([alert, ok]))
+    response = rmaker.make_request(path='/api/v1/status')
+    assert response.json == 'warning'
+
+    # stale 'ok' status is a warning, too
+    rmaker.make_authenticated_admin_request(method='POST', path='/api/v1/alert_reset/cluster-1/prometheus')
+    response = rmaker.make_request(path='/api/v1/status')
+    assert response.json == 'ok'
+    db_alert = Alert.query.filter_by(status='ok').first()
+    db_alert.last_seen_ts = time.time() - 3600
+    db.session.commit()
+    response = rmaker.make_request(path='/api/v1/status')
+    assert response.json == 'warning'
+
+    # with caching, the change is not visible right away
+    app.config['SYSTEM_STATUS_CACHE_TTL'] = 60
+    rmaker.make_authenticated_admin_request(method='POST', path='/api/v1/alerts', data=json.dumps([ok]))
+    response = rmaker.make_request(path='/api/v1/status')
+    assert response.json == 'warning'
+
+
+def test_alert_compaction(rmaker: RequestMaker, pri_data: PrimaryData):
+    alerts = [
+        dict(target='cluster-1', source='prometheus', status='archived',
+             data=dict(labels=dict(alertname='KubeNodeNotReady'), id=i))
+        for i in range(3)
+    ] + [
+        dict(target='cluster-1', source='prometheus', status='firing',
+             data=dict(labels=dict(alertname='KubeNodeNotReady'), id=4))
+    ]
+    rmaker.make_authenticated_admin_request(method='POST', path='/api/v1/alerts', data=json.dumps(alerts))
+
+    # only admins
+    response = rmaker.make_authenticated_user_request(method='POST', path='/api/v1/alerts/compact')
+    assert response.status_code == 403
+
+    # nothing is old enough
+    response = rmaker.make_authenticated_admin_request(method='POST', path='/api/v1/alerts/compact')
+    assert response.status_code == 200
+    assert response.json['num_compacted'] == 0
+
+    response = rmaker.make_authenticated_admin_request(method='POST', path='/api/v1/alerts/compact?retention_days=0')
+    assert response.status_code == 200
+    assert response.json['num_compacted'] == 3
+
+    # more alerts for the same day are merged into the history
+    more_alerts = [dict(alerts[0], data=dict(alerts[0]['data'], id=i)) for i in (9, 10)]
+    rmaker.make_authenticated_admin_request(method='POST', path='/api/v1/alerts', data=json.dumps(more_alerts))
+    response = rmaker.make_authenticated_admin_request(method='POST', path='/api/v1/alerts/compact?retention_days=0')
+    assert response.json['num_compacted'] == 2
+
+    response = rmaker.make_authenticated_admin_request(path='/api/v1/alerts?include_archived=1')
+    assert [a['status'] for a in response.json] == ['firing']
+
+    history = AlertHistory.query.all()
+    assert len(history) == 1
+    assert history[0].name == 'KubeNodeNotReady'
+    assert history[0].num_alerts == 5
+    assert history[0].day == datetime.date.today()
@@ -166,35 +166,54 @@ def test_get_application_session_list_vs_view(rmaker: RequestMaker, pri_data: Pr
 
 
 def test_get_application_sessions_limit(rmaker: RequestMaker, pri_data: PrimaryData):
-    # First, test_get_application_sessions() duplicated with additional limit=10 parameter
+    # With limit, the sessions that are due for processing are returned in work queue order
 
     # Anonymous
     resp = rmaker.make_request(path='/api/v1/application_sessions?limit=10')
     assert resp.status_code == 401
 
-    # Authenticated
+    # Nothing is due in the initial data: running sessions have not reached their lifetime
+    # and failed sessions are not processed
     resp = rmaker.make_authenticated_user_request(path='/api/v1/application_sessions?limit=10')
     assert resp.status_code == 200
-    assert len(resp.json) == 2
+    assert len(resp.json) == 0
 
-    # Workspace Manager (His own session + other sessions from his managed workspaces)
-    resp = rmaker.make_authenticated_workspace_owner_request(path='/api/v1/application_sessions?limit=10')
+    resp = rmaker.make_authenticated_admin_request(path='/api/v1/application_sessions?limit=10')
     assert resp.status_code == 200
-    assert len(resp.json) == 3
+    assert len(resp.json) == 0
 
-    # Admin
+    # log fetching makes a running session due
+    s5 = db.session.scalar(
+        select(ApplicationSession).where(ApplicationSession.id == pri_data.known_application_session_id_5)
+    )
+    s5.log_fetch_pending = True
+    db.session.commit()
     resp = rmaker.make_authenticated_admin_request(path='/api/v1/application_sessions?limit=10')
     assert resp.status_code == 200
-    assert len(resp.json) == 4
+    assert [s['id'] for s in resp.json] == [pri_data.known_application_session_id_5]
 
-    # Then, test actual limits
+    # sessions past their maximum lifetime are due
+    s1 = db.session.scalar(
+        select(ApplicationSession).where(ApplicationSession.id == pri_data.known_application_session_id)
+    )
+    s1.provisioned_at = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    db.session.commit()
+    resp = rmaker.make_authenticated_admin_request(path='/api/v1/application_sessions?limit=10')
+    assert resp.status_code == 200
+    assert len(resp.json) == 2
+    assert resp.json[0]['id'] == pri_data.known_application_session_id
 
     # simple limit
-    resp = rmaker.make_authenticated_admin_request(path='/api/v1/application_sessions?limit=3')
+    resp = rmaker.make_authenticated_admin_request(path='/api/v1/application_sessions?limit=1')
     assert resp.status_code == 200
-    assert len(resp.json) == 3
+    assert len(resp.json) == 1
+
+    # user only sees own due sessions
+    resp = rmaker.make_authenticated_user_request(path='/api/v1/application_sessions?limit=10')
+    assert resp.status_code == 200
+    assert [s['id'] for s in resp.json] == [pri_data.known_application_session_id]
 
-    # setup one highest priority session (to_be_deleted), check that it is returned as the only one
+    # setup one highest priority session (to_be_deleted), check that it is returned first
     s2 = db.session.scalar(
         select(ApplicationSession).where(ApplicationSession.id == pri_data.known_application_session_id_2)
     )
@@ -206,9 +225,6 @@ def test_get_application_sessions_limit(rmaker: RequestMaker, pri_data: PrimaryD
     assert resp.json[0]['id'] == pri_data.known_application_session_id_2
 
     # setup second high priority session (to_be_deleted), check that both are first
-    s1 = db.session.scalar(
-        select(ApplicationSession).where(ApplicationSession.id == pri_data.known_application_session_id)
-    )
     s1.to_be_deleted = True
     db.session.commit()
     resp = rmaker.make_authenticated_admin_request(path='/api/v1/application_sessions?limit=3')
@@ -217,13 +233,13 @@ def test_get_application_sessions_limit(rmaker: RequestMaker, pri_data: PrimaryD
     assert set([resp.json[0]['id'], resp.json[1]['id']]) == \
            set([pri_data.known_application_session_id, pri_data.known_application_session_id_2])
 
-    # QUEUEING, PROVISIONING, STARTING should come right after to_be_deleted
+    # QUEUEING and STARTING should come right after to_be_deleted, PROVISIONING is not due
     s7 = ApplicationSession(
         Application.query.filter_by(id=pri_data.known_application_id).first(),
         User.query.filter_by(ext_id="user@example.org").first())
     s7.name = 'pb-s7'
-    s7.provisioned_at = datetime.datetime.strptime("2023-12-19T13:00:00", "%Y-%m-%dT%H:%M:%S")
     db.session.add(s7)
+    db.session.commit()
     for state in [
         ApplicationSession.STATE_QUEUEING, ApplicationSession.STATE_PROVISIONING, ApplicationSession.STATE_STARTING
     ]:
@@ -231,10 +247,38 @@ def test_get_application_sessions_limit(rmaker: RequestMaker, pri_data: PrimaryD
         db.session.commit()
         resp = rmaker.make_authenticated_admin_request(path='/api/v1/application_sessions?limit=5')
         assert resp.status_code == 200
-        assert len(resp.json) == 5
         assert set([resp.json[0]['id'], resp.json[1]['id']]) == \
                set([pri_data.known_application_session_id, pri_data.known_application_session_id_2])
-        assert resp.json[2]['id'] == s7.id, f'state {state} did not get sorted as second priority'
+        if state == ApplicationSession.STATE_PROVISIONING:
+            assert len(resp.json) == 3
+            assert s7.id not in [s['id'] for s in resp.json]
+        else:
+            assert len(resp.json) == 4
+            assert resp.json[2]['id'] == s7.id, f'state {state} did not get sorted as second priority'
+
+    # a starting session that is not ready yet backs off and drops out of the queue for a while
+    response = rmaker.make_authenticated_admin_request(
+        method='PATCH',
+        path='/api/v1/application_sessions/%s' % s7.id,
+        data=json.dumps(dict(backoff=True))
+    )
+    assert response.status_code == 200
+    resp = rmaker.make_authenticated_admin_request(path='/api/v1/application_sessions?limit=5')
+    assert resp.status_code == 200
+    assert s7.id not in [s['id'] for s in resp.json]
+
+    # backoff grows exponentially and is reset on state change
+    db.session.refresh(s7)
+    assert s7.backoff_count == 1
+    first_delay = s7.next_action_at - datetime.datetime.utcnow()
+    s7.back_off()
+    second_delay = s7.next_action_at - datetime.datetime.utcnow()
+    assert second_delay > first_delay
+    s7.state = ApplicationSession.STATE_RUNNING
+    s7.provisioned_at = datetime.datetime.utcnow()
+    db.session.commit()
+    assert s7.backoff_count == 0
+    assert s7.next_action_at > datetime.datetime.utcnow()
 
 
 def test_get_application_session(rmaker: RequestMaker, pri_data: PrimaryData):
@@ -505,6 +549,102 @@ def test_application_session_logs(rmaker: RequestMaker, pri_data: PrimaryData):
     assert 'patched running logs' == response_get.json[0]['message']
 
 
+def test_application_session_transitions(rmaker: RequestMaker, pri_data: PrimaryData):
+    session_id = pri_data.known_application_session_id_4
+    assert ApplicationSession.STATE_QUEUEING in db.session.get(ApplicationSession, session_id).transitions
+
+    # state changes are recorded, the first time wins
+    for state in ('provisioning', 'starting', 'starting'):
+        response = rmaker.make_authenticated_admin_request(
+            method='PATCH',
+            path='/api/v1/application_sessions/%s' % session_id,
+            data=json.dumps(dict(state=state))
+        )
+        assert response.status_code == 200
+    transitions = db.session.get(ApplicationSession, session_id).transitions
+    assert transitions['queueing'] <= transitions['provisioning'] <= transitions['starting']
+    starting_ts = transitions['starting']
+
+    # provisioning log milestones are recorded with the timestamp of the log record
+    for ts, message in ((1000.0, 'pulling container image'), (1010.0, 'some other message')):
+        response = rmaker.make_authenticated_admin_request(
+            method='PATCH',
+            path='/api/v1/application_sessions/%s/logs' % session_id,
+            data=json.dumps(dict(log_record=dict(
+                log_level='info', log_type='provisioning', timestamp=ts, message=message)))
+        )
+        assert response.status_code == 200
+    transitions = db.session.get(ApplicationSession, session_id).transitions
+    assert transitions['image_pulling'] == 1000.0
+    assert transitions['starting'] == starting_ts
+    assert len(transitions) == 4
+
+
+def test_application_session_phase_durations(rmaker: RequestMaker, pri_data: PrimaryData):
+    now = int(time.time())
+    path = '/api/v1/application_sessions/phase_durations?start_ts=%d&end_ts=%d' % (now - 3600, now + 3600)
+    for session_id, cluster, image, offset in (
+            (pri_data.known_application_session_id, 'cluster-1', 'image-1', 0),
+            (pri_data.known_application_session_id_2, 'cluster-1', 'image-2', 10),
+            (pri_data.known_application_session_id_5, 'cluster-2', 'image-2', 20),
+    ):
+        application_session = db.session.get(ApplicationSession, session_id)
+        application_session.provisioning_config = dict(cluster=cluster, image=image)
+        application_session.transitions = dict(
+            queueing=1000.0,
+            provisioning=1001.0 + offset,
+            starting=1002.0 + offset,
+            image_pulling=1003.0 + offset,
+            container_starting=1013.0 + 2 * offset,
+            running=1014.0 + 2 * offset,
+        )
+    db.session.commit()
+
+    # Anonymous
+    response = rmaker.make_request(path=path)
+    assert response.status_code == 401
+
+    # Authenticated User
+    response = rmaker.make_authenticated_user_request(path=path)
+    assert response.status_code == 403
+
+    # Admin, invalid window
+    response = rmaker.make_authenticated_admin_request(
+        path='/api/v1/application_sessions/phase_durations?start_ts=%d&end_ts=%d' % (now, now - 1))
+    assert response.status_code == 422
+
+    # Admin, by cluster. Sessions without a complete pair of transitions are not counted in the phase.
+    response = rmaker.make_authenticated_admin_request(path=path)
+    assert response.status_code == 200
+    assert response.json['group_by'] == 'cluster'
+    groups = {group['key']: group for group in response.json['groups']}
+    assert sorted(groups.keys()) == ['cluster-1', 'cluster-2']
+    phases = groups['cluster-1']['phases']
+    assert phases['queueing'] == dict(count=2, p50=1.0, p95=11.0, p99=11.0)
+    assert phases['scheduling'] == dict(count=2, p50=1.0, p95=1.0, p99=1.0)
+    assert phases['image_pull'] == dict(count=2, p50=10.0, p95=20.0, p99=20.0)
+    assert phases['total'] == dict(count=2, p50=14.0, p95=34.0, p99=34.0)
+    assert 'deprovisioning' not in phases
+    assert groups['cluster-2']['phases']['total'] == dict(count=1, p50=54.0, p95=54.0, p99=54.0)
+
+    # Admin, by image and application
+    response = rmaker.make_authenticated_admin_request(path=path + '&group_by=image')
+    assert response.status_code == 200
+    groups = {group['key']: group for group in response.json['groups']}
+    assert groups['image-2']['phases']['container_start']['count'] == 2
+
+    response = rmaker.make_authenticated_admin_request(path=path + '&group_by=application')
+    assert response.status_code == 200
+    for group in response.json['groups']:
+        assert group['name'] == db.session.get(Application, group['key']).name
+
+    # Admin, window before the sessions were created
+    response = rmaker.make_authenticated_admin_request(
+        path='/api/v1/application_sessions/phase_durations?start_ts=%d&end_ts=%d' % (now - 7200, now - 3600))
+    assert response.status_code == 200
+    assert response.json['groups'] == []
+
+
 def test_application_session_provisioning_config(rmaker: RequestMaker, pri_data: PrimaryData):
     # Authenticated User, should not see provisioning_config
     response = rmaker.make_authenticated_user_request(
@@ -543,3 +683,221 @@ def test_application_session_info(rmaker: RequestMaker, pri_data: PrimaryData):
         method='GET',
         path='/api/v1/application_sessions/%s' % pri_data.known_application_session_id)
     assert response.json.get('info') == dict(container_image='registry.example.org/pebbles/image1')
+
+
+def test_get_application_session_changes(rmaker: RequestMaker, pri_data: PrimaryData):
+    # Anonymous and user are not allowed
+    resp = rmaker.make_request(path='/api/v1/application_sessions/changes')
+    assert resp.status_code == 401
+    resp = rmaker.make_authenticated_user_request(path='/api/v1/application_sessions/changes')
+    assert resp.status_code == 403
+
+    # without a cursor we get the current position of the feed
+    resp = rmaker.make_authenticated_admin_request(path='/api/v1/application_sessions/changes')
+    assert resp.status_code == 200
+    assert resp.json['changes'] == []
+    cursor = resp.json['cursor']
+
+    # nothing has changed and nothing is due
+    resp = rmaker.make_authenticated_admin_request(
+        path='/api/v1/application_sessions/changes?since=%s&timeout=0.1' % cursor)
+    assert resp.status_code == 200
+    assert resp.json['changes'] == []
+    assert not resp.json['due']
+
+    # a state change is returned right away
+    resp = rmaker.make_authenticated_admin_request(
+        method='PATCH',
+        path='/api/v1/application_sessions/%s' % pri_data.known_application_session_id,
+        data=json.dumps(dict(state=ApplicationSession.STATE_STARTING)))
+    assert resp.status_code == 200
+    start_ts = time.time()
+    resp = rmaker.make_authenticated_admin_request(
+        path='/api/v1/application_sessions/changes?since=%s&timeout=10' % cursor)
+    assert resp.status_code == 200
+    assert time.time() - start_ts < 5
+    assert [(c['id'], c['state']) for c in resp.json['changes']] == [
+        (pri_data.known_application_session_id, ApplicationSession.STATE_STARTING)]
+    assert resp.json['cursor'] != cursor
+
+    # the starting session is due for action, so the caller is woken up right away
+    resp = rmaker.make_authenticated_admin_request(
+        path='/api/v1/application_sessions/changes?since=%s&timeout=10' % resp.json['cursor'])
+    assert resp.status_code == 200
+    assert resp.json['changes'] == []
+    assert resp.json['due']
+
+    # a cursor from another API process cannot be used to filter the changes, the caller has to check everything
+    for since in ('0123456789ab-1', '1700000000.5'):
+        resp = rmaker.make_authenticated_admin_request(
+            path='/api/v1/application_sessions/changes?since=%s&timeout=10' % since)
+        assert resp.status_code == 200
+        assert resp.json['resync']
+        assert resp.json['cursor'] != since
+
+
+def test_deleting_retry_backoff(rmaker: RequestMaker, pri_data: PrimaryData):
+    session_id = pri_data.known_application_session_id
+    path = '/api/v1/application_sessions/%s' % session_id
+    for data in (dict(to_be_deleted=True), dict(state=ApplicationSession.STATE_DELETING)):
+        resp = rmaker.make_authenticated_admin_request(method='PATCH', path=path, data=json.dumps(data))
+        assert resp.status_code == 200
+    session = db.session.get(ApplicationSession, session_id)
+    assert session.next_action_at <= datetime.datetime.utcnow()
+
+    # a deletion retry patches the same state, which does not reschedule the session. The backoff moves it forward,
+    # so that the session does not stay due and wake up the workers all the time.
+    for data in (dict(state=ApplicationSession.STATE_DELETING), dict(backoff=True)):
+        resp = rmaker.make_authenticated_admin_request(method='PATCH', path=path, data=json.dumps(data))
+        assert resp.status_code == 200
+    db.session.refresh(session)
+    assert session.next_action_at > datetime.datetime.utcnow()
+
+
+def test_application_session_stream(rmaker: RequestMaker, pri_data: PrimaryData):
+    # Anonymous
+    resp = rmaker.make_request(path='/api/v1/application_sessions/stream')
+    assert resp.status_code == 401
+
+    resp = rmaker.make_authenticated_admin_request(path='/api/v1/application_sessions/changes')
+    cursor = resp.json['cursor']
+
+    # user's session changes state, gets an endpoint and a provisioning log line
+    resp = rmaker.make_authenticated_admin_request(
+        method='PATCH',
+        path='/api/v1/application_sessions/%s' % pri_data.known_application_session_id,
+        data=json.dumps(dict(state=ApplicationSession.STATE_STARTING)))
+    assert resp.status_code == 200
+    resp = rmaker.make_authenticated_admin_request(
+        method='PATCH',
+        path='/api/v1/application_sessions/%s/logs' % pri_data.known_application_session_id,
+        data=json.dumps(dict(log_record=dict(
+            log_level='INFO', log_type='provisioning', timestamp=time.time(), message='pulling image'))))
+    assert resp.status_code == 200
+    resp = rmaker.make_authenticated_admin_request(
+        method='PATCH',
+        path='/api/v1/application_sessions/%s' % pri_data.known_application_session_id,
+        data=json.dumps(dict(
+            state=ApplicationSession.STATE_RUNNING,
+            session_data=json.dumps(dict(endpoints=[dict(name='https', access='https://example.org/s1')])))))
+    assert resp.status_code == 200
+    # somebody else's session
+    resp = rmaker.make_authenticated_admin_request(
+        method='PATCH',
+        path='/api/v1/application_sessions/%s' % pri_data.known_application_session_id_5,
+        data=json.dumps(dict(to_be_deleted=True)))
+    assert resp.status_code == 200
+
+    resp = rmaker.make_authenticated_user_request(
+        path='/api/v1/application_sessions/stream?since=%s&duration=0.5' % cursor)
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/event-stream'
+
+    events = []
+    for block in resp.get_data(as_text=True).split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':'))
+        if 'data' in fields:
+            events.append((fields['event'], json.loads(fields['data'])))
+
+    # the state and the session data are committed separately in PATCH
+    assert [event for event, _ in events] == [
+        'application_session', 'application_session_log', 'application_session', 'application_session']
+    assert all(data['id'] == pri_data.known_application_session_id for _, data in events)
+    assert events[0][1]['state'] == ApplicationSession.STATE_STARTING
+    assert 'session_data' not in events[0][1]
+    assert events[1][1]['log_record']['message'] == 'pulling image'
+    assert events[2][1]['state'] == ApplicationSession.STATE_RUNNING
+    assert events[3][1]['session_data']['endpoints'][0]['access'] == 'https://example.org/s1'
+
+    # reconnecting with the last event id continues after it, nothing new
+    resp = rmaker.make_authenticated_user_request(
+        path='/api/v1/application_sessions/stream?duration=0.1',
+        headers={'Last-Event-ID': resp.get_data(as_text=True).split('id: ')[-1].split('\n')[0]})
+    assert resp.status_code == 200
+    assert 'data: ' not in resp.get_data(as_text=True)
+
+    # a cursor from another API process makes the client reload its sessions
+    resp = rmaker.make_authenticated_user_request(
+        path='/api/v1/application_sessions/stream?duration=0.1', headers={'Last-Event-ID': '0123456789ab-1'})
+    assert resp.status_code == 200
+    assert 'event: resync' in resp.get_data(as_text=True)
+
+
+def test_application_session_stream_token(app, rmaker: RequestMaker, pri_data: PrimaryData):
+    from pebbles.views.application_sessions import ApplicationSessionStream
+    path = '/api/v1/application_sessions/stream?duration=0.1'
+    resp = rmaker.make_request(method='POST', path='/api/v1/application_sessions/stream_token')
+    assert resp.status_code == 401
+
+    # browsers cannot set the Authorization header for EventSource, they pass a stream token in the URL instead
+    resp = rmaker.make_authenticated_user_request(method='POST', path='/api/v1/application_sessions/stream_token')
+    assert resp.status_code == 200
+    assert resp.json['expires_in'] == app.config['APPLICATION_SESSION_STREAM_TOKEN_LIFETIME']
+    token = resp.json['token']
+    resp = rmaker.make_request(path=path + '&token=%s' % token)
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/event-stream'
+    resp.get_data()
+    resp.close()
+
+    # the stream token is not an API token
+    resp = rmaker.make_authenticated_request(path='/api/v1/application_sessions', auth_token=token)
+    assert resp.status_code == 401
+
+    # expired and bogus tokens, and API tokens in the URL are refused
+    user = db.session.get(User, pri_data.known_user_id)
+    expired_token = user.generate_auth_token(
+        app.config['SECRET_KEY'], expires_in=-1, scope=ApplicationSessionStream.STREAM_TOKEN_SCOPE)
+    api_token = user.generate_auth_token(app.config['SECRET_KEY'])
+    for bad_token in (expired_token, 'x' + token, api_token):
+        resp = rmaker.make_request(path=path + '&token=%s' % bad_token)
+        assert resp.status_code == 401
+
+
+def test_application_session_change_payloads(pri_data: PrimaryData):
+    from pebbles.change_feed import change_feed
+    from pebbles.query_stats import collect_queries
+    session_id = pri_data.known_application_session_id
+    since = change_feed.parse_cursor(change_feed.latest_cursor())
+
+    # large session data and log messages stay out of the change events, NOTIFY payloads are limited to 8000 bytes
+    application_session = db.session.get(ApplicationSession, session_id)
+    application_session.session_data = dict(endpoints=[dict(name='https', access='https://example.org/' + 'x' * 10000)])
+    with collect_queries() as stats:
+        for i in range(3):
+            db.session.add(ApplicationSessionLog(session_id, 'INFO', 'provisioning', time.time() + i, 'x' * 10000))
+        db.session.commit()
+    changes, _ = change_feed.wait_for_changes(since, 0)
+    assert sorted(c['kind'] for c in changes) == ['application_session'] + ['application_session_log'] * 3
+    assert all(len(json.dumps(c)) < 1000 for c in changes)
+
+    # the owners of the sessions are looked up once for all the new logs
+    assert len([s for s, _ in stats.statements if s.startswith('SELECT') and 'application_sessions' in s]) == 1
+
+
+def test_application_session_stream_limit(app, rmaker: RequestMaker, pri_data: PrimaryData):
+    from pebbles.views.application_sessions import ApplicationSessionStream
+    path = '/api/v1/application_sessions/stream?duration=0.1'
+
+    # finished streams give their slot back. The server closes the responses, in tests it has to be done explicitly.
+    open_streams = ApplicationSessionStream.slots.open_streams
+    app.config['APPLICATION_SESSION_STREAM_MAX_PER_PROCESS'] = open_streams + 1
+    for _ in range(3):
+        resp = rmaker.make_authenticated_user_request(path=path)
+        assert resp.status_code == 200
+        resp.get_data()
+        resp.close()
+    assert ApplicationSessionStream.slots.open_streams == open_streams
+
+    # beyond the limit clients are told to poll instead
+    assert ApplicationSessionStream.slots.acquire(open_streams + 1)
+    try:
+        resp = rmaker.make_authenticated_user_request(path=path)
+        assert resp.status_code == 503
+        assert resp.headers['Retry-After']
+    finally:
+        ApplicationSessionStream.slots.release()
+
+    app.config['APPLICATION_SESSION_STREAM_ENABLED'] = False
+    resp = rmaker.make_authenticated_user_request(path=path)
+    assert resp.status_code == 503
@@ -210,3 +210,127 @@ def test_add_results_to_tasks(rmaker: RequestMaker, pri_data: PrimaryData):
         data=json.dumps(dict(results=''))
     )
     assert response.status_code == 404
+
+
+def test_get_tasks_by_workspace(rmaker: RequestMaker, pri_data: PrimaryData):
+    for workspace_id in (pri_data.known_workspace_id, pri_data.known_workspace_id, pri_data.known_workspace_id_2):
+        response = rmaker.make_authenticated_admin_request(
+            method='POST',
+            path='/api/v1/tasks',
+            data=json.dumps(dict(kind='workspace_volume_backup', data=dict(workspace_id=workspace_id)))
+        )
+        assert response.status_code == 200
+
+    response = rmaker.make_authenticated_admin_request(
+        path='/api/v1/tasks?workspace_id=%s' % pri_data.known_workspace_id,
+    )
+    assert response.status_code == 200
+    assert len(response.json) == 2
+    assert {t['data']['workspace_id'] for t in response.json} == {pri_data.known_workspace_id}
+
+    response = rmaker.make_authenticated_admin_request(
+        path='/api/v1/tasks?workspace_id=foo',
+    )
+    assert response.status_code == 200
+    assert len(response.json) == 0
+
+
+def add_cluster_task(rmaker, cluster, priority=0):
+    response = rmaker.make_authenticated_admin_request(
+        method='POST',
+        path='/api/v1/tasks',
+        data=json.dumps(dict(
+            kind='workspace_volume_backup',
+            data=dict(workspace_id='ws-1', type='user-data', cluster=cluster),
+            priority=priority,
+        ))
+    )
+    assert response.status_code == 200
+    return response.json['id']
+
+
+def claim_tasks(rmaker, worker_id, limit=10):
+    response = rmaker.make_authenticated_admin_request(
+        method='POST',
+        path='/api/v1/tasks/claim',
+        data=json.dumps(dict(worker_id=worker_id, limit=limit))
+    )
+    assert response.status_code == 200
+    return [t['id'] for t in response.json]
+
+
+def test_claim_and_release_tasks(app, rmaker: RequestMaker, pri_data: PrimaryData):
+    app.config['TASK_MAX_JOBS_PER_CLUSTER'] = 2
+
+    c1_tasks = [add_cluster_task(rmaker, 'cluster-1') for _ in range(3)]
+    c2_task = add_cluster_task(rmaker, 'cluster-2')
+    high_priority_task = add_cluster_task(rmaker, 'cluster-1', priority=10)
+
+    # only admins
+    response = rmaker.make_authenticated_user_request(
+        method='POST', path='/api/v1/tasks/claim', data=json.dumps(dict(worker_id='w1')))
+    assert response.status_code == 403
+
+    # high priority first, then in creation order, limited to two Jobs per cluster
+    assert claim_tasks(rmaker, 'w1') == [high_priority_task, c1_tasks[0], c2_task]
+
+    # claimed tasks are leased, nothing else fits in cluster-1
+    assert claim_tasks(rmaker, 'w2') == []
+
+    # a task moves to processing, its Job is checked later
+    response = rmaker.make_authenticated_admin_request(
+        method='PATCH', path='/api/v1/tasks/%s' % c1_tasks[0], data=json.dumps(dict(state='processing')))
+    assert response.status_code == 200
+    response = rmaker.make_authenticated_admin_request(
+        method='POST', path='/api/v1/tasks/%s/release' % c1_tasks[0], data=json.dumps(dict(worker_id='w1', delay=60)))
+    assert response.status_code == 200
+    assert response.json['lease_owner'] is None
+    assert claim_tasks(rmaker, 'w2') == []
+
+    # only the lease owner can release the task or count its attempts
+    response = rmaker.make_authenticated_admin_request(
+        method='POST', path='/api/v1/tasks/%s/release' % high_priority_task,
+        data=json.dumps(dict(worker_id='w2', error='lease expired')))
+    assert response.status_code == 409
+    response = rmaker.make_authenticated_admin_request(
+        method='POST', path='/api/v1/tasks/%s/release' % high_priority_task, data=json.dumps(dict(delay=0)))
+    assert response.status_code == 400
+
+    # a failed attempt is retried with a backoff, the Job slot is freed for the next task
+    response = rmaker.make_authenticated_admin_request(
+        method='POST', path='/api/v1/tasks/%s/release' % high_priority_task,
+        data=json.dumps(dict(worker_id='w1', error='cluster api unavailable')))
+    assert response.status_code == 200
+    assert response.json['attempts'] == 1
+    assert response.json['state'] == Task.STATE_NEW
+    assert response.json['results'] == ['cluster api unavailable']
+    assert claim_tasks(rmaker, 'w2') == [c1_tasks[1]]
+
+    # out of attempts
+    task = db.session.scalar(select(Task).where(Task.id == high_priority_task))
+    task.attempts = Task.MAX_ATTEMPTS - 1
+    task.lease_owner = 'w2'
+    db.session.commit()
+    response = rmaker.make_authenticated_admin_request(
+        method='POST', path='/api/v1/tasks/%s/release' % high_priority_task,
+        data=json.dumps(dict(worker_id='w2', error='cluster api unavailable')))
+    assert response.json['state'] == Task.STATE_FAILED
+
+    # finishing releases the lease
+    response = rmaker.make_authenticated_admin_request(
+        method='PATCH', path='/api/v1/tasks/%s' % c2_task, data=json.dumps(dict(state='finished')))
+    assert response.status_code == 200
+    assert response.json['lease_owner'] is None
+
+
+def test_claim_skips_full_clusters(app, rmaker: RequestMaker, pri_data: PrimaryData):
+    app.config['TASK_MAX_JOBS_PER_CLUSTER'] = 2
+    c1_tasks = [add_cluster_task(rmaker, 'cluster-1') for _ in range(2)]
+    assert claim_tasks(rmaker, 'w1', limit=2) == c1_tasks
+
+    # cluster-1 is full and has more queued tasks than a claim considers, the newer cluster-2 task is still claimed
+    for _ in range(5):
+        add_cluster_task(rmaker, 'cluster-1')
+    c2_task = add_cluster_task(rmaker, 'cluster-2')
+    assert claim_tasks(rmaker, 'w2', limit=1) == [c2_task]
+    assert claim_tasks(rmaker, 'w2', limit=1) == []
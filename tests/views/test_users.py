@@ -1,6 +1,6 @@
 import json
 
-from pebbles.models import User
+from pebbles.models import User, Workspace, WorkspaceMembership
 from pebbles.models import db
 from tests.conftest import PrimaryData, RequestMaker
 
@@ -241,6 +241,66 @@ def test_post_user_admin(rmaker: RequestMaker, pri_data: PrimaryData):
     assert response.status_code == 400
 
 
+def test_import_users(app, rmaker: RequestMaker, pri_data: PrimaryData):
+    user_data = [
+        dict(ext_id='import-1@example.org', password='import-1-pw', email_id='Import-1@example.org'),
+        dict(ext_id='Import-2@example.org'),
+        dict(ext_id='import-2@example.org'),
+        dict(ext_id='user@example.org'),
+    ]
+    # Owner
+    response = rmaker.make_authenticated_workspace_owner_request(
+        method='POST',
+        path='/api/v1/users/import',
+        data=json.dumps(user_data)
+    )
+    assert response.status_code == 403
+
+    # Admin, invalid data
+    response = rmaker.make_authenticated_admin_request(
+        method='POST',
+        path='/api/v1/users/import',
+        data=json.dumps([dict(email_id='no-ext-id@example.org')])
+    )
+    assert response.status_code == 422
+
+    # Admin, too many users
+    app.config['USER_IMPORT_MAX_USERS'] = len(user_data) - 1
+    response = rmaker.make_authenticated_admin_request(
+        method='POST',
+        path='/api/v1/users/import',
+        data=json.dumps(user_data)
+    )
+    assert response.status_code == 422
+    app.config['USER_IMPORT_MAX_USERS'] = len(user_data)
+
+    # Admin, duplicates in the data are dropped and existing users are skipped
+    response = rmaker.make_authenticated_admin_request(
+        method='POST',
+        path='/api/v1/users/import?lifetime_in_days=7',
+        data=json.dumps(user_data)
+    )
+    assert response.status_code == 200
+    assert response.json['skipped'] == ['user@example.org']
+    created = {u['ext_id']: u for u in response.json['created']}
+    assert sorted(created.keys()) == ['import-1@example.org', 'import-2@example.org']
+    # only generated passwords are returned
+    assert 'password' not in created['import-1@example.org']
+    assert created['import-2@example.org']['password']
+
+    user_1 = User.query.filter_by(ext_id='import-1@example.org').one()
+    assert user_1.email_id == 'import-1@example.org'
+    assert user_1.check_password('import-1-pw')
+    assert round(user_1.expiry_ts - user_1.joining_ts) == 7 * 86400
+    user_2 = User.query.filter_by(ext_id='import-2@example.org').one()
+    assert user_2.check_password(created['import-2@example.org']['password'])
+
+    # new users are members of the default workspace
+    system_default_workspace = Workspace.query.filter_by(name='System.default').one()
+    for user in (user_1, user_2):
+        assert WorkspaceMembership.query.filter_by(workspace_id=system_default_workspace.id, user_id=user.id).one()
+
+
 def test_user_workspace_quota(rmaker: RequestMaker, pri_data: PrimaryData):
     # Anonymous
     response = rmaker.make_request(
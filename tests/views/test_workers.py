@@ -0,0 +1,35 @@
+import datetime
+
+from pebbles.models import db, WorkerHeartbeat
+from tests.conftest import PrimaryData, RequestMaker
+
+
+def test_worker_heartbeats(rmaker: RequestMaker, pri_data: PrimaryData):
+    # only admins
+    response = rmaker.make_authenticated_user_request(method='PUT', path='/api/v1/workers/worker-1')
+    assert response.status_code == 403
+
+    response = rmaker.make_authenticated_admin_request(method='PUT', path='/api/v1/workers/worker-1')
+    assert response.status_code == 200
+    assert [w['id'] for w in response.json] == ['worker-1']
+
+    response = rmaker.make_authenticated_admin_request(method='PUT', path='/api/v1/workers/worker-2')
+    assert response.status_code == 200
+    assert [w['id'] for w in response.json] == ['worker-1', 'worker-2']
+
+    # worker-1 stops sending heartbeats
+    heartbeat = db.session.get(WorkerHeartbeat, 'worker-1')
+    heartbeat.updated_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=WorkerHeartbeat.HEARTBEAT_TTL + 1)
+    db.session.commit()
+
+    response = rmaker.make_authenticated_admin_request(path='/api/v1/workers')
+    assert response.status_code == 200
+    assert [w['id'] for w in response.json] == ['worker-2']
+
+    # worker-2 leaves
+    response = rmaker.make_authenticated_admin_request(method='DELETE', path='/api/v1/workers/worker-2')
+    assert response.status_code == 200
+    response = rmaker.make_authenticated_admin_request(method='DELETE', path='/api/v1/workers/worker-2')
+    assert response.status_code == 404
+    response = rmaker.make_authenticated_admin_request(path='/api/v1/workers')
+    assert response.json == []
@@ -2,6 +2,7 @@ import datetime
 import json
 import time
 
+import pytest
 from dateutil.relativedelta import relativedelta
 from sqlalchemy import select
 
@@ -443,6 +444,61 @@ def test_delete_workspace(rmaker: RequestMaker, pri_data: PrimaryData):
             assert application_session.to_be_deleted
 
 
+def test_list_expired_workspaces(rmaker: RequestMaker, pri_data: PrimaryData):
+    expired_before = time.time()
+    # Authenticated
+    response = rmaker.make_authenticated_user_request(path='/api/v1/workspaces?expired_before=%d' % expired_before)
+    assert response.status_code == 403
+
+    # Admin, only ids of active workspaces that have expired and are not System workspaces
+    response = rmaker.make_authenticated_admin_request(path='/api/v1/workspaces?expired_before=%d' % expired_before)
+    assert response.status_code == 200
+    expected_ids = [
+        ws.id for ws in Workspace.query.filter_by(status='active').all()
+        if ws.expiry_ts < expired_before and not ws.name.startswith('System')
+    ]
+    assert expected_ids
+    assert sorted(response.json) == sorted(expected_ids)
+
+
+def test_bulk_delete_workspaces(rmaker: RequestMaker, pri_data: PrimaryData):
+    wss = [Workspace('WorkspaceToBeDeleted%d' % i) for i in range(3)]
+    db.session.add_all(wss)
+    db.session.commit()
+    ws_ids = [ws.id for ws in wss]
+
+    # Workspace owner
+    response = rmaker.make_authenticated_workspace_owner_request(
+        method='PATCH',
+        path='/api/v1/workspaces',
+        data=json.dumps(dict(workspace_ids=ws_ids, status='deleted'))
+    )
+    assert response.status_code == 403
+
+    # Admin, a System workspace in the batch, nothing is changed
+    response = rmaker.make_authenticated_admin_request(
+        method='PATCH',
+        path='/api/v1/workspaces',
+        data=json.dumps(dict(workspace_ids=ws_ids + [pri_data.system_default_workspace_id], status='deleted'))
+    )
+    assert response.status_code == 422
+    assert Workspace.query.filter(Workspace.id.in_(ws_ids), Workspace.status == 'active').count() == 3
+
+    # Admin, workspaces with applications and sessions
+    response = rmaker.make_authenticated_admin_request(
+        method='PATCH',
+        path='/api/v1/workspaces',
+        data=json.dumps(dict(workspace_ids=ws_ids + [pri_data.known_workspace_id], status='deleted'))
+    )
+    assert response.status_code == 200
+    assert response.json['num_changed'] == 4
+    assert Workspace.query.filter(Workspace.id.in_(ws_ids), Workspace.status == 'deleted').count() == 3
+    for application in Workspace.query.filter_by(id=pri_data.known_workspace_id).first().applications:
+        assert application.status == 'deleted'
+        for application_session in application.application_sessions:
+            assert application_session.to_be_deleted
+
+
 def test_join_workspace(rmaker: RequestMaker, pri_data: PrimaryData):
     # Anonymous
     response = rmaker.make_request(
@@ -973,6 +1029,35 @@ def test_clear_expired_members_from_workspace(rmaker: RequestMaker, pri_data: Pr
     assert response.json.get('num_deleted') == 1
 
 
+def test_clear_expired_members_from_all_workspaces(rmaker: RequestMaker, pri_data: PrimaryData):
+    ws = Workspace(name='WorkspaceToBeCleared')
+    ws.membership_expiry_policy = dict(kind=Workspace.MEP_ACTIVITY_TIMEOUT, timeout_days=45)
+    u1 = User.query.filter_by(id=pri_data.known_user_id).first()
+    u1.last_login_ts = time.time() - 46 * 24 * 3600
+    ws.memberships.append(WorkspaceMembership(user=u1, workspace=ws, is_manager=False, is_owner=False))
+    db.session.add(ws)
+    db.session.commit()
+
+    # Anonymous
+    response = rmaker.make_request(method='POST', path='/api/v1/workspaces/clear_expired_members')
+    assert response.status_code == 401
+    # Authenticated workspace owner
+    response = rmaker.make_authenticated_workspace_owner_request(
+        method='POST', path='/api/v1/workspaces/clear_expired_members')
+    assert response.status_code == 403
+
+    # Admin
+    response = rmaker.make_authenticated_admin_request(method='POST', path='/api/v1/workspaces/clear_expired_members')
+    assert response.status_code == 200
+    assert response.json == dict(num_deleted=1, workspaces={ws.id: 1})
+    assert WorkspaceMembership.query.filter_by(workspace_id=ws.id).count() == 0
+
+    # nothing left to remove
+    response = rmaker.make_authenticated_admin_request(method='POST', path='/api/v1/workspaces/clear_expired_members')
+    assert response.status_code == 200
+    assert response.json == dict(num_deleted=0, workspaces={})
+
+
 def test_clear_expired_members_from_workspace_no_login(rmaker: RequestMaker, pri_data: PrimaryData):
     ws = Workspace(name='WorkspaceToBeCleared')
     ws.membership_expiry_policy = dict(kind=Workspace.MEP_ACTIVITY_TIMEOUT, timeout_days=60)
@@ -1143,6 +1228,65 @@ def test_workspace_accounting(rmaker: RequestMaker, pri_data: PrimaryData):
     assert response.json['gib_hours'] == 28
 
 
+def test_workspace_accounting_report(rmaker: RequestMaker, pri_data: PrimaryData):
+    june_2022 = dict(
+        start_ts=int(datetime.datetime(2022, 6, 1, tzinfo=datetime.timezone.utc).timestamp()),
+        end_ts=int(datetime.datetime(2022, 7, 1, tzinfo=datetime.timezone.utc).timestamp()),
+    )
+    # Anonymous
+    response = rmaker.make_request(
+        method='GET',
+        path='/api/v1/workspace_accounting?start_ts=%(start_ts)d&end_ts=%(end_ts)d' % june_2022
+    )
+    assert response.status_code == 401
+
+    # Authenticated Workspace Owner
+    response = rmaker.make_authenticated_workspace_owner_request(
+        method='GET',
+        path='/api/v1/workspace_accounting?start_ts=%(start_ts)d&end_ts=%(end_ts)d' % june_2022
+    )
+    assert response.status_code == 403
+
+    # Admin, invalid window
+    response = rmaker.make_authenticated_admin_request(
+        method='GET',
+        path='/api/v1/workspace_accounting?start_ts=%(end_ts)d&end_ts=%(start_ts)d' % june_2022
+    )
+    assert response.status_code == 422
+
+    # Admin, JSON
+    response = rmaker.make_authenticated_admin_request(
+        method='GET',
+        path='/api/v1/workspace_accounting?start_ts=%(start_ts)d&end_ts=%(end_ts)d' % june_2022
+    )
+    assert response.status_code == 200
+    assert len(response.json) == 1
+    row = response.json[0]
+    assert row['workspace_id'] == pri_data.known_workspace_id
+    assert row['month'] == '2022-06'
+    assert row['gib_hours'] == pytest.approx(28)
+
+    # Admin, CSV
+    response = rmaker.make_authenticated_admin_request(
+        method='GET',
+        path='/api/v1/workspace_accounting?start_ts=%(start_ts)d&end_ts=%(end_ts)d&format=csv' % june_2022
+    )
+    assert response.status_code == 200
+    lines = response.data.decode('utf-8').splitlines()
+    assert lines[0] == 'workspace_id,workspace_name,cluster,month,gib_hours'
+    assert len(lines) == 2
+    assert lines[1].startswith(pri_data.known_workspace_id)
+
+    # Admin, window with no sessions
+    response = rmaker.make_authenticated_admin_request(
+        method='GET',
+        path='/api/v1/workspace_accounting?start_ts=%d&end_ts=%d' % (
+            june_2022['end_ts'], june_2022['end_ts'] + 3600)
+    )
+    assert response.status_code == 200
+    assert response.json == []
+
+
 def test_workspace_user_folder_size(rmaker: RequestMaker, pri_data: PrimaryData):
     # Anonymous
     response = rmaker.make_request(
@@ -1362,6 +1506,24 @@ def test_create_volume_tasks(rmaker: RequestMaker, pri_data: PrimaryData):
     ).all()
     # one task per workspace member plus one for shared folder
     assert len(tasks) == len(members) + 1
+    assert sorted(t.data.get('type') for t in tasks) == ['shared-data'] + ['user-data'] * len(members)
+    for task in tasks:
+        assert task.state == Task.STATE_NEW
+        assert task.cluster == task.data.get('cluster')
+        assert task.create_ts
+
+    # Admin, legal request for a batch backup
+    response = rmaker.make_authenticated_admin_request(
+        method='POST',
+        path='/api/v1/workspaces/%s/create_volume_tasks' % pri_data.known_workspace_id,
+        data=json.dumps(dict(task_kind='workspace_volume_backup', batch=True)),
+    )
+    assert response.status_code == 200
+    tasks = db.session.scalars(
+        select(Task).where(Task.kind == 'workspace_volume_backup', Task.id.not_in([t.id for t in tasks]))).all()
+    assert len(tasks) == 1
+    assert tasks[0].data.get('type') == 'workspace-data'
+    assert tasks[0].data.get('workspace_id') == pri_data.known_workspace_id
 
     # Admin, legal request for restore
     response = rmaker.make_authenticated_admin_request(
@@ -1385,6 +1547,8 @@ def test_create_volume_tasks(rmaker: RequestMaker, pri_data: PrimaryData):
         dict(task_kind='workspace_volume_restore'),
         dict(task_kind='workspace_restore'),
         dict(task_kind='workspace_volume_restore', cluster='dummy_cluster_2'),
+        dict(task_kind='workspace_volume_restore', src_cluster='dummy_cluster_1', tgt_cluster='dummy_cluster_2',
+             batch=True),
 
     ]
     for data in invalid_data: